@@ -0,0 +1,222 @@
+"""Benchmarks for dshield against a local simulated DShield server.
+
+Measures throughput, p50/p99 latency and peak memory for single calls, bulk
+IP lookups and large-payload decoding. Results are written as JSON together
+with the commit they were measured on; ``--compare`` checks them against an
+earlier run and exits non-zero on regressions::
+
+    python -m benchmarks.run --output before.json
+    python -m benchmarks.run --compare before.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import dshield
+from benchmarks.server import SimulatedServer
+from dshield.replay import Archive
+
+# Metrics where a larger value is better; for all others smaller is better.
+_HIGHER_IS_BETTER = ('throughput',)
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def _timed(function, repeat):
+    """Call `function` `repeat` times and summarise the latencies."""
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        call_started = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    return {
+        'calls': repeat,
+        'throughput': repeat / elapsed,
+        'p50': _percentile(latencies, 50),
+        'p99': _percentile(latencies, 99),
+    }
+
+
+def _peak_memory(function):
+    """Return the peak memory allocated while running `function`."""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class _Discard(object):
+    """A sink that drops everything written to it."""
+
+    def write(self, data):
+        return len(data)
+
+
+def bench_single(options):
+    results = {}
+    for name, call in [('infocon', dshield.infocon),
+                       ('ip', lambda: dshield.ip('10.0.0.1')),
+                       ('topports', lambda: dshield.topports(limit=100))]:
+        call()
+        results[name] = _timed(call, options.repeat)
+    return results
+
+
+def bench_bulk(options):
+    addresses = ['10.{0}.{1}.{2}'.format(n // 65536, n // 256 % 256, n % 256)
+                 for n in range(options.addresses)]
+    results = {}
+    for concurrency in (1, options.concurrency):
+        started = time.perf_counter()
+        count = sum(1 for _ in dshield.ip_many(addresses, concurrency))
+        elapsed = time.perf_counter() - started
+        results['concurrency_{0}'.format(concurrency)] = {
+            'calls': count, 'throughput': count / elapsed}
+    return results
+
+
+def bench_large(options):
+    results = {}
+    limit = options.large_rows
+    for name, call in [
+            ('sources_dicts', lambda: dshield.sources('ip', limit)),
+            ('sources_typed', lambda: dshield.sources('ip', limit,
+                                                      return_format=dshield.TYPED)),
+            ('sources_columnar', lambda: dshield.sources(
+                'ip', limit, return_format=dshield.COLUMNAR)),
+            ('sources_iter', lambda: sum(1 for _ in dshield.iter_sources('ip', limit))),
+            ('sources_text', lambda: dshield.sources('ip', limit,
+                                                     return_format=dshield.TEXT)),
+            ('sources_download', lambda: dshield.download_sources(
+                _Discard(), 'ip', limit, return_format=dshield.TEXT))]:
+        call()
+        result = _timed(call, max(1, options.repeat // 20))
+        result['peak_memory'] = _peak_memory(call)
+        results[name] = result
+    return results
+
+
+SCENARIOS = {
+    'single': bench_single,
+    'bulk': bench_bulk,
+    'large': bench_large,
+}
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    """Run the selected scenarios against a fresh simulated server."""
+    archive = Archive(options.archive) if options.archive else None
+    server = SimulatedServer(latency=options.latency, rows=options.rows,
+                             error_rate=options.error_rate, seed=options.seed,
+                             archive=archive).start()
+    dshield.configure_session(pool_size=options.concurrency,
+                              base_url=server.base_url)
+    dshield.configure_retries(backoff=0)
+    try:
+        results = dict((name, SCENARIOS[name](options))
+                       for name in options.scenarios)
+    finally:
+        dshield.configure_session()
+        dshield.configure_retries()
+        server.stop()
+    return {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'options': dict((key, value) for key, value in vars(options).items()
+                        if key not in ('output', 'compare')),
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold):
+    """Yield (name, before, after, change, regressed) for shared metrics."""
+    for scenario, cases in sorted(current['results'].items()):
+        for case, metrics in sorted(cases.items()):
+            before_metrics = baseline['results'].get(scenario, {}).get(case, {})
+            for metric, after in sorted(metrics.items()):
+                before = before_metrics.get(metric)
+                if metric == 'calls' or not before:
+                    continue
+                change = (after - before) / float(before)
+                if metric in _HIGHER_IS_BETTER:
+                    regressed = change < -threshold
+                else:
+                    regressed = change > threshold
+                yield ('/'.join([scenario, case, metric]), before, after,
+                       change, regressed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='one of {0} (default: all)'.format(
+                            ', '.join(sorted(SCENARIOS))))
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='calls per single-call measurement')
+    parser.add_argument('--addresses', type=int, default=500,
+                        help='addresses looked up in the bulk scenario')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='simulated server latency in seconds')
+    parser.add_argument('--rows', type=int, default=100,
+                        help='default rows in list responses')
+    parser.add_argument('--large-rows', type=int, default=10000,
+                        help='rows in the large-payload scenario')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--archive',
+                        help='serve real responses recorded in this archive '
+                             'where available, see dshield.configure_archive')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative change counted as a regression')
+    options = parser.parse_args(argv)
+    options.scenarios = options.scenarios or sorted(SCENARIOS)
+    for name in options.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario {0!r}'.format(name))
+
+    report = run(options)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = 0
+        for name, before, after, change, regressed in compare(
+                baseline, report, options.threshold):
+            regressions += regressed
+            print('{0:<45} {1:>14.6g} {2:>14.6g} {3:>+8.1%}{4}'.format(
+                name, before, after, change, '  REGRESSION' if regressed else ''))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+"""A local stand-in for the DShield API, for benchmarks.
+
+Every route under ``/api/`` answers with deterministic synthetic data in the
+JSON, XML, TEXT or PHP format, with tunable latency, payload size and error
+rate. Responses recorded from the real API with :func:`dshield.configure_archive`
+can be served instead of synthetic ones where available. Run it on its own
+with ``python -m benchmarks.server``.
+"""
+
+import argparse
+import datetime
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+from dshield.replay import Archive
+
+
+def _ip(rng):
+    return '.'.join(str(rng.randint(1, 254)) for _ in range(4))
+
+
+def _day(value, default):
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return default
+
+
+def _limit(value, default):
+    return int(value) if value and value.isdigit() else default
+
+
+def _days(args, default_days):
+    end = _day(args[1] if len(args) > 1 else None, datetime.date(2012, 5, 31))
+    start = _day(args[0] if args else None,
+                 end - datetime.timedelta(days=default_days))
+    return [start + datetime.timedelta(days=n)
+            for n in range((end - start).days + 1)]
+
+
+def _counts(rng, row):
+    row.update(records=str(rng.randint(1, 10 ** 6)),
+               targets=str(rng.randint(1, 10 ** 5)),
+               sources=str(rng.randint(1, 10 ** 4)))
+    return row
+
+
+def _sources(rng, count):
+    return [{'ip': _ip(rng), 'attacks': str(rng.randint(1, 10 ** 5)),
+             'count': str(rng.randint(1, 10 ** 6)),
+             'firstseen': '2012-03-0{0}'.format(rng.randint(1, 8)),
+             'lastseen': '2012-03-08'} for _ in range(count)]
+
+
+def payload(endpoint, args, rows, rng):
+    """Return synthetic decoded data for an endpoint and its URI arguments."""
+    if endpoint == 'infocon':
+        return {'status': 'green'}
+    if endpoint == 'handler':
+        return {'name': 'Benchmark Handler'}
+    if endpoint == 'ip':
+        if args and args[0] == 'badip':
+            return {'error': 'bad IP address'}
+        return {'ip': {'number': args[0] if args else '', 'count': '12',
+                       'attacks': '3', 'maxdate': '2012-03-08',
+                       'mindate': '2012-03-01', 'as': '4837'}}
+    if endpoint in ('port', 'portdate'):
+        if args and not args[0].isdigit():
+            return {'error': 'bad port number'}
+        return {'number': args[0] if args else '', 'data': _counts(rng, {})}
+    if endpoint == 'backscatter':
+        return [{'sourceport': str(rng.randint(1, 65535)),
+                 'count': str(rng.randint(1, 10 ** 6)),
+                 'sources': str(rng.randint(1, 10 ** 4)),
+                 'targets': str(rng.randint(1, 10 ** 5))}
+                for _ in range(_limit(args[1] if len(args) > 1 else None, rows))]
+    if endpoint == 'topports':
+        data = {'limit': _limit(args[1] if len(args) > 1 else None, 10)}
+        for rank in range(data['limit']):
+            data[str(rank)] = _counts(rng, {'rank': rank + 1,
+                                            'targetport': rng.randint(1, 65535)})
+        return data
+    if endpoint == 'topips':
+        return [{'rank': str(rank + 1), 'source': _ip(rng),
+                 'reports': str(rng.randint(1, 10 ** 6)),
+                 'targets': str(rng.randint(1, 10 ** 5))}
+                for rank in range(_limit(args[1] if len(args) > 1 else None, 10))]
+    if endpoint in ('sources', 'asnum'):
+        return _sources(rng, _limit(args[1] if len(args) > 1 else None, rows))
+    if endpoint == 'porthistory':
+        if args and not args[0].isdigit():
+            return {'porthistory': {'error': 'bad port number'}}
+        return {'porthistory': [_counts(rng, {'date': str(day)})
+                                for day in _days(args[1:], 30)]}
+    if endpoint == 'dailysummary':
+        return [_counts(rng, {'date': str(day)}) for day in _days(args, 0)]
+    if endpoint == 'daily404summary':
+        return [{'date': args[0] if args else '', 'count': str(rng.randint(1, 999))}]
+    if endpoint == 'daily404detail':
+        return [{'url': '/{0}.php'.format(rng.randint(1, 10 ** 6)),
+                 'ip': _ip(rng), 'count': str(rng.randint(1, 99))}
+                for _ in range(_limit(args[1] if len(args) > 1 else None, rows))]
+    if endpoint == 'glossary':
+        return [{'term': 'term{0}'.format(n), 'definition': 'Definition.'}
+                for n in range(20)]
+    if endpoint in ('webhoneypotsummary', 'webhoneypotbytype'):
+        return [{'type': 'type{0}'.format(n), 'count': str(rng.randint(1, 999))}
+                for n in range(30)]
+    return None
+
+
+def _xml(value, tag='response'):
+    if isinstance(value, dict):
+        inner = ''.join(_xml(item, key if not key.isdigit() else 'row')
+                        for key, item in value.items())
+    elif isinstance(value, list):
+        inner = ''.join(_xml(item, 'row') for item in value)
+    else:
+        inner = escape(str(value))
+    return '<{0}>{1}</{0}>'.format(tag, inner)
+
+
+def _text(value):
+    rows = value if isinstance(value, list) else [value]
+    return '\n'.join('\t'.join(str(item) for item in row.values())
+                     if isinstance(row, dict) else str(row) for row in rows)
+
+
+def _php(value):
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = enumerate(value)
+    else:
+        value = str(value)
+        return 's:{0}:"{1}";'.format(len(value.encode('utf-8')), value)
+    return 'a:{0}:{{{1}}}'.format(len(value), ''.join(
+        _php(str(key)) + _php(item) for key, item in items))
+
+
+FORMATS = {
+    'json': ('application/json', lambda value: json.dumps(value)),
+    'xml': ('text/xml', lambda value: '<?xml version="1.0" encoding="UTF-8"?>\n'
+            + _xml(value)),
+    'text': ('text/plain', _text),
+    'php': ('text/plain', _php),
+}
+
+
+class SimulatedServer(ThreadingHTTPServer):
+    """A threaded HTTP server mimicking every dshield.org/api/ route.
+
+    :param latency: seconds added before every response
+    :param jitter: maximum random seconds added on top of `latency`
+    :param rows: default number of rows for list endpoints (e.g. sources)
+    :param error_rate: fraction of requests answered with 503 and Retry-After
+    :param seed: seed making payloads and errors reproducible
+    :param archive: optional :class:`dshield.replay.Archive` whose recorded
+                    responses are served for the requests it holds
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.0,
+                 rows=100, error_rate=0.0, seed=0, archive=None):
+        ThreadingHTTPServer.__init__(self, address, _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.rows = rows
+        self.error_rate = error_rate
+        self.seed = seed
+        self.archive = archive
+        self.requests = 0
+        self._bodies = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._thread = None
+
+    @property
+    def base_url(self):
+        """The API root to pass to :func:`dshield.configure_session`."""
+        return 'http://{0}:{1}/api/'.format(*self.server_address[:2])
+
+    def body(self, path, fmt):
+        """Return the (content type, body bytes) for a path and format."""
+        key = (path, fmt)
+        request = '{0}?{1}'.format(path, fmt)
+        if self.archive is not None and request in self.archive:
+            return FORMATS[fmt][0], self.archive.get(request).content
+        if key not in self._bodies:
+            parts = [part for part in path.split('/') if part]
+            rng = random.Random(zlib.crc32(path.encode('utf-8')) ^ self.seed)
+            data = payload(parts[0] if parts else '', parts[1:], self.rows, rng)
+            content_type, serialize = FORMATS[fmt]
+            body = serialize(data).encode('utf-8') if data is not None else None
+            with self._lock:
+                self._bodies[key] = (content_type, body)
+        return self._bodies[key]
+
+    def should_fail(self):
+        with self._lock:
+            self.requests += 1
+            return self.error_rate and self._random.random() < self.error_rate
+
+    def delay(self):
+        with self._lock:
+            extra = self._random.uniform(0, self.jitter) if self.jitter else 0
+        return self.latency + extra
+
+    def start(self):
+        """Serve from a daemon thread and return self."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this, delayed ACKs
+    # add ~40ms to every response on a kept-alive connection.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        fmt = query.split('&')[0].split('=')[0] or 'json'
+        delay = self.server.delay()
+        if delay:
+            time.sleep(delay)
+        if not path.startswith('/api/') or fmt not in FORMATS:
+            return self._send(404, 'text/plain', b'not found')
+        if self.server.should_fail():
+            return self._send(503, 'text/plain', b'busy', {'Retry-After': '0'})
+        content_type, body = self.server.body(path[len('/api/'):], fmt)
+        if body is None:
+            return self._send(404, 'text/plain', b'not found')
+        self._send(200, content_type, body)
+
+    def _send(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--archive', help='serve responses recorded here')
+    args = parser.parse_args(argv)
+    archive = Archive(args.archive) if args.archive else None
+    server = SimulatedServer(('127.0.0.1', args.port), args.latency,
+                             args.jitter, args.rows, args.error_rate, args.seed,
+                             archive)
+    print('Serving on {0}'.format(server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
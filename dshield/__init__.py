@@ -0,0 +1,1319 @@
+"""A Pythonic interface to the Internet Storm Center / DShield API."""
+
+import collections
+import datetime
+import io
+import ipaddress
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent import futures
+
+import requests
+
+from dshield import records
+from dshield.cache import (DiskStore, MemoryCache, SharedCache,
+                           conditional_headers, endpoint, is_historical)
+from dshield.metrics import (RequestEvent, TimedHTTPAdapter, connect_time,
+                             reset_connect_time)
+from dshield.ratelimit import RETRY_STATUSES, RetryPolicy, TokenBucket, retry_after
+from dshield.replay import RECORD, REPLAY, Archive, ReplayMiss
+from dshield.stream import CHUNK_SIZE, iter_json_records, iter_xml_records
+
+__version__ = "0.2.1"
+
+__all__ = [
+    'XML', 'JSON', 'TEXT', 'PHP', 'TYPED', 'COLUMNAR', 'RECORD', 'REPLAY',
+    'DEFAULT_POOL_SIZE', 'DEFAULT_TIMEOUT', 'MAX_RANGE_DAYS', 'Error',
+    'ReplayMiss', 'configure_session', 'close_session', 'configure_cache',
+    'disable_cache', 'get_cache', 'configure_store', 'disable_store',
+    'get_store', 'configure_archive', 'disable_archive', 'get_archive',
+    'configure_refresher', 'disable_refresher', 'get_refresher',
+    'configure_rate_limit', 'configure_retries', 'add_hook', 'remove_hook',
+    'backscatter', 'handler', 'infocon', 'ip', 'ip_many', 'port', 'portdate',
+    'topports', 'topips', 'sources', 'porthistory', 'asnum', 'dailysummary',
+    'daily404summary', 'daily404detail', 'glossary', 'webhoneypotsummary',
+    'webhoneypotbytype', 'iter_sources', 'iter_asnum', 'iter_daily404detail',
+    'download_sources', 'download_asnum', 'download_daily404detail'
+]
+
+XML = "?xml"
+JSON = "?json"
+TEXT = "?text"
+PHP = "?php"
+# Not API formats: JSON responses converted locally, see dshield.records.
+TYPED = "typed"
+COLUMNAR = "columnar"
+
+__BASE_URL = "https://dshield.org/api/"
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 30
+
+# Longest date range, in days, requested from the API in one call. Longer
+# ranges are split into windows of this size and fetched concurrently.
+MAX_RANGE_DAYS = 30
+
+_session = None
+_base_url = __BASE_URL
+_pool_size = DEFAULT_POOL_SIZE
+_timeout = DEFAULT_TIMEOUT
+_session_lock = threading.Lock()
+_cache = None
+_store = None
+_archive = None
+_refresher = None
+_limiter = None
+_retry = RetryPolicy()
+_inflight = {}
+_inflight_lock = threading.Lock()
+_hooks = []
+_MISSING = object()
+
+# Local conversions of decoded JSON, by return_format.
+_CONVERTERS = {
+    TYPED: records.convert,
+    COLUMNAR: records.to_columns,
+}
+
+
+class Error(Exception):
+    """Custom exception class."""
+
+
+def _new_session(pool_size):
+    """Create a keep-alive session with a connection pool of `pool_size`."""
+    session = requests.Session()
+    adapter = TimedHTTPAdapter(pool_connections=pool_size,
+                               pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def configure_session(pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                      session=None, base_url=None):
+    """Replace the shared HTTP session used by every API call.
+
+    Connections are kept alive and reused between calls, and the session may
+    be shared freely between threads.
+
+    :param pool_size: maximum number of pooled connections kept open
+    :param timeout: default timeout in seconds for each request, or None
+    :param session: an optional pre-built `requests.Session` to use instead
+    :param base_url: optional API root to use instead of dshield.org, such
+                     as a mirror or a local test server
+    """
+    global _session, _base_url, _pool_size, _timeout
+    with _session_lock:
+        old, _session = _session, session or _new_session(pool_size)
+        _base_url = base_url or __BASE_URL
+        _pool_size = pool_size
+        _timeout = timeout
+    if old is not None and old is not _session:
+        old.close()
+
+
+def close_session():
+    """Close the shared HTTP session and its pooled connections.
+
+    A new session is created on the next API call.
+    """
+    global _session
+    with _session_lock:
+        old, _session = _session, None
+    if old is not None:
+        old.close()
+
+
+def _get_session():
+    """Return the shared HTTP session, creating it on first use."""
+    global _session
+    session = _session
+    if session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _new_session(DEFAULT_POOL_SIZE)
+            session = _session
+    return session
+
+
+def add_hook(hook):
+    """Call `hook` with a :class:`dshield.metrics.RequestEvent` after every
+    API call, from the thread that made the call.
+
+    Hooks should be quick and must not raise.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Stop calling a hook added with :func:`add_hook`."""
+    _hooks.remove(hook)
+
+
+def configure_rate_limit(rate=None, burst=None, limiter=None):
+    """Pace all API requests in the process with a shared token bucket.
+
+    The rate adapts when the server throttles requests, see
+    :class:`dshield.ratelimit.TokenBucket`.
+
+    :param rate: requests per second, or None to disable rate limiting
+    :param burst: maximum number of requests sent back to back
+    :param limiter: an optional pre-built limiter to use instead
+    """
+    global _limiter
+    if limiter is None and rate is not None:
+        limiter = TokenBucket(rate, burst)
+    _limiter = limiter
+
+
+def configure_retries(max_retries=3, backoff=0.5, max_backoff=60):
+    """Set how requests are retried on throttling (429), server errors (5xx)
+    and connection failures.
+
+    Delays grow exponentially with full jitter and honour Retry-After.
+
+    :param max_retries: number of retries after the first attempt, 0 to
+                        disable retries
+    :param backoff: base delay in seconds, doubled on each retry
+    :param max_backoff: cap on any single delay in seconds; a response
+                        asking to retry after longer is returned as is
+    """
+    global _retry
+    _retry = RetryPolicy(max_retries, backoff, max_backoff)
+
+
+def configure_cache(maxsize=None, ttls=None, cache=None, path=None):
+    """Enable caching of API responses in front of every call.
+
+    Responses are cached per API URI and `return_format`, evicted least
+    recently used first, and expire after a per-endpoint TTL (see
+    :class:`dshield.cache.MemoryCache`). Queries pinned to past dates do not
+    expire. Cached values are shared between callers, so treat them as
+    read-only.
+
+    :param maxsize: optional maximum number of cached responses
+    :param ttls: optional dict of endpoint name to TTL in seconds
+    :param cache: an optional pre-built cache to use instead
+    :param path: optional SQLite file to share the cache between processes
+                 on this host, see :class:`dshield.cache.SharedCache`
+    """
+    global _cache
+    if cache is None:
+        kwargs = {'ttls': ttls}
+        if maxsize is not None:
+            kwargs['maxsize'] = maxsize
+        if path is not None:
+            cache = SharedCache(path, **kwargs)
+        else:
+            cache = MemoryCache(**kwargs)
+    _cache = cache
+
+
+def disable_cache():
+    """Stop caching API responses and drop the current cache."""
+    global _cache
+    _cache = None
+
+
+def get_cache():
+    """Return the active response cache, or None if caching is disabled."""
+    return _cache
+
+
+def configure_store(path=None, max_bytes=None, store=None):
+    """Persist responses to queries pinned to past dates in a local file.
+
+    Dated queries for days that are over never change, so they are fetched
+    once and then served from disk, across processes and restarts. Undated
+    queries and those that include today always go to the API.
+
+    :param path: path of the SQLite database file
+    :param max_bytes: optional cap on the total size of stored responses
+    :param store: an optional pre-built :class:`dshield.cache.DiskStore`
+    """
+    global _store
+    old, _store = _store, store or DiskStore(path, max_bytes)
+    if old is not None and old is not _store:
+        old.close()
+
+
+def disable_store():
+    """Stop using the persistent store and close it."""
+    global _store
+    old, _store = _store, None
+    if old is not None:
+        old.close()
+
+
+def get_store():
+    """Return the active persistent store, or None if it is disabled."""
+    return _store
+
+
+def configure_archive(path=None, mode=REPLAY, archive=None):
+    """Record API responses to a local archive, or replay them from one.
+
+    When recording, every response received from the API is appended to the
+    archive. When replaying, no request reaches the network: responses are
+    served from memory, skipping rate limits and retries, and requests that
+    were never recorded raise :class:`dshield.replay.ReplayMiss`. The
+    response cache and persistent store still apply in front of the archive.
+
+    :param path: path of the archive file
+    :param mode: dshield.RECORD or dshield.REPLAY
+    :param archive: an optional pre-built :class:`dshield.replay.Archive`
+    """
+    global _archive
+    old, _archive = _archive, archive or Archive(path, mode)
+    if old is not None and old is not _archive:
+        old.close()
+
+
+def disable_archive():
+    """Stop recording or replaying and close the archive."""
+    global _archive
+    old, _archive = _archive, None
+    if old is not None:
+        old.close()
+
+
+def get_archive():
+    """Return the active archive, or None if neither recording nor
+    replaying."""
+    return _archive
+
+
+def configure_refresher(refresher):
+    """Serve the queries registered with `refresher` from it.
+
+    Calls to those queries return the refresher's last good value without
+    waiting for the network, even when it is overdue; see
+    :class:`dshield.refresh.Refresher`. Other queries are unaffected.
+
+    :param refresher: a :class:`dshield.refresh.Refresher`
+    """
+    global _refresher
+    old, _refresher = _refresher, refresher
+    if old is not None and old is not refresher:
+        old.stop()
+
+
+def disable_refresher():
+    """Stop serving from the refresher, and stop its background thread."""
+    global _refresher
+    old, _refresher = _refresher, None
+    if old is not None:
+        old.stop()
+
+
+def get_refresher():
+    """Return the active refresher, or None."""
+    return _refresher
+
+
+def _path(function, return_format=None):
+    """Return the API path and query for `function` in `return_format`,
+    e.g. 'ip/8.8.8.8?json'."""
+    return function + (return_format or JSON)
+
+
+def _url(function, return_format=None):
+    """Return the full API URL for `function` in `return_format`."""
+    return _base_url + _path(function, return_format)
+
+
+def _replayed(entry, url):
+    """Build a response for a recorded archive entry."""
+    response = requests.Response()
+    response.status_code = entry.status
+    response.encoding = entry.encoding
+    response.raw = io.BytesIO(entry.content)
+    response.url = url
+    return response
+
+
+def _request(function, return_format=None, event=None, headers=None):
+    """Return the response to a GET for `function`, with its body not read
+    yet, from the API or from the archive if one is configured.
+
+    Extra request `headers` are not sent while recording, so that the
+    archive only holds complete responses.
+    """
+    archive = _archive
+    if archive is None:
+        return _send(function, return_format, event, headers)
+    path = _path(function, return_format)
+    if archive.mode == REPLAY:
+        response = _replayed(archive.get(path), _url(function, return_format))
+        if event is not None:
+            event.status = response.status_code
+        return response
+    response = _send(function, return_format, event)
+    archive.add(path, response.status_code, response.content, response.encoding)
+    return response
+
+
+def _send(function, return_format=None, event=None, headers=None):
+    """Send a GET for `function` to the API and return the response, with
+    its body not read yet.
+
+    Requests are paced by the rate limiter, if any, and retried according to
+    the retry policy. Retries and timings are recorded in `event`, if given.
+    """
+    url = _url(function, return_format)
+    retry = _retry
+    attempt = 0
+    while True:
+        limiter = _limiter
+        if limiter is not None:
+            limiter.acquire()
+        if event is not None:
+            event.retries = attempt
+            reset_connect_time()
+            sent = time.perf_counter()
+        try:
+            response = _get_session().get(url, headers=headers,
+                                          timeout=_timeout, stream=True)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt >= retry.max_retries:
+                raise
+            time.sleep(retry.delay(attempt))
+            attempt += 1
+            continue
+        if event is not None:
+            event.status = response.status_code
+            event.connect = connect_time()
+            event.ttfb = time.perf_counter() - sent - event.connect
+        delay = None
+        if (response.status_code in RETRY_STATUSES
+                and attempt < retry.max_retries):
+            delay = retry.delay(attempt,
+                                retry_after(response.headers.get('Retry-After')))
+        if delay is None:
+            if limiter is not None and response.status_code != 429:
+                limiter.succeeded()
+            return response
+        response.close()
+        if limiter is not None and response.status_code == 429:
+            limiter.throttled(delay)
+        time.sleep(delay)
+        attempt += 1
+
+
+def _body(response, return_format=None):
+    """Return the body of `response`: bytes for JSON to be decoded, text for
+    any explicit `return_format`."""
+    if return_format:
+        return response.text
+    return response.content
+
+
+def _decode(body, return_format=None):
+    """Decode a response body as returned by :func:`_body`."""
+    if return_format:
+        return body
+    return json.loads(body)
+
+
+def _fetch(function, return_format=None, event=None, stale=None):
+    """Request `function` from the API, bypassing the response cache.
+
+    Historical queries are served from and saved to the persistent store,
+    if one is configured.
+
+    :param stale: optional expired cache entry ``(value, validators)``; the
+                  request is then conditional, and on 304 Not Modified the
+                  cached value is returned as is.
+    :returns: the decoded value, the validators of the response if any, and
+              whether the value may be cached: only 200 OK responses (or
+              stored and revalidated ones) are, never error pages.
+    :raises Error: if JSON was asked for and the API did not answer 200 OK
+    """
+    store = _store
+    historical = store is not None and is_historical(function)
+    body = None
+    validators = None
+    cacheable = True
+    if historical:
+        body = store.get(function, return_format)
+        if event is not None:
+            event.store = 'miss' if body is None else 'hit'
+    if body is None:
+        response = _request(function, return_format, event,
+                            stale[1] if stale is not None else None)
+        if response.status_code == 304 and stale is not None:
+            response.close()
+            if event is not None:
+                event.cache = 'revalidated'
+            return (stale[0], conditional_headers(response.headers) or stale[1],
+                    True)
+        if not return_format:
+            _check_status(response, function)  # error pages are not JSON
+        cacheable = response.status_code == 200
+        if cacheable:
+            validators = conditional_headers(response.headers)
+        if event is not None:
+            started = time.perf_counter()
+        body = _body(response, return_format)
+        if event is not None:
+            event.download = time.perf_counter() - started
+            event.bytes = len(response.content)
+        if historical and cacheable:
+            store.set(function, return_format, body)
+    if event is None:
+        return _decode(body, return_format), validators, cacheable
+    started = time.perf_counter()
+    value = _decode(body, return_format)
+    event.decode = time.perf_counter() - started
+    return value, validators, cacheable
+
+
+def _decoded(return_format):
+    """Return True if `return_format` asks for decoded rather than raw data."""
+    return not return_format or return_format in _CONVERTERS
+
+
+def _get(function, return_format=None):
+    """Get and return data from the API, through the cache if enabled.
+
+    :returns: A str, list, or dict, depending on the input values and API data.
+    """
+    if return_format in _CONVERTERS:
+        return _CONVERTERS[return_format](endpoint(function), _get(function))
+    event = None
+    if _hooks:
+        event = RequestEvent(endpoint(function), function, return_format)
+    try:
+        return _get_through_cache(function, return_format, event)
+    except BaseException as e:
+        if event is not None:
+            event.error = e
+        raise
+    finally:
+        if event is not None:
+            _emit(event)
+
+
+def _get_through_cache(function, return_format, event):
+    cache = _cache
+    key = (function, return_format)
+    if _refresher is not None:
+        value = _refresher.get(key, _MISSING)
+        if value is not _MISSING:
+            if event is not None:
+                event.cache = 'hit'
+            return value
+    if cache is not None:
+        value = cache.get(key, _MISSING)
+        if event is not None:
+            event.cache = 'miss' if value is _MISSING else 'hit'
+        if value is not _MISSING:
+            return value
+
+    def fetch():
+        if event is not None:
+            event.coalesced = False
+        if cache is None:
+            return _fetch(function, return_format, event)[0]
+        value, validators, cacheable = _fetch(function, return_format, event,
+                                              cache.stale(key))
+        if cacheable:
+            cache.set(key, value, validators)
+        return value
+    if event is not None:
+        event.coalesced = True
+    return _coalesce(key, fetch)
+
+
+def _emit(event):
+    """Finish `event` and pass it to every hook."""
+    event.total = time.perf_counter() - event.started
+    for hook in list(_hooks):
+        hook(event)
+
+
+class _Call(object):
+    """An in-flight request that concurrent duplicates wait on."""
+
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+def _coalesce(key, fetch):
+    """Run `fetch()` once for all threads asking for `key` at the same time.
+
+    The first caller runs it; every concurrent duplicate waits and gets the
+    same result or exception.
+    """
+    with _inflight_lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _inflight[key] = _Call()
+    if not leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.value
+    try:
+        call.value = fetch()
+    except BaseException as e:
+        call.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        call.done.set()
+    return call.value
+
+
+def _iter_records(function, return_format=None, typed=False):
+    """Stream `function` from the API and return a generator of its records,
+    parsed incrementally from JSON or XML as they are read.
+
+    The response cache and persistent store are bypassed. For hooks, the
+    `download` phase covers reading and decoding the whole stream.
+
+    :param typed: yield typed records (see :mod:`dshield.records`) instead
+                  of dicts
+    :raises Error: while iterating, if the API did not answer 200 OK or
+                   answered with an error message
+    """
+    if return_format not in (None, JSON, XML):
+        raise ValueError("Records can only be streamed from JSON or XML, "
+                         "not {0!r}".format(return_format))
+    parse = iter_xml_records if return_format == XML else iter_json_records
+    convert = None
+    if typed:
+        convert = records.RECORD_TYPES[endpoint(function)].from_dict
+    return _streamed_records(function, return_format, parse, convert)
+
+
+def _streamed_records(function, return_format, parse, convert):
+    event = None
+    if _hooks:
+        event = RequestEvent(endpoint(function), function, return_format)
+    try:
+        response = _request(function, return_format, event)
+        _check_status(response, function)
+        started = time.perf_counter()
+        chunks = response.iter_content(CHUNK_SIZE)
+        if event is not None:
+            chunks = _counted(chunks, event)
+        try:
+            for record in parse(chunks):
+                error = _api_error(record)
+                if error is not None:
+                    raise Error(str(error))
+                if convert is not None and isinstance(record, dict):
+                    record = convert(record)
+                yield record
+        finally:
+            response.close()
+            if event is not None:
+                event.download = time.perf_counter() - started
+    except GeneratorExit:
+        raise  # the consumer stopped early, which is not a failure
+    except BaseException as e:
+        if event is not None:
+            event.error = e
+        raise
+    finally:
+        if event is not None:
+            _emit(event)
+
+
+def _download(function, return_format, sink):
+    """Stream the raw body of `function` in `return_format` into `sink` as
+    it is read from the network, without decoding it.
+
+    `sink` is a path, written through a temporary file next to it and
+    renamed once complete, or a binary file object with a `write` method.
+    The response cache and persistent store are bypassed.
+
+    :returns: the number of bytes written.
+    :raises Error: if the API did not answer 200 OK; nothing is written.
+    """
+    if return_format in _CONVERTERS:
+        raise ValueError("cannot download the {0} format, use an API format "
+                         "such as dshield.XML".format(return_format))
+    event = None
+    if _hooks:
+        event = RequestEvent(endpoint(function), function, return_format)
+    try:
+        response = _request(function, return_format, event)
+        _check_status(response, function)
+        started = time.perf_counter()
+        chunks = response.iter_content(CHUNK_SIZE)
+        if event is not None:
+            chunks = _counted(chunks, event)
+        try:
+            if not isinstance(sink, (str, os.PathLike)):
+                return _write(chunks, sink)
+            partial = '{0}.part'.format(os.fspath(sink))
+            try:
+                with open(partial, 'wb') as output:
+                    written = _write(chunks, output)
+                os.replace(partial, sink)
+            except BaseException:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+            return written
+        finally:
+            response.close()
+            if event is not None:
+                event.download = time.perf_counter() - started
+    except BaseException as e:
+        if event is not None:
+            event.error = e
+        raise
+    finally:
+        if event is not None:
+            _emit(event)
+
+
+def _check_status(response, function):
+    """Close `response` and raise :class:`Error` unless it is 200 OK."""
+    if response.status_code != 200:
+        response.close()
+        raise Error("Bad response, HTTP status {0} for {1}".format(
+            response.status_code, function))
+
+
+def _write(chunks, output):
+    written = 0
+    for chunk in chunks:
+        output.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def _counted(chunks, event):
+    """Pass `chunks` through, adding their sizes to `event.bytes`."""
+    event.bytes = 0
+    for chunk in chunks:
+        event.bytes += len(chunk)
+        yield chunk
+
+
+def _unique(items):
+    """Yield each item of `items` the first time it is seen."""
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+
+def _bounded_map(function, items, concurrency, ordered=False,
+                 errors=(Error, requests.RequestException)):
+    """Yield (item, result) pairs of `function(item)` run on a thread pool.
+
+    At most `concurrency` calls run at once and only a small window of `items`
+    is read ahead, so unbounded iterables are fine. Exceptions listed in
+    `errors` are yielded as the result instead of being raised.
+    """
+    def call(item):
+        try:
+            return function(item)
+        except errors as e:
+            return e
+
+    items = iter(items)
+    pending = collections.OrderedDict()
+    executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        for item in itertools.islice(items, concurrency * 2):
+            pending[executor.submit(call, item)] = item
+        while pending:
+            if ordered:
+                done = [next(iter(pending))]
+                done[0].result()
+            else:
+                done = futures.wait(pending,
+                                    return_when=futures.FIRST_COMPLETED)[0]
+            for future in done:
+                item = pending.pop(future)
+                for new in itertools.islice(items, 1):
+                    pending[executor.submit(call, new)] = new
+                yield item, future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _date(date):
+    """Return `date` as a 'Y-M-D' string; valid strings are passed through.
+
+    :raises Error: for strings not in 'Y-M-D' format.
+    """
+    try:
+        return date.strftime("%Y-%m-%d")
+    except AttributeError:
+        pass
+    try:
+        datetime.datetime.strptime(date, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise Error('Bad date, {date}'.format(date=date))
+    return date
+
+
+def _to_date(date):
+    """Return `date` (a string, date or datetime) as a datetime.date()."""
+    if isinstance(date, datetime.datetime):
+        return date.date()
+    if isinstance(date, datetime.date):
+        return date
+    return datetime.datetime.strptime(date, "%Y-%m-%d").date()
+
+
+def _windows(start_date, end_date):
+    """Split a date range into (start, end) windows the API accepts. A
+    missing `end_date` means today.
+
+    :returns: a list of windows, or None if the range needs no splitting,
+              has no start or cannot be parsed (the API is left to deal with
+              it then).
+    """
+    if not start_date:
+        return None
+    try:
+        start = _to_date(start_date)
+        end = _to_date(end_date) if end_date else datetime.date.today()
+    except (TypeError, ValueError):
+        return None
+    if (end - start).days < MAX_RANGE_DAYS:
+        return None
+    windows = []
+    while start <= end:
+        stop = min(start + datetime.timedelta(days=MAX_RANGE_DAYS - 1), end)
+        windows.append((start, stop))
+        start = stop + datetime.timedelta(days=1)
+    return windows
+
+
+def _merge_days(responses):
+    """Merge per-window responses of a date range into one response.
+
+    Each response is a list of records with a 'date' field, possibly wrapped
+    in a single-key dict. The result has the same shape, holds each day once
+    and is ordered by date. Responses of any other shape are skipped; API
+    errors must be raised before merging, see :func:`_check_window`.
+    """
+    key = None
+    days = collections.OrderedDict()
+    for response in responses:
+        rows = response
+        if isinstance(response, dict) and len(response) == 1:
+            name, rows = next(iter(response.items()))
+            if isinstance(rows, list):
+                key = name
+        if not isinstance(rows, list):
+            continue
+        for row in rows:
+            day = row.get('date') if isinstance(row, dict) else None
+            days.setdefault(day if day is not None else len(days), row)
+    rows = [days[day] for day in sorted(days, key=str)]
+    return {key: rows} if key is not None else rows
+
+
+def _get_range(uri, start_date, end_date, return_format, check=None):
+    """Get a date range, splitting long ranges into concurrent requests.
+
+    :param uri: a function of (start_date, end_date) returning the API URI
+    :param check: optional function applied to each response to raise errors
+    """
+    check = check or (lambda response: response)
+    windows = _windows(start_date, end_date) if _decoded(return_format) else None
+    if windows is None:
+        return check(_get(uri(start_date, end_date), return_format))
+    results = _bounded_map(lambda window: _check_window(check(_get(uri(*window)))),
+                           windows,
+                           min(_pool_size, len(windows)), ordered=True,
+                           errors=())
+    merged = _merge_days(response for _, response in results)
+    if return_format:
+        return _CONVERTERS[return_format](endpoint(uri(*windows[0])), merged)
+    return merged
+
+
+def _check_window(response):
+    """Return a decoded response for one window of a date range, raising
+    Error if it is an API error."""
+    error = _api_error(response)
+    if error is not None:
+        raise Error(str(error))
+    return response
+
+
+def _api_error(response):
+    """Return the error message of a decoded API error response, such as
+    ``{"error": "bad IP address"}`` or ``{"porthistory": {"error": ...}}``,
+    or None. Only the top level and a single wrapping key are looked at."""
+    if not isinstance(response, dict):
+        return None
+    if 'error' in response:
+        return response['error']
+    if len(response) == 1:
+        inner = next(iter(response.values()))
+        if isinstance(inner, dict) and 'error' in inner:
+            return inner['error']
+    return None
+
+
+# Raw responses holding one of the markers within this many characters from
+# the start are errors; real data is never that short.
+_ERROR_PREFIX = 256
+
+
+def _raise_for(response, marker, message):
+    """Raise Error if `response` is an API error; Error(message) if the
+    error mentions `marker`.
+
+    Decoded responses are checked through their 'error' field, and raw
+    (XML, TEXT, PHP) responses through their first few characters, so large
+    responses cost nothing to check.
+    """
+    if isinstance(response, str):
+        if marker in response[:_ERROR_PREFIX]:
+            raise Error(message)
+        return response
+    error = _api_error(response)
+    if error is not None:
+        raise Error(message if marker in str(error) else str(error))
+    return response
+
+
+# Local argument checks, run by the URI builders so that bad arguments raise
+# Error before any request is sent.
+
+_SORT_KEYS = {
+    'topports': ('records', 'targets', 'sources'),
+    'topips': ('records', 'attacks'),
+    'sources': ('ip', 'count', 'attacks', 'firstseen', 'lastseen'),
+}
+
+# Largest `limit` the API accepts, by function.
+_MAX_LIMITS = {
+    'sources': 10000,
+    'asnum': 2000,
+}
+
+
+def _check_ip(ip_address):
+    """Return `ip_address` as a string if it is an IPv4 or IPv6 address,
+    including the zero-padded IPv4 form ('010.001.002.003')."""
+    text = str(ip_address)
+    try:
+        ipaddress.ip_address(text)
+    except ValueError:
+        parts = text.split('.')
+        if not (len(parts) == 4 and all(_is_number(part) and len(part) <= 3
+                                         and int(part) < 256 for part in parts)):
+            raise Error('Bad IP address, {address}'.format(address=ip_address))
+    return text
+
+
+def _check_port(port_number):
+    """Return `port_number` as a string if it is a port from 0 to 65535."""
+    text = str(port_number)
+    if not _is_number(text) or int(text) > 65535:
+        raise Error('Bad port number, {number}'.format(number=port_number))
+    return text
+
+
+def _check_count(value, name, maximum=None):
+    """Return `value` as a string if it is a positive integer, and at most
+    `maximum` if given."""
+    text = str(value)
+    if not _is_number(text) or int(text) < 1:
+        raise Error('Bad {name}, {value}'.format(name=name, value=value))
+    if maximum is not None and int(text) > maximum:
+        raise Error('Bad {name}, {value}; at most {maximum}'.format(
+            name=name, value=value, maximum=maximum))
+    return text
+
+
+def _date_range(start_date=None, end_date=None):
+    """Return a date range as two datetime.date(), by default from 30 days
+    ago to today like :func:`porthistory`.
+
+    :raises Error: for bad dates, or a range that ends before it starts.
+    """
+    today = datetime.date.today()
+    start = (_to_date(_date(start_date)) if start_date
+             else today - datetime.timedelta(days=30))
+    end = _to_date(_date(end_date)) if end_date else today
+    _check_range(start, end)
+    return start, end
+
+
+def _check_range(start_date, end_date):
+    """Raise Error if a date range ends before it starts."""
+    if start_date and end_date and _to_date(_date(end_date)) < _to_date(
+            _date(start_date)):
+        raise Error('Bad date range, {start} to {end}'.format(
+            start=_date(start_date), end=_date(end_date)))
+
+
+def _is_number(text):
+    return text.isascii() and text.isdigit()
+
+
+# URI builders, shared by the blocking functions below and by dshield.aio.
+# They check their arguments first, see above.
+
+def _backscatter_uri(date=None, rows=None):
+    uri = 'backscatter'
+    if date:
+        uri = '/'.join([uri, _date(date)])
+        if rows:
+            uri = '/'.join([uri, _check_count(rows, 'rows')])
+    return uri
+
+def _ip_uri(ip_address):
+    return 'ip/{address}'.format(address=_check_ip(ip_address))
+
+def _port_uri(port_number):
+    return 'port/{number}'.format(number=_check_port(port_number))
+
+def _portdate_uri(port_number, date=None):
+    uri = 'portdate/{number}'.format(number=_check_port(port_number))
+    if date:
+        uri = '/'.join([uri, _date(date)])
+    return uri
+
+def _top_uri(function, sort_by, limit, date=None):
+    if sort_by not in _SORT_KEYS[function]:
+        raise Error('Bad sort_by for {function}, {sort_by}; expected one of '
+                    '{keys}'.format(function=function, sort_by=sort_by,
+                                    keys=', '.join(_SORT_KEYS[function])))
+    uri = '/'.join([function, sort_by,
+                    _check_count(limit, 'limit', _MAX_LIMITS.get(function))])
+    if date:
+        uri = '/'.join([uri, _date(date)])
+    return uri
+
+def _porthistory_uri(port_number, start_date=None, end_date=None):
+    uri = 'porthistory/{port}'.format(port=_check_port(port_number))
+    if not start_date:
+        # default 30 days ago
+        start_date = datetime.datetime.now() - datetime.timedelta(days=30)
+    _check_range(start_date, end_date)
+    uri = '/'.join([uri, _date(start_date)])
+    if end_date:
+        uri = '/'.join([uri, _date(end_date)])
+    return uri
+
+def _asnum_uri(number, limit=None):
+    uri = 'asnum/{number}'.format(number=_check_count(number, 'AS number'))
+    if limit:
+        uri = '/'.join([uri, _check_count(limit, 'limit', _MAX_LIMITS['asnum'])])
+    return uri
+
+def _dailysummary_uri(start_date=None, end_date=None):
+    uri = 'dailysummary'
+    if not start_date:
+        # default today
+        start_date = datetime.datetime.now()
+    _check_range(start_date, end_date)
+    uri = '/'.join([uri, _date(start_date)])
+    if end_date:
+        uri = '/'.join([uri, _date(end_date)])
+    return uri
+
+def _daily404summary_uri(date):
+    uri = 'daily404summary'
+    if date:
+        uri = '/'.join([uri, _date(date)])
+    return uri
+
+def _daily404detail_uri(date, limit=None):
+    uri = 'daily404detail'
+    if date:
+        uri = '/'.join([uri, _date(date)])
+        if limit:
+            uri = '/'.join([uri, _check_count(limit, 'limit')])
+    return uri
+
+def _glossary_uri(term=None):
+    uri = 'glossary'
+    if term:
+        uri = '/'.join([uri, term])
+    return uri
+
+def _webhoneypot_uri(function, date):
+    return '/'.join([function, _date(date)])
+
+
+def backscatter(date=None, rows=None, return_format=None):
+    """Returns possible backscatter data.
+
+    This report only includes "syn ack" data and is summarized by source port.
+
+    :param date: optional string (in Y-M-D format) or datetime.date() object
+    :param rows: optional number of rows returned (default 1000)
+    :returns: list -- backscatter data.
+    """
+    return _get(_backscatter_uri(date, rows), return_format)
+
+def handler(return_format=None):
+    """Returns the name of the handler of the day."""
+    return _get('handler', return_format)
+
+def infocon(return_format=None):
+    """Returns the current infocon level (green, yellow, orange, red)."""
+    return _get('infocon', return_format)
+
+def ip(ip_address, return_format=None):
+    """Returns a summary of the information our database holds for a
+    particular IP address (similar to /ipinfo.html).
+
+    In the returned data:
+
+    Count: (also reports or records) total number of packets blocked from
+    this IP.
+    Attacks: (also targets) number of unique destination IP addresses for
+    these packets.
+
+    :param ip_address: a valid IP address
+    """
+    response = _get(_ip_uri(ip_address), return_format)
+    return _raise_for(response, 'bad IP address',
+                      'Bad IP address, {address}'.format(address=ip_address))
+
+def ip_many(ip_addresses, concurrency=10, ordered=False, return_format=None):
+    """Look up many IP addresses concurrently, see :func:`ip`.
+
+    Duplicate addresses are only looked up once. Results are yielded as
+    ``(ip_address, result)`` tuples as each lookup completes, or in input order
+    if `ordered` is true. A failed lookup does not abort the batch; its
+    exception (usually :class:`Error`) is yielded as the result instead.
+
+    :param ip_addresses: an iterable of IP addresses
+    :param concurrency: maximum number of lookups in flight at once
+    :param ordered: yield results in input order rather than completion order
+    """
+    return _bounded_map(lambda address: ip(address, return_format),
+                        _unique(ip_addresses), concurrency, ordered)
+
+def port(port_number, return_format=None):
+    """Summary information about a particular port.
+
+    In the returned data:
+
+    Records: Total number of records for a given date.
+    Targets: Number of unique destination IP addresses.
+    Sources: Number of unique originating IPs.
+
+    :param port_number: a string or integer port number
+    """
+    response = _get(_port_uri(port_number), return_format)
+    return _raise_for(response, 'bad port number',
+                      'Bad port number, {number}'.format(number=port_number))
+
+def portdate(port_number, date=None, return_format=None):
+    """Information about a particular port at a particular date.
+
+    If the date is ommited, today's date is used.
+
+    :param port_number: a string or integer port number
+    :param date: an optional string in 'Y-M-D' format or datetime.date() object
+    """
+    response = _get(_portdate_uri(port_number, date), return_format)
+    return _raise_for(response, 'bad port number',
+                      'Bad port number, {number}'.format(number=port_number))
+
+def topports(sort_by='records', limit=10, date=None, return_format=None):
+    """Information about top ports for a particular date with return limit.
+
+    :param sort_by: one of 'records', 'targets', 'sources'
+    :param limit: number of records to be returned
+    :param date: an optional string in 'Y-M-D' format or datetime.date() object
+    """
+    return _get(_top_uri('topports', sort_by, limit, date), return_format)
+
+def topips(sort_by='records', limit=10, date=None, return_format=None):
+    """Information about top ports for a particular date with return limit.
+
+    :param sort_by: one of 'records', 'attacks'
+    :param limit: number of records to be returned
+    :param date: an optional string in 'Y-M-D' format or datetime.date() object
+    """
+    return _get(_top_uri('topips', sort_by, limit, date), return_format)
+
+def sources(sort_by='attacks', limit=10, date=None, return_format=None):
+    """Information summary from the last 30 days about source IPs with return
+    limit.
+
+    :param sort_by: one of 'ip', 'count', 'attacks', 'firstseen', 'lastseen'
+    :param limit: number of records to be returned (max 10000)
+    :param date: an optional string in 'Y-M-D' format or datetime.date() object
+    """
+    return _get(_top_uri('sources', sort_by, limit, date), return_format)
+
+def iter_sources(sort_by='attacks', limit=10, date=None, return_format=None,
+                 typed=False):
+    """Like :func:`sources`, but yields the records one at a time as they are
+    read from the network, keeping memory flat for large limits.
+
+    :param return_format: None (JSON) or dshield.XML; XML is parsed
+                          incrementally into the same record dicts
+    :param typed: yield typed records instead of dicts, as for
+                  ``return_format=dshield.TYPED``
+    """
+    return _iter_records(_top_uri('sources', sort_by, limit, date),
+                         return_format, typed)
+
+def download_sources(sink, sort_by='attacks', limit=10, date=None,
+                     return_format=XML):
+    """Like :func:`sources`, but streams the raw response into `sink` (a path
+    or binary file object) in chunks, keeping memory flat for large limits.
+
+    :returns: the number of bytes written.
+    """
+    return _download(_top_uri('sources', sort_by, limit, date), return_format,
+                     sink)
+
+def porthistory(port_number, start_date=None, end_date=None, return_format=None):
+    """Returns port data for a range of dates.
+
+    In the return data:
+
+    Records: Total number of records for a given date range.
+    Targets: Number of unique destination IP addresses.
+    Sources: Number of unique originating IPs.
+
+    Ranges longer than :data:`MAX_RANGE_DAYS` days, up to today if there is
+    no `end_date`, are split into several requests that are fetched
+    concurrently and merged into one date-ordered result (unless an API
+    `return_format` such as XML is given).
+
+    :param port_number: a valid port number (required)
+    :param start_date: string or datetime.date(), default is 30 days ago
+    :param end_date: string or datetime.date(), default is today
+    """
+    return _get_range(
+        lambda start, end: _porthistory_uri(port_number, start, end),
+        start_date, end_date, return_format,
+        lambda response: _raise_for(response, 'bad port number',
+                                    'Bad port, {port}'.format(port=port_number)))
+
+def asnum(number, limit=None, return_format=None):
+    """Returns a summary of the information our database holds for a
+    particular ASNUM (similar to /asdetailsascii.html) with return limit.
+
+    :param limit: number of records to be returned (max 2000)
+    """
+    return _get(_asnum_uri(number, limit), return_format)
+
+def iter_asnum(number, limit=None, return_format=None, typed=False):
+    """Like :func:`asnum`, but yields the records one at a time as they are
+    read from the network, keeping memory flat for large limits.
+
+    :param return_format: None (JSON) or dshield.XML; XML is parsed
+                          incrementally into the same record dicts
+    :param typed: yield typed records instead of dicts, as for
+                  ``return_format=dshield.TYPED``
+    """
+    return _iter_records(_asnum_uri(number, limit), return_format, typed)
+
+def download_asnum(sink, number, limit=None, return_format=XML):
+    """Like :func:`asnum`, but streams the raw response into `sink` (a path
+    or binary file object) in chunks, keeping memory flat for large limits.
+
+    :returns: the number of bytes written.
+    """
+    return _download(_asnum_uri(number, limit), return_format, sink)
+
+def dailysummary(start_date=None, end_date=None, return_format=None):
+    """Returns daily summary totals of targets, attacks and sources.
+    (Query 2002-01-01 to present)
+
+    The API is limited to 30 days at a time; longer ranges, up to today if
+    there is no `end_date`, are split into several requests that are fetched
+    concurrently and merged into one date-ordered result (unless an API
+    `return_format` such as XML is given).
+
+    In the return data:
+
+    Sources: Distinct source IP addresses the packets originate from.
+    Targets: Distinct target IP addresses the packets were sent to.
+    Reports: Number of packets reported.
+
+    :param start_date: string or datetime.date(), default is today
+    :param end_date: string or datetime.date(), default is today
+    """
+    return _get_range(_dailysummary_uri, start_date, end_date, return_format)
+
+def daily404summary(date, return_format=None):
+    """Returns daily summary information of submitted 404 Error Page
+    Information.
+
+    :param date: string or datetime.date() (required)
+    """
+    return _get(_daily404summary_uri(date), return_format)
+
+def daily404detail(date, limit=None, return_format=None):
+    """Returns detail information of submitted 404 Error Page Information.
+
+    :param date: string or datetime.date() (required)
+    :param limit: string or int, limit for number of returned items
+    """
+    return _get(_daily404detail_uri(date, limit), return_format)
+
+def iter_daily404detail(date, limit=None, return_format=None, typed=False):
+    """Like :func:`daily404detail`, but yields the records one at a time as
+    they are read from the network, keeping memory flat for large limits.
+
+    :param return_format: None (JSON) or dshield.XML; XML is parsed
+                          incrementally into the same record dicts
+    :param typed: yield typed records instead of dicts, as for
+                  ``return_format=dshield.TYPED``
+    """
+    return _iter_records(_daily404detail_uri(date, limit), return_format,
+                         typed)
+
+def download_daily404detail(sink, date, limit=None, return_format=XML):
+    """Like :func:`daily404detail`, but streams the raw response into `sink`
+    (a path or binary file object) in chunks, keeping memory flat for large
+    limits.
+
+    :returns: the number of bytes written.
+    """
+    return _download(_daily404detail_uri(date, limit), return_format, sink)
+
+def glossary(term=None, return_format=None):
+    """List of glossary terms and definitions.
+
+    :param term: a whole or parital word to "search" in the API
+    """
+    return _get(_glossary_uri(term), return_format)
+
+def webhoneypotsummary(date, return_format=None):
+    """API data for `Webhoneypot: Web Server Log Project
+    <https://dshield.org/webhoneypot/>`_.
+
+    :param date: string or datetime.date() (required)
+    """
+    return _get(_webhoneypot_uri('webhoneypotsummary', date), return_format)
+
+def webhoneypotbytype(date, return_format=None):
+    """API data for `Webhoneypot: Attack By Type
+    <https://isc.sans.edu/webhoneypot/types.html>`_. We currently use a set
+    of regular expressions to determine the type of attack used to attack the
+    honeypot. Output is the top 30 attacks for the last month.
+
+    :param date: string or datetime.date() (required)
+    """
+    return _get(_webhoneypot_uri('webhoneypotbytype', date), return_format)
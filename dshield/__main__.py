@@ -0,0 +1,5 @@
+import sys
+
+from dshield.cli import main
+
+sys.exit(main())
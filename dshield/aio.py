@@ -0,0 +1,413 @@
+"""An asyncio interface to the Internet Storm Center / DShield API.
+
+Every public function in :mod:`dshield` has an awaitable counterpart here
+with the same arguments, URIs, `return_format` handling and :class:`Error`
+semantics. Requests run over a pooled aiohttp session, so one event loop can
+keep many lookups in flight at once.
+
+This module requires `aiohttp <https://docs.aiohttp.org/>`_.
+"""
+
+import asyncio
+import contextlib
+import functools
+import itertools
+import time
+import weakref
+
+import aiohttp
+
+import dshield
+from dshield import Error, XML, JSON, TEXT, PHP
+from dshield.cache import conditional_headers
+from dshield.metrics import RequestEvent
+from dshield.ratelimit import RETRY_STATUSES, retry_after
+
+# Error and the return formats are re-exported for convenience.
+__all__ = [
+    'Error', 'XML', 'JSON', 'TEXT', 'PHP', 'configure_session',
+    'close_session', 'pooled_session', 'backscatter', 'handler', 'infocon',
+    'ip', 'ip_many', 'port', 'portdate', 'topports', 'topips', 'sources',
+    'porthistory', 'asnum', 'dailysummary', 'daily404summary',
+    'daily404detail', 'glossary', 'webhoneypotsummary', 'webhoneypotbytype'
+]
+
+_sessions = weakref.WeakKeyDictionary()
+_inflight = weakref.WeakKeyDictionary()
+_pool_size = dshield.DEFAULT_POOL_SIZE
+_timeout = dshield.DEFAULT_TIMEOUT
+
+
+def configure_session(pool_size=dshield.DEFAULT_POOL_SIZE,
+                      timeout=dshield.DEFAULT_TIMEOUT):
+    """Set the pool size and default timeout of sessions created from now on.
+
+    Each event loop gets its own pooled session, created on first use.
+
+    :param pool_size: maximum number of pooled connections kept open
+    :param timeout: default timeout in seconds for each request, or None
+    """
+    global _pool_size, _timeout
+    _pool_size = pool_size
+    _timeout = timeout
+
+
+async def close_session():
+    """Close the pooled session belonging to the running event loop."""
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+@contextlib.asynccontextmanager
+async def pooled_session():
+    """Close the pooled session of the running event loop when the block
+    exits, so that no connection is left open when the loop shuts down::
+
+        async with dshield.aio.pooled_session():
+            await dshield.aio.infocon()
+    """
+    try:
+        yield
+    finally:
+        await close_session()
+
+
+def _get_session():
+    """Return the pooled session for the running event loop."""
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=_pool_size),
+            timeout=aiohttp.ClientTimeout(total=_timeout))
+        _sessions[loop] = session
+    return session
+
+
+async def _request(function, return_format=None, event=None, headers=None):
+    """Send a GET for `function` to the API and return the response and its
+    body, paced and retried like :func:`dshield._request`.
+
+    Retries and timings are recorded in `event`, if given; aiohttp does not
+    report connect times, so `connect` stays None and is part of `ttfb`.
+    Responses are recorded to or replayed from the archive shared with
+    :mod:`dshield`, see :func:`dshield.configure_archive`.
+    """
+    archive = dshield.get_archive()
+    if archive is not None and archive.mode == dshield.REPLAY:
+        entry = archive.get(dshield._path(function, return_format))
+        if event is not None:
+            event.status = entry.status
+            event.bytes = len(entry.content)
+        return entry, entry.text if return_format else entry.content
+    if archive is not None:
+        headers = None  # record complete responses only
+    url = dshield._url(function, return_format)
+    retry = dshield._retry
+    attempt = 0
+    while True:
+        limiter = dshield._limiter
+        if limiter is not None:
+            wait = limiter.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        if event is not None:
+            event.retries = attempt
+            sent = time.perf_counter()
+        try:
+            async with _get_session().get(url, headers=headers) as response:
+                if event is not None:
+                    event.status = response.status
+                    event.ttfb = time.perf_counter() - sent
+                delay = None
+                if (response.status in RETRY_STATUSES
+                        and attempt < retry.max_retries):
+                    delay = retry.delay(
+                        attempt, retry_after(response.headers.get('Retry-After')))
+                if delay is None:
+                    started = time.perf_counter()
+                    raw = await response.read()
+                    if event is not None:
+                        event.download = time.perf_counter() - started
+                        event.bytes = len(raw)
+                    if archive is not None:
+                        archive.add(dshield._path(function, return_format),
+                                    response.status, raw, response.charset)
+                    if return_format:
+                        body = await response.text()
+                    else:
+                        body = raw
+                    if limiter is not None and response.status != 429:
+                        limiter.succeeded()
+                    return response, body
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt >= retry.max_retries:
+                raise
+            delay = retry.delay(attempt)
+        else:
+            if limiter is not None and response.status == 429:
+                limiter.throttled(delay)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def _fetch(function, return_format=None, event=None, stale=None):
+    """Request `function` from the API, bypassing the response cache.
+
+    Historical queries go through the persistent store shared with
+    :mod:`dshield`, see :func:`dshield.configure_store`. Expired cache
+    entries are revalidated like in :func:`dshield._fetch`.
+
+    :returns: the decoded value, the validators of the response if any, and
+              whether the value may be cached: only 200 OK responses (or
+              stored and revalidated ones) are, never error pages.
+    :raises Error: if JSON was asked for and the API did not answer 200 OK
+    """
+    store = dshield.get_store()
+    historical = store is not None and dshield.is_historical(function)
+    body = None
+    validators = None
+    cacheable = True
+    if historical:
+        body = store.get(function, return_format)
+        if event is not None:
+            event.store = 'miss' if body is None else 'hit'
+    if body is None:
+        response, body = await _request(function, return_format, event,
+                                        stale[1] if stale is not None else None)
+        if response.status == 304 and stale is not None:
+            if event is not None:
+                event.cache = 'revalidated'
+            return (stale[0], conditional_headers(response.headers) or stale[1],
+                    True)
+        if not return_format and response.status != 200:
+            # error pages are not JSON
+            raise Error("Bad response, HTTP status {0} for {1}".format(
+                response.status, function))
+        cacheable = response.status == 200
+        if cacheable:
+            validators = conditional_headers(response.headers)
+        if historical and cacheable:
+            store.set(function, return_format, body)
+    if event is None:
+        return dshield._decode(body, return_format), validators, cacheable
+    started = time.perf_counter()
+    value = dshield._decode(body, return_format)
+    event.decode = time.perf_counter() - started
+    return value, validators, cacheable
+
+
+async def _get(function, return_format=None):
+    """Get and return data from the API, through the cache if enabled.
+
+    The response cache is shared with :mod:`dshield`, see
+    :func:`dshield.configure_cache`.
+
+    :returns: A str, list, or dict, depending on the input values and API data.
+    """
+    if return_format in dshield._CONVERTERS:
+        return dshield._CONVERTERS[return_format](dshield.endpoint(function),
+                                                  await _get(function))
+    event = None
+    if dshield._hooks:
+        event = RequestEvent(dshield.endpoint(function), function, return_format)
+    try:
+        return await _get_through_cache(function, return_format, event)
+    except BaseException as e:
+        if event is not None:
+            event.error = e
+        raise
+    finally:
+        if event is not None:
+            dshield._emit(event)
+
+
+async def _get_through_cache(function, return_format, event):
+    cache = dshield.get_cache()
+    key = (function, return_format)
+    refresher = dshield.get_refresher()
+    if refresher is not None:
+        value = refresher.get(key, dshield._MISSING)
+        if value is not dshield._MISSING:
+            if event is not None:
+                event.cache = 'hit'
+            return value
+    if cache is not None:
+        value = cache.get(key, dshield._MISSING)
+        if event is not None:
+            event.cache = 'miss' if value is dshield._MISSING else 'hit'
+        if value is not dshield._MISSING:
+            return value
+
+    async def fetch():
+        if event is not None:
+            event.coalesced = False
+        if cache is None:
+            return (await _fetch(function, return_format, event))[0]
+        value, validators, cacheable = await _fetch(function, return_format,
+                                                    event, cache.stale(key))
+        if cacheable:
+            cache.set(key, value, validators)
+        return value
+    if event is not None:
+        event.coalesced = True
+    return await _coalesce(key, fetch)
+
+
+async def _coalesce(key, fetch):
+    """Await `fetch()` once for all tasks of this event loop asking for `key`
+    at the same time; duplicates get the same result or exception.
+
+    The fetch runs in a task of its own that every caller awaits through
+    :func:`asyncio.shield`, so cancelling one caller leaves the others
+    waiting.
+    """
+    inflight = _inflight.setdefault(asyncio.get_running_loop(), {})
+    task = inflight.get(key)
+    if task is None:
+        task = inflight[key] = asyncio.ensure_future(fetch())
+        task.add_done_callback(functools.partial(_fetched, inflight, key))
+    return await asyncio.shield(task)
+
+
+def _fetched(inflight, key, task):
+    if inflight.get(key) is task:
+        del inflight[key]
+    if not task.cancelled():
+        task.exception()  # nobody may be waiting; mark it retrieved
+
+
+async def _get_range(uri, start_date, end_date, return_format, check=None):
+    """Asynchronous :func:`dshield._get_range`: long date ranges are split
+    into windows that are fetched concurrently and merged."""
+    check = check or (lambda response: response)
+    windows = None
+    if dshield._decoded(return_format):
+        windows = dshield._windows(start_date, end_date)
+    if windows is None:
+        return check(await _get(uri(start_date, end_date), return_format))
+    responses = await asyncio.gather(*[_get(uri(*window)) for window in windows])
+    merged = dshield._merge_days([dshield._check_window(check(response))
+                                  for response in responses])
+    if return_format:
+        return dshield._CONVERTERS[return_format](
+            dshield.endpoint(uri(*windows[0])), merged)
+    return merged
+
+
+async def backscatter(date=None, rows=None, return_format=None):
+    """Awaitable :func:`dshield.backscatter`."""
+    return await _get(dshield._backscatter_uri(date, rows), return_format)
+
+async def handler(return_format=None):
+    """Awaitable :func:`dshield.handler`."""
+    return await _get('handler', return_format)
+
+async def infocon(return_format=None):
+    """Awaitable :func:`dshield.infocon`."""
+    return await _get('infocon', return_format)
+
+async def ip(ip_address, return_format=None):
+    """Awaitable :func:`dshield.ip`."""
+    response = await _get(dshield._ip_uri(ip_address), return_format)
+    return dshield._raise_for(response, 'bad IP address',
+                              'Bad IP address, {address}'.format(address=ip_address))
+
+async def ip_many(ip_addresses, concurrency=10, ordered=False,
+                  return_format=None):
+    """Asynchronous generator version of :func:`dshield.ip_many`."""
+    async def lookup(address):
+        try:
+            return await ip(address, return_format)
+        except (Error, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return e
+
+    addresses = dshield._unique(ip_addresses)
+    pending = {}
+    try:
+        for address in itertools.islice(addresses, concurrency):
+            pending[asyncio.ensure_future(lookup(address))] = address
+        while pending:
+            if ordered:
+                done = [next(iter(pending))]
+                await asyncio.wait(done)
+            else:
+                done = (await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED))[0]
+            for task in done:
+                address = pending.pop(task)
+                for new in itertools.islice(addresses, 1):
+                    pending[asyncio.ensure_future(lookup(new))] = new
+                yield address, task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def port(port_number, return_format=None):
+    """Awaitable :func:`dshield.port`."""
+    response = await _get(dshield._port_uri(port_number), return_format)
+    return dshield._raise_for(response, 'bad port number',
+                              'Bad port number, {number}'.format(number=port_number))
+
+async def portdate(port_number, date=None, return_format=None):
+    """Awaitable :func:`dshield.portdate`."""
+    response = await _get(dshield._portdate_uri(port_number, date), return_format)
+    return dshield._raise_for(response, 'bad port number',
+                              'Bad port number, {number}'.format(number=port_number))
+
+async def topports(sort_by='records', limit=10, date=None, return_format=None):
+    """Awaitable :func:`dshield.topports`."""
+    return await _get(dshield._top_uri('topports', sort_by, limit, date),
+                      return_format)
+
+async def topips(sort_by='records', limit=10, date=None, return_format=None):
+    """Awaitable :func:`dshield.topips`."""
+    return await _get(dshield._top_uri('topips', sort_by, limit, date),
+                      return_format)
+
+async def sources(sort_by='attacks', limit=10, date=None, return_format=None):
+    """Awaitable :func:`dshield.sources`."""
+    return await _get(dshield._top_uri('sources', sort_by, limit, date),
+                      return_format)
+
+async def porthistory(port_number, start_date=None, end_date=None,
+                      return_format=None):
+    """Awaitable :func:`dshield.porthistory`."""
+    return await _get_range(
+        lambda start, end: dshield._porthistory_uri(port_number, start, end),
+        start_date, end_date, return_format,
+        lambda response: dshield._raise_for(
+            response, 'bad port number',
+            'Bad port, {port}'.format(port=port_number)))
+
+async def asnum(number, limit=None, return_format=None):
+    """Awaitable :func:`dshield.asnum`."""
+    return await _get(dshield._asnum_uri(number, limit), return_format)
+
+async def dailysummary(start_date=None, end_date=None, return_format=None):
+    """Awaitable :func:`dshield.dailysummary`."""
+    return await _get_range(dshield._dailysummary_uri, start_date, end_date,
+                            return_format)
+
+async def daily404summary(date, return_format=None):
+    """Awaitable :func:`dshield.daily404summary`."""
+    return await _get(dshield._daily404summary_uri(date), return_format)
+
+async def daily404detail(date, limit=None, return_format=None):
+    """Awaitable :func:`dshield.daily404detail`."""
+    return await _get(dshield._daily404detail_uri(date, limit), return_format)
+
+async def glossary(term=None, return_format=None):
+    """Awaitable :func:`dshield.glossary`."""
+    return await _get(dshield._glossary_uri(term), return_format)
+
+async def webhoneypotsummary(date, return_format=None):
+    """Awaitable :func:`dshield.webhoneypotsummary`."""
+    return await _get(dshield._webhoneypot_uri('webhoneypotsummary', date),
+                      return_format)
+
+async def webhoneypotbytype(date, return_format=None):
+    """Awaitable :func:`dshield.webhoneypotbytype`."""
+    return await _get(dshield._webhoneypot_uri('webhoneypotbytype', date),
+                      return_format)
@@ -0,0 +1,469 @@
+"""Response caches for the DShield API."""
+
+import collections
+import datetime
+import json
+import os
+import re
+import threading
+import time
+
+DEFAULT_MAXSIZE = 1024
+DEFAULT_TTL = 300
+
+# Seconds each endpoint stays fresh. Queries pinned to past dates never
+# change and are cached without expiry regardless of these values.
+DEFAULT_TTLS = {
+    'infocon': 300,
+    'handler': 3600,
+    'glossary': 86400,
+    'ip': 3600,
+    'port': 3600,
+    'portdate': 3600,
+    'asnum': 3600,
+}
+
+# Endpoints whose URI holds a start and an optional end date; with no end
+# date the range runs up to today.
+_RANGE_ENDPOINTS = ('porthistory', 'dailysummary')
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+CacheInfo = collections.namedtuple('CacheInfo',
+                                   'hits misses evictions size maxsize')
+
+
+def endpoint(function):
+    """Return the endpoint name of an API URI, e.g. 'ip' for 'ip/1.2.3.4'."""
+    return function.split('/', 1)[0]
+
+
+def is_historical(function, today=None):
+    """Return True if the API URI `function` is pinned to past dates only.
+
+    The responses for such URIs never change. To allow for late submissions
+    and time zones, yesterday (UTC) does not count as past yet.
+
+    :param function: an API URI, e.g. 'backscatter/2011-12-01'
+    :param today: optional datetime.date() to compare against
+    """
+    parts = function.split('/')
+    dates = []
+    for part in parts[1:]:
+        if _DATE.match(part):
+            try:
+                dates.append(datetime.datetime.strptime(part, "%Y-%m-%d").date())
+            except ValueError:
+                return False
+    if not dates:
+        return False
+    if parts[0] in _RANGE_ENDPOINTS and len(dates) < 2:
+        return False
+    if today is None:
+        today = datetime.datetime.utcnow().date()
+    return max(dates) < today - datetime.timedelta(days=1)
+
+
+def conditional_headers(headers):
+    """Return the request headers revalidating a response, built from its
+    ETag and Last-Modified `headers`, or None if it has neither."""
+    conditions = {}
+    if headers.get('ETag'):
+        conditions['If-None-Match'] = headers['ETag']
+    if headers.get('Last-Modified'):
+        conditions['If-Modified-Since'] = headers['Last-Modified']
+    return conditions or None
+
+
+class MemoryCache(object):
+    """A thread-safe in-memory LRU cache with per-endpoint TTLs.
+
+    Keys are ``(function, return_format)`` tuples, where `function` is the API
+    URI such as 'ip/1.2.3.4'. Cached values are shared between callers and
+    should be treated as read-only.
+
+    Expired entries stored with validators (see :func:`conditional_headers`)
+    are kept until evicted, so that they can be revalidated with the server
+    instead of downloaded again.
+
+    :param maxsize: maximum number of entries before the least recently used
+                    one is evicted
+    :param ttls: optional dict of endpoint name to TTL in seconds, overriding
+                 :data:`DEFAULT_TTLS`
+    :param default_ttl: TTL in seconds for endpoints not listed in `ttls`
+    """
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttls=None,
+                 default_ttl=DEFAULT_TTL):
+        self.maxsize = maxsize
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def ttl(self, function):
+        """Return the TTL in seconds for `function`, or None for no expiry."""
+        if is_historical(function):
+            return None
+        return self.ttls.get(endpoint(function), self.default_ttl)
+
+    def get(self, key, default=None):
+        """Return the fresh value cached for `key`, or `default`."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.time()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None and entry[2] is None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def stale(self, key):
+        """Return ``(value, validators)`` for an entry kept for revalidation,
+        or None."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[2] is None:
+                return None
+            return entry[1], entry[2]
+
+    def set(self, key, value, validators=None):
+        """Cache `value` under `key` for the TTL of its endpoint.
+
+        :param validators: optional headers revalidating `value` once it
+                           expires, see :func:`conditional_headers`
+        """
+        ttl = self.ttl(key[0])
+        if ttl is not None and ttl <= 0:
+            return
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._data[key] = (expires, value, validators)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, function, return_format=None):
+        """Drop the entry for one API URI and return format, if cached."""
+        with self._lock:
+            self._data.pop((function, return_format), None)
+
+    def clear(self):
+        """Drop every cached entry. Counters are left untouched."""
+        with self._lock:
+            self._data.clear()
+
+    def info(self):
+        """Return a :class:`CacheInfo` with the hit/miss/eviction counters."""
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             len(self._data), self.maxsize)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _Database(object):
+    """A SQLite file at `path` opened once per process: a forked child
+    reopens it on first use, since the parent's connection must not be
+    used by the child. Subclasses create their tables in :meth:`_setup`."""
+
+    # Seconds between recording reads of one entry, so that most reads do
+    # not write to the file.
+    touch_interval = 60
+
+    def _connect(self):
+        import sqlite3  # only loaded by processes that use a SQLite file
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=30,
+                                   check_same_thread=False, isolation_level=None)
+        self._setup(self._db)
+        self._pid = os.getpid()
+
+    def _setup(self, db):
+        raise NotImplementedError
+
+    def _connection(self):
+        """Return the connection of this process, reopening it after a
+        fork."""
+        if self._pid != os.getpid():
+            self._connect()
+        return self._db
+
+    def close(self):
+        """Close the connection of this process."""
+        with self._lock:
+            self._db.close()
+
+
+class SharedCache(_Database, MemoryCache):
+    """A response cache shared by every process on one host, in a SQLite
+    file in WAL mode.
+
+    It behaves like :class:`MemoryCache`, with the same keys and TTLs, but
+    entries are stored as JSON in the file, so a response fetched by one
+    worker process is served to all of them. Readers never block writers.
+    Each process opens its own connection, and a forked child reopens it on
+    first use, so a cache configured before forking is safe to use in the
+    workers. Hit and miss counters are kept per process.
+
+    :param path: path of the SQLite database file
+    :param maxsize: maximum number of entries before the least recently used
+                    ones are evicted
+    :param ttls: optional dict of endpoint name to TTL in seconds, overriding
+                 :data:`DEFAULT_TTLS`
+    :param default_ttl: TTL in seconds for endpoints not listed in `ttls`
+    """
+
+    def __init__(self, path, maxsize=DEFAULT_MAXSIZE, ttls=None,
+                 default_ttl=DEFAULT_TTL):
+        MemoryCache.__init__(self, maxsize, ttls, default_ttl)
+        self.path = path
+        self._pid = None
+        self._db = None
+        self._connect()
+
+    def _setup(self, db):
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                        uri TEXT NOT NULL,
+                        format TEXT NOT NULL,
+                        value TEXT NOT NULL,
+                        validators TEXT,
+                        expires REAL,
+                        accessed REAL NOT NULL,
+                        PRIMARY KEY (uri, format))""")
+        db.execute("CREATE INDEX IF NOT EXISTS entries_accessed "
+                   "ON entries (accessed)")
+
+    def get(self, key, default=None):
+        """Return the fresh value cached for `key`, or `default`."""
+        function, return_format = key
+        db = self._connection()
+        now = time.time()
+        with self._lock:
+            row = db.execute(
+                "SELECT value, expires, accessed FROM entries "
+                "WHERE uri = ? AND format = ?",
+                (function, return_format or '')).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                self.misses += 1
+                return default
+            if now - row[2] > self.touch_interval:
+                db.execute("UPDATE entries SET accessed = ? "
+                           "WHERE uri = ? AND format = ?",
+                           (now, function, return_format or ''))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def stale(self, key):
+        """Return ``(value, validators)`` for an entry kept for revalidation,
+        or None."""
+        function, return_format = key
+        db = self._connection()
+        with self._lock:
+            row = db.execute(
+                "SELECT value, validators FROM entries "
+                "WHERE uri = ? AND format = ? AND validators IS NOT NULL",
+                (function, return_format or '')).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def set(self, key, value, validators=None):
+        """Cache `value` under `key` for the TTL of its endpoint, evicting
+        the least recently used entries beyond `maxsize`.
+
+        :param validators: optional headers revalidating `value` once it
+                           expires, see :func:`conditional_headers`
+        """
+        function, return_format = key
+        ttl = self.ttl(function)
+        if ttl is not None and ttl <= 0:
+            return
+        now = time.time()
+        row = (function, return_format or '', json.dumps(value),
+               None if validators is None else json.dumps(validators),
+               None if ttl is None else now + ttl, now)
+        db = self._connection()
+        with self._lock:
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                       row)
+            excess = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0] \
+                - self.maxsize
+            if excess > 0:
+                # Expired entries that cannot be revalidated go first.
+                db.execute(
+                    "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM "
+                    "entries ORDER BY (expires <= ? AND validators IS NULL) "
+                    "DESC, accessed LIMIT ?)", (now, excess))
+                self.evictions += excess
+
+    def invalidate(self, function, return_format=None):
+        """Drop the entry for one API URI and return format, if cached."""
+        db = self._connection()
+        with self._lock:
+            db.execute("DELETE FROM entries WHERE uri = ? AND format = ?",
+                       (function, return_format or ''))
+
+    def clear(self):
+        """Drop every cached entry, for all processes. Counters are left
+        untouched."""
+        db = self._connection()
+        with self._lock:
+            db.execute("DELETE FROM entries")
+
+    def info(self):
+        """Return a :class:`CacheInfo` with the counters of this process and
+        the number of entries shared by all."""
+        return CacheInfo(self.hits, self.misses, self.evictions, len(self),
+                         self.maxsize)
+
+    def __len__(self):
+        db = self._connection()
+        with self._lock:
+            return db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+
+class DiskStore(_Database):
+    """A persistent store of raw API responses in a single SQLite file.
+
+    Only meant for queries whose answer never changes, see
+    :func:`is_historical`. The file can be shared by several processes;
+    like :class:`SharedCache`, a store configured before forking reopens
+    the file in each child. The total size is kept up to date on every
+    write, so the size cap is enforced without scanning the file.
+
+    :param path: path of the SQLite database file
+    :param max_bytes: optional cap on the total size of stored responses;
+                      the least recently used ones are pruned beyond it
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._pid = None
+        self._db = None
+        self._connect()
+
+    def _setup(self, db):
+        db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                        uri TEXT NOT NULL,
+                        format TEXT NOT NULL,
+                        body BLOB NOT NULL,
+                        size INTEGER NOT NULL,
+                        accessed REAL NOT NULL,
+                        PRIMARY KEY (uri, format))""")
+        db.execute("CREATE INDEX IF NOT EXISTS responses_accessed "
+                   "ON responses (accessed)")
+        db.execute("CREATE TABLE IF NOT EXISTS total (size INTEGER NOT NULL)")
+        # Stores written before the total was kept are summed up once.
+        db.execute("INSERT INTO total SELECT COALESCE(SUM(size), 0) FROM "
+                   "responses WHERE NOT EXISTS (SELECT 1 FROM total)")
+
+    def get(self, function, return_format):
+        """Return the stored response body, or None if it is not stored."""
+        return_format = return_format or ''
+        db = self._connection()
+        now = time.time()
+        with self._lock:
+            row = db.execute(
+                "SELECT body, accessed FROM responses WHERE uri = ? AND format = ?",
+                (function, return_format)).fetchone()
+            if row is not None and now - row[1] > self.touch_interval:
+                db.execute(
+                    "UPDATE responses SET accessed = ? WHERE uri = ? AND format = ?",
+                    (now, function, return_format))
+        return None if row is None else row[0]
+
+    def set(self, function, return_format, body):
+        """Store a response body (str or bytes), pruning if the size cap is
+        exceeded."""
+        return_format = return_format or ''
+        db = self._connection()
+        with self._lock:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute(
+                    "SELECT size FROM responses WHERE uri = ? AND format = ?",
+                    (function, return_format)).fetchone()
+                db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (function, return_format, body, len(body), time.time()))
+                db.execute("UPDATE total SET size = size + ?",
+                           (len(body) - (row[0] if row else 0),))
+                total = db.execute("SELECT size FROM total").fetchone()[0]
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        if self.max_bytes is not None and total > self.max_bytes:
+            self.prune()
+
+    def size(self):
+        """Return the total size of the stored responses."""
+        db = self._connection()
+        with self._lock:
+            return db.execute("SELECT size FROM total").fetchone()[0]
+
+    def prune(self, max_bytes=None):
+        """Drop least recently used responses until the total size is at most
+        `max_bytes` (default: the store's own cap).
+
+        :returns: the number of responses removed.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_bytes is None:
+            return 0
+        db = self._connection()
+        with self._lock:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                total = db.execute("SELECT size FROM total").fetchone()[0]
+                doomed = []
+                freed = 0
+                if total > max_bytes:
+                    rows = db.execute(
+                        "SELECT uri, format, size FROM responses ORDER BY accessed")
+                    for uri, return_format, size in rows:
+                        if total - freed <= max_bytes:
+                            break
+                        doomed.append((uri, return_format))
+                        freed += size
+                    rows.close()
+                    db.executemany(
+                        "DELETE FROM responses WHERE uri = ? AND format = ?", doomed)
+                    db.execute("UPDATE total SET size = size - ?", (freed,))
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        return len(doomed)
+
+    def vacuum(self):
+        """Reclaim the disk space left behind by pruned responses."""
+        db = self._connection()
+        with self._lock:
+            db.execute("VACUUM")
+
+    def clear(self):
+        """Drop every stored response."""
+        db = self._connection()
+        with self._lock:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("DELETE FROM responses")
+            db.execute("UPDATE total SET size = 0")
+            db.execute("COMMIT")
+
+    def __len__(self):
+        db = self._connection()
+        with self._lock:
+            return db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
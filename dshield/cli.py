@@ -0,0 +1,293 @@
+"""The ``dshield`` command: run API queries from the shell.
+
+A single query names a function and its arguments, positionally or as
+``name=value``::
+
+    $ dshield topports records 10 2012-05-01
+    $ dshield porthistory 22 start_date=2012-05-01 --format csv
+
+A manifest (JSON, or YAML with PyYAML installed) lists many queries, each
+with fixed `args` and optional `expand` lists that are multiplied out into
+one query per combination::
+
+    concurrency: 8
+    queries:
+      - function: topports
+        args: {sort_by: records, limit: 10}
+        expand: {date: [2012-05-01, 2012-05-02]}
+      - function: asnum
+        expand: {number: [4837, 7922]}
+
+and runs them concurrently over one pooled session and response cache::
+
+    $ dshield run manifest.yaml --format jsonl -o results.jsonl
+"""
+
+import argparse
+import collections
+import csv
+import datetime
+import itertools
+import json
+import sys
+
+import dshield
+from dshield.records import Columns, Record, rows as table_rows
+
+FUNCTIONS = ('backscatter', 'handler', 'infocon', 'ip', 'port', 'portdate',
+             'topports', 'topips', 'sources', 'porthistory', 'asnum',
+             'dailysummary', 'daily404summary', 'daily404detail', 'glossary',
+             'webhoneypotsummary', 'webhoneypotbytype')
+FORMATS = ('json', 'jsonl', 'csv')
+DEFAULT_CONCURRENCY = 8
+
+
+class ManifestError(ValueError):
+    """Raised for a manifest that cannot be run."""
+
+
+def _query(function, args=None):
+    if function not in FUNCTIONS:
+        raise ManifestError("unknown function {0!r}, expected one of: {1}".format(
+            function, ', '.join(FUNCTIONS)))
+    return {'function': function,
+            'args': dict((name, _plain(value))
+                         for name, value in (args or {}).items())}
+
+
+def _plain(value):
+    """Return YAML dates as 'Y-M-D' strings, so queries stay JSON-ready."""
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def parse_arguments(function, arguments):
+    """Return the query for a function name and its command-line arguments,
+    positional or ``name=value``."""
+    query = _query(function)
+    positional = []
+    for argument in arguments:
+        name, sep, value = argument.partition('=')
+        if sep and name.isidentifier():
+            query['args'][name] = value
+        else:
+            positional.append(argument)
+    query['positional'] = positional
+    return query
+
+
+def load_manifest(path):
+    """Read a JSON or YAML manifest and return ``(queries, concurrency)``,
+    with every `expand` list multiplied out."""
+    with open(path) as manifest_file:
+        text = manifest_file.read()
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ManifestError("reading YAML manifests requires PyYAML "
+                                "(pip install dshield[yaml])")
+        manifest = yaml.safe_load(text)
+    else:
+        manifest = json.loads(text)
+    if isinstance(manifest, list):
+        manifest = {'queries': manifest}
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('queries'), list):
+        raise ManifestError("{0}: expected a list of queries".format(path))
+    queries = []
+    for entry in manifest['queries']:
+        if not isinstance(entry, dict) or 'function' not in entry:
+            raise ManifestError("{0}: each query needs a 'function'".format(path))
+        queries.extend(_expand(entry))
+    return queries, manifest.get('concurrency', DEFAULT_CONCURRENCY)
+
+
+def _expand(entry):
+    expand = entry.get('expand') or {}
+    names = sorted(expand)
+    for values in itertools.product(*[_listed(expand[name]) for name in names]):
+        query = _query(entry['function'], entry.get('args'))
+        query['args'].update(zip(names, map(_plain, values)))
+        if entry.get('return_format'):
+            query['args']['return_format'] = entry['return_format']
+        yield query
+
+
+def _listed(value):
+    return value if isinstance(value, list) else [value]
+
+
+_RETURN_FORMATS = {'xml': '?xml', 'json': '?json', 'text': '?text', 'php': '?php'}
+
+
+def run_query(query):
+    """Call the dshield function of `query` and return its result.
+
+    :raises dshield.Error: for any failure of the call, so that one query
+                           never ends a run
+    """
+    args = dict(query['args'])
+    if args.get('return_format') is not None:
+        args['return_format'] = _RETURN_FORMATS.get(
+            str(args['return_format']).lower(), args['return_format'])
+    try:
+        return getattr(dshield, query['function'])(*query.get('positional', ()),
+                                                    **args)
+    except dshield.Error:
+        raise
+    except Exception as e:
+        raise dshield.Error("{0}: {1}".format(query['function'], e))
+
+
+def _flatten(value, prefix=''):
+    """Flatten nested dicts into one dict with dotted keys."""
+    flat = {}
+    for key, item in value.items():
+        key = '{0}{1}'.format(prefix, key)
+        if isinstance(item, dict):
+            flat.update(_flatten(item, key + '.'))
+        else:
+            flat[key] = item
+    return flat
+
+
+def _plain_value(value):
+    """Return typed records, columns and dates as plain JSON values."""
+    if isinstance(value, Record):
+        return collections.OrderedDict((name, _plain_value(item))
+                                       for name, item in value._asdict().items())
+    if isinstance(value, Columns):
+        return collections.OrderedDict((name, _column(value, name))
+                                       for name in value)
+    if isinstance(value, (list, tuple)):
+        return [_plain_value(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _plain_value(item)) for key, item in value.items())
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def _column(columns, name):
+    if columns.kinds[name] == 'date':
+        return [_plain_value(day) for day in columns.dates(name)]
+    if columns.kinds[name] == 'int':
+        return [None if number == dshield.records.MISSING else number
+                for number in columns[name]]
+    return list(columns[name])
+
+
+def rows(query, result, labelled=True):
+    """Yield flat row dicts for the result (or exception) of `query`,
+    labelled with the function and its arguments."""
+    label = {}
+    if labelled:
+        label['function'] = query['function']
+        label.update(query['args'])
+    if isinstance(result, Exception):
+        yield dict(label, error=str(result))
+        return
+    if isinstance(result, Columns):
+        names = list(result)
+        result = [dict(zip(names, values)) for values in
+                  zip(*[_column(result, name) for name in names])]
+    table = table_rows(_plain_value(result))
+    for row in table if table is not None else [result]:
+        if isinstance(row, dict):
+            yield dict(label, **_flatten(row))
+        else:
+            yield dict(label, result=row)
+
+
+def write(results, output, output_format, single=False):
+    """Write ``(query, result)`` pairs to `output` as json, jsonl or csv.
+
+    :returns: the number of failed queries.
+    """
+    failures = 0
+    if output_format == 'json':
+        if single:
+            query, result = next(iter(results))
+            json.dump(_plain_value(result), output, indent=2)
+            output.write('\n')
+            return 0
+        output.write('[')
+        for number, (query, result) in enumerate(results):
+            item = {'query': query}
+            if isinstance(result, Exception):
+                item['error'] = str(result)
+                failures += 1
+            else:
+                item['result'] = _plain_value(result)
+            output.write('{0}\n  {1}'.format(',' if number else '',
+                                             json.dumps(item)))
+        output.write('\n]\n')
+        return failures
+    collected = []
+    for query, result in results:
+        failures += isinstance(result, Exception)
+        for row in rows(query, result, labelled=not single):
+            if output_format == 'jsonl':
+                output.write(json.dumps(row) + '\n')
+            else:
+                collected.append(row)
+    if output_format == 'csv':
+        fields = []
+        for row in collected:
+            fields.extend(key for key in row if key not in fields)
+        writer = csv.DictWriter(output, fields, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(collected)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='dshield', description='Query the DShield API.',
+        epilog='Run "dshield run MANIFEST" to run a manifest of queries.')
+    parser.add_argument('function', metavar='function',
+                        help='an API function, e.g. ip or topports, or "run"')
+    parser.add_argument('arguments', nargs='*',
+                        help='function arguments, positional or name=value; '
+                             'for "run", the manifest file')
+    parser.add_argument('-f', '--format', choices=FORMATS, default='json',
+                        help='output format (default: json)')
+    parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    parser.add_argument('-c', '--concurrency', type=int,
+                        help='queries run at once from a manifest')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.function == 'run':
+            if len(args.arguments) != 1:
+                parser.error('run takes exactly one manifest file')
+            queries, concurrency = load_manifest(args.arguments[0])
+            concurrency = int(args.concurrency or concurrency)
+        else:
+            queries = [parse_arguments(args.function, args.arguments)]
+            concurrency = 1
+    except (OSError, ValueError) as e:
+        parser.exit(2, 'dshield: {0}\n'.format(e))
+
+    dshield.configure_session(pool_size=concurrency)
+    if dshield.get_cache() is None:
+        dshield.configure_cache()
+    results = dshield._bounded_map(run_query, queries, concurrency,
+                                   ordered=True)
+    single = args.function != 'run'
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if single:
+            query, result = next(results)
+            if isinstance(result, Exception):
+                sys.stderr.write('dshield: {0}\n'.format(result))
+                return 1
+            results = [(query, result)]
+        failures = write(results, output, args.format, single)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+"""Enrich log lines with DShield data about the IP addresses they contain.
+
+:func:`enrich` is a generator pipeline: it extracts IPv4 and IPv6 addresses
+from each line, looks each distinct address up once within a sliding
+window, with a bounded number of lookups in flight, and yields the lines in
+input order with the results attached. Memory stays bounded however long
+the input is. It is also installed as the ``dshield-enrich`` command::
+
+    $ tail -f /var/log/firewall.log | dshield-enrich > enriched.jsonl
+"""
+
+import argparse
+import collections
+import datetime
+import fileinput
+import ipaddress
+import json
+import re
+import sys
+from concurrent import futures
+
+import dshield
+from dshield.records import Record
+
+DEFAULT_CONCURRENCY = 10
+DEFAULT_WINDOW = 100000
+DEFAULT_LOOKAHEAD = 1000
+
+_IPV4 = re.compile(r'(?<![\d.])(?:\d{1,3}\.){3}\d{1,3}(?!\.?\d)')
+# An IPv6 address may end in a dotted IPv4 address, as in '::ffff:192.0.2.7'.
+_IPV6 = re.compile(r'(?<![\w:.])[0-9A-Fa-f]{0,4}(?::[0-9A-Fa-f]{0,4}){2,7}'
+                   r'(?:(?<=:)(?:\d{1,3}\.){3}\d{1,3})?(?![\w:]|\.\d)')
+
+
+def extract(line):
+    """Return the distinct IPv4 and IPv6 addresses in `line`, normalised
+    and in order of appearance. IPv4-mapped IPv6 addresses, such as
+    '::ffff:192.0.2.7', are given as the IPv4 address."""
+    matches = sorted((match.start(), -match.end(), match.group())
+                     for pattern in (_IPV4, _IPV6)
+                     for match in pattern.finditer(line))
+    addresses = []
+    end = 0
+    for start, stop, text in matches:
+        if start < end:
+            continue  # part of an address already seen
+        try:
+            address = ipaddress.ip_address(text)
+        except ValueError:
+            continue
+        end = -stop
+        if getattr(address, 'ipv4_mapped', None) is not None:
+            address = address.ipv4_mapped
+        if address.is_unspecified:
+            continue
+        address = str(address)
+        if address not in addresses:
+            addresses.append(address)
+    return addresses
+
+
+def _lookup(lookup, address):
+    try:
+        return lookup(address)
+    except Exception as e:
+        # A failed lookup is reported for its address; it must never end
+        # the pipeline.
+        return e
+
+
+def _result(value):
+    """Return the JSON-ready form of one lookup result."""
+    if isinstance(value, Exception):
+        return {'error': str(value)}
+    if isinstance(value, Record):
+        return value._asdict()
+    if isinstance(value, dict) and isinstance(value.get('ip'), dict):
+        return value['ip']
+    return value
+
+
+def enrich(lines, concurrency=DEFAULT_CONCURRENCY, window=DEFAULT_WINDOW,
+           lookahead=DEFAULT_LOOKAHEAD, lookup=None, all_lines=False):
+    """Yield a dict for each line of `lines` that holds IP addresses, in
+    input order::
+
+        {'line': '...', 'ips': {'192.0.2.7': {...}, ...}}
+
+    A failed lookup gives ``{'error': '...'}`` for that address.
+
+    :param lines: an iterable of log lines, possibly unbounded
+    :param concurrency: maximum number of lookups in flight at once
+    :param window: number of most recently seen addresses whose results are
+                   reused instead of looked up again
+    :param lookahead: maximum number of lines read ahead of the one waiting
+                      for its lookups
+    :param lookup: function looking up one address, :func:`dshield.ip` by
+                   default (so the response cache applies); for example
+                   :meth:`dshield.index.ReputationIndex.lookup`
+    :param all_lines: also yield lines without addresses, with empty 'ips'
+    """
+    lookup = lookup or dshield.ip
+    seen = collections.OrderedDict()
+    pending = collections.deque()
+    executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        for line in lines:
+            line = line.rstrip('\r\n')
+            addresses = extract(line)
+            if not addresses and not all_lines:
+                continue
+            calls = []
+            for address in addresses:
+                call = seen.get(address)
+                if call is None:
+                    call = seen[address] = executor.submit(_lookup, lookup,
+                                                           address)
+                    if len(seen) > window:
+                        seen.popitem(last=False)
+                else:
+                    seen.move_to_end(address)
+                calls.append(call)
+            pending.append((line, addresses, calls))
+            while pending and (len(pending) > lookahead or
+                               all(call.done() for call in pending[0][2])):
+                yield _enriched(*pending.popleft())
+        while pending:
+            yield _enriched(*pending.popleft())
+    finally:
+        for _, _, calls in pending:
+            for call in calls:
+                call.cancel()
+        executor.shutdown(wait=False)
+
+
+def _enriched(line, addresses, calls):
+    return {'line': line,
+            'ips': collections.OrderedDict(
+                (address, _result(call.result()))
+                for address, call in zip(addresses, calls))}
+
+
+def _default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Enrich log lines with DShield data about their IP '
+                    'addresses, as JSON lines.')
+    parser.add_argument('files', nargs='*', metavar='file',
+                        help='log files to read (default: standard input)')
+    parser.add_argument('-c', '--concurrency', type=int,
+                        default=DEFAULT_CONCURRENCY,
+                        help='lookups in flight at once')
+    parser.add_argument('-w', '--window', type=int, default=DEFAULT_WINDOW,
+                        help='recent addresses whose results are reused')
+    parser.add_argument('--lookahead', type=int, default=DEFAULT_LOOKAHEAD,
+                        help='lines read ahead of the oldest unresolved one')
+    parser.add_argument('-a', '--all', action='store_true',
+                        help='also output lines without IP addresses')
+    parser.add_argument('--index', type=int, metavar='LIMIT',
+                        help='preload a reputation index of the top LIMIT '
+                             'sources and only look up other addresses')
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'),
+                        default=sys.stdout, help='output file')
+    args = parser.parse_args(argv)
+
+    if dshield.get_cache() is None:
+        dshield.configure_cache(maxsize=args.window)
+    dshield.configure_session(pool_size=args.concurrency)
+    lookup = None
+    if args.index:
+        from dshield.index import ReputationIndex
+        lookup = ReputationIndex(limit=args.index).start().lookup
+    lines = fileinput.input(args.files or ('-',),
+                            openhook=fileinput.hook_encoded('utf-8', 'replace'))
+    try:
+        for record in enrich(lines, args.concurrency, args.window,
+                             args.lookahead, lookup, args.all):
+            args.output.write(json.dumps(record, default=_default) + '\n')
+    except KeyboardInterrupt:
+        return 130
+    except BrokenPipeError:
+        return 0
+    finally:
+        lines.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
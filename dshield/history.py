@@ -0,0 +1,121 @@
+"""Incremental port history synchronisation against a local SQLite store."""
+
+import datetime
+import json
+import sqlite3
+import threading
+
+import dshield
+
+
+def _final(day, today=None):
+    """Return True once the data for `day` can no longer change.
+
+    This matches :func:`dshield.cache.is_historical`: yesterday (UTC) and
+    later are still open.
+    """
+    if today is None:
+        today = datetime.datetime.utcnow().date()
+    return day < today - datetime.timedelta(days=1)
+
+
+def _spans(days):
+    """Group a sorted list of dates into contiguous (first, last) spans."""
+    spans = []
+    for day in days:
+        if spans and day - spans[-1][1] == datetime.timedelta(days=1):
+            spans[-1][1] = day
+        else:
+            spans.append([day, day])
+    return [tuple(span) for span in spans]
+
+
+class PortHistoryStore(object):
+    """Keeps :func:`dshield.porthistory` records per (port, day) on disk, and
+    only asks the API for the days it does not hold yet.
+
+    Days whose data is final are stored, including those for which the API
+    returned no record, so they are never requested again. Recent days are
+    fetched on every sync.
+
+    :param path: path of the SQLite database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS porthistory (
+                              port TEXT NOT NULL,
+                              day TEXT NOT NULL,
+                              record TEXT,
+                              PRIMARY KEY (port, day))""")
+
+    def _held(self, port_number, start, end):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT day, record FROM porthistory"
+                " WHERE port = ? AND day BETWEEN ? AND ?",
+                (str(port_number), str(start), str(end))).fetchall()
+        return dict((day, record and json.loads(record)) for day, record in rows)
+
+    def _save(self, port_number, days, records):
+        rows = [(str(port_number), str(day),
+                 json.dumps(records[str(day)]) if str(day) in records else None)
+                for day in days if _final(day)]
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO porthistory VALUES (?, ?, ?)", rows)
+
+    def missing(self, port_number, start_date=None, end_date=None):
+        """Return the (first, last) date spans that a sync would request."""
+        start, end = dshield._date_range(start_date, end_date)
+        held = self._held(port_number, start, end)
+        days = [start + datetime.timedelta(days=n)
+                for n in range((end - start).days + 1)]
+        return _spans([day for day in days if str(day) not in held])
+
+    def porthistory(self, port_number, start_date=None, end_date=None):
+        """Sync and return the full port history for a range of dates.
+
+        Only the spans returned by :meth:`missing` are requested.
+
+        :param port_number: a valid port number (required)
+        :param start_date: string or datetime.date(), default is 30 days ago
+        :param end_date: string or datetime.date(), default is today
+        :returns: list -- the daily records, ordered by date.
+        :raises dshield.Error: for bad dates or a reversed range, like
+                               :func:`dshield.porthistory`
+        """
+        start, end = dshield._date_range(start_date, end_date)
+        held = self._held(port_number, start, end)
+        for first, last in self.missing(port_number, start, end):
+            response = dshield.porthistory(port_number, first, last)
+            merged = dshield._merge_days([response])
+            if isinstance(merged, dict):
+                merged = next(iter(merged.values()))
+            records = dict((row['date'], row) for row in merged
+                           if isinstance(row, dict) and 'date' in row)
+            days = [first + datetime.timedelta(days=n)
+                    for n in range((last - first).days + 1)]
+            self._save(port_number, days, records)
+            held.update((str(day), records.get(str(day))) for day in days)
+        return [held[day] for day in sorted(held) if held[day] is not None]
+
+    def sync(self, port_numbers, start_date=None, end_date=None,
+             concurrency=dshield.DEFAULT_POOL_SIZE):
+        """Sync many ports concurrently, see :meth:`porthistory`.
+
+        :returns: a generator of ``(port_number, records)`` tuples in input
+                  order; a failed port yields its exception as the records.
+        """
+        return dshield._bounded_map(
+            lambda port_number: self.porthistory(port_number, start_date,
+                                                 end_date),
+            dshield._unique(port_numbers), concurrency, ordered=True)
+
+    def close(self):
+        """Close the underlying database connection."""
+        with self._lock:
+            self._db.close()
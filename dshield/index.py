@@ -0,0 +1,237 @@
+"""A local IP reputation index built from the top sources lists.
+
+:class:`ReputationIndex` bulk-loads :func:`dshield.sources` and
+:func:`dshield.topips` into sorted integer arrays, so that looking up an
+address or a network is a binary search in memory. Only addresses missing
+from the index are sent to :func:`dshield.ip`.
+"""
+
+import array
+import bisect
+import ipaddress
+import socket
+import threading
+import time
+
+import dshield
+from dshield.records import Record, Source, TopIP, _date, _int, _str
+
+DEFAULT_LIMIT = 10000
+DEFAULT_TOPIPS_LIMIT = 1000
+
+
+class Reputation(Record):
+    """What is known about one source address.
+
+    Fields only reported by :func:`dshield.topips` (`rank`, `reports`,
+    `targets`) are None for addresses only found in the sources list, and
+    the other way around. `indexed` is False for results fetched with
+    :func:`dshield.ip` after an index miss.
+    """
+    __slots__ = ('ip', 'attacks', 'count', 'firstseen', 'lastseen', 'rank',
+                 'reports', 'targets', 'indexed')
+    _types = (_str, _int, _int, _date, _date, _int, _int, _int, bool)
+
+
+def _key(address):
+    """Return ``(version, integer)`` for an IP address string, accepting the
+    zero-padded IPv4 form used by the API ('001.002.003.004'), or None."""
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, address), 'big')
+    except (OSError, TypeError, ValueError):
+        pass
+    try:
+        parsed = ipaddress.ip_address(address)
+    except ValueError:
+        parts = address.split('.') if isinstance(address, str) else ()
+        if len(parts) != 4 or not all(part.isdigit() and int(part) < 256
+                                      for part in parts):
+            return None
+        return 4, int.from_bytes(bytes(int(part) for part in parts), 'big')
+    return parsed.version, int(parsed)
+
+
+class _Snapshot(object):
+    """Immutable sorted keys and their entries, per IP version."""
+
+    __slots__ = ('keys', 'entries', 'loaded')
+
+    def __init__(self, merged, loaded=None):
+        self.keys = {4: array.array('L'), 6: []}
+        self.entries = {4: [], 6: []}
+        for (version, number), entry in sorted(merged.items()):
+            self.keys[version].append(number)
+            self.entries[version].append(entry)
+        self.loaded = loaded
+
+    def get(self, version, number):
+        keys = self.keys[version]
+        position = bisect.bisect_left(keys, number)
+        if position < len(keys) and keys[position] == number:
+            return self.entries[version][position]
+        return None
+
+    def between(self, version, first, last):
+        keys = self.keys[version]
+        return self.entries[version][bisect.bisect_left(keys, first):
+                                     bisect.bisect_right(keys, last)]
+
+
+_ADDRESS_TYPES = {4: ipaddress.IPv4Address, 6: ipaddress.IPv6Address}
+
+
+def _merge(merged, address, **fields):
+    """Set `fields` on the entry for `address` in `merged`, adding it."""
+    key = _key(address)
+    if key is None:
+        return
+    entry = merged.get(key)
+    if entry is None:
+        entry = merged[key] = Reputation(str(_ADDRESS_TYPES[key[0]](key[1])),
+                                         None, None, None, None, None, None,
+                                         None, True)
+    for name, value in fields.items():
+        setattr(entry, name, value)
+
+
+class ReputationIndex(object):
+    """An in-memory index of the addresses in the top sources lists.
+
+    Lookups are a binary search over sorted integer arrays and never touch
+    the network; :meth:`lookup` falls back to :func:`dshield.ip` for
+    addresses that are not indexed. :meth:`refresh` builds a new index and
+    swaps it in at once, so lookups running meanwhile see either the old or
+    the new data, never a mix.
+
+    :param limit: number of :func:`dshield.sources` records to load
+    :param topips_limit: number of :func:`dshield.topips` records to load,
+                         0 to skip them
+    :param sort_by: `sort_by` passed to :func:`dshield.sources`
+    """
+
+    def __init__(self, limit=DEFAULT_LIMIT, topips_limit=DEFAULT_TOPIPS_LIMIT,
+                 sort_by='attacks'):
+        self.limit = limit
+        self.topips_limit = topips_limit
+        self.sort_by = sort_by
+        self.error = None
+        self._snapshot = _Snapshot({})
+        self._refresh_lock = threading.Lock()
+        self._stop = None
+        self._thread = None
+
+    @property
+    def loaded(self):
+        """Time of the last successful refresh, or None."""
+        return self._snapshot.loaded
+
+    def refresh(self):
+        """Download the lists again and replace the index with them."""
+        with self._refresh_lock:
+            merged = {}
+            for row in dshield.iter_sources(self.sort_by, self.limit):
+                if isinstance(row, dict):
+                    record = Source.from_dict(row)
+                    _merge(merged, record.ip, attacks=record.attacks,
+                           count=record.count, firstseen=record.firstseen,
+                           lastseen=record.lastseen)
+            if self.topips_limit:
+                for record in dshield.topips(limit=self.topips_limit,
+                                             return_format=dshield.TYPED):
+                    if isinstance(record, TopIP):
+                        _merge(merged, record.source, rank=record.rank,
+                               reports=record.reports, targets=record.targets)
+            self._snapshot = _Snapshot(merged, time.time())
+            self.error = None
+
+    def start(self, interval=3600):
+        """Refresh now, then every `interval` seconds in a daemon thread.
+
+        A failed background refresh keeps the current index and is stored
+        in :attr:`error`.
+        """
+        self.refresh()
+        self.stop()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        args=(self._stop, interval))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _run(self, stop, interval):
+        while not stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                # Any failure keeps the current index; the thread goes on.
+                self.error = e
+
+    def stop(self):
+        """Stop refreshing in the background."""
+        if self._stop is not None:
+            self._stop.set()
+            self._thread.join()
+            self._stop = self._thread = None
+
+    def get(self, address):
+        """Return the indexed :class:`Reputation` of `address`, or None."""
+        key = _key(address)
+        if key is None:
+            return None
+        return self._snapshot.get(*key)
+
+    def network(self, network):
+        """Return the indexed entries inside `network`, e.g. '1.2.3.0/24',
+        in address order."""
+        network = ipaddress.ip_network(network, strict=False)
+        return self._snapshot.between(network.version,
+                                      int(network.network_address),
+                                      int(network.broadcast_address))
+
+    def lookup(self, address):
+        """Return the :class:`Reputation` of `address` from the index, or
+        from :func:`dshield.ip` if it is not indexed.
+
+        :raises dshield.Error: if `address` is missing and not a valid IP
+        """
+        entry = self.get(address)
+        if entry is not None:
+            return entry
+        return _from_ip(address, dshield.ip(address))
+
+    def lookup_many(self, addresses, concurrency=10):
+        """Yield ``(address, Reputation)`` for each distinct address, hits
+        first, then misses as :func:`dshield.ip_many` resolves them.
+
+        A miss that fails yields its :class:`dshield.Error` instead.
+        """
+        misses = []
+        for address in dshield._unique(addresses):
+            entry = self.get(address)
+            if entry is None:
+                misses.append(address)
+            else:
+                yield address, entry
+        for address, result in dshield.ip_many(misses, concurrency):
+            if isinstance(result, Exception):
+                yield address, result
+            else:
+                yield address, _from_ip(address, result)
+
+    def __contains__(self, address):
+        return self.get(address) is not None
+
+    def __len__(self):
+        snapshot = self._snapshot
+        return len(snapshot.entries[4]) + len(snapshot.entries[6])
+
+
+def _from_ip(address, response):
+    """Build a :class:`Reputation` from a :func:`dshield.ip` response."""
+    data = response.get('ip', response) if isinstance(response, dict) else {}
+    if not isinstance(data, dict):
+        data = {}
+    return Reputation(address, _int(data.get('attacks')), _int(data.get('count')),
+                      _date(data.get('mindate')), _date(data.get('maxdate')),
+                      None, None, None, False)
@@ -0,0 +1,279 @@
+"""Per-request instrumentation for the DShield API.
+
+Hooks registered with :func:`dshield.add_hook` are called with a
+:class:`RequestEvent` after every API call. :class:`Metrics` is such a hook
+that keeps counters and latency histograms per endpoint and exports them in
+the Prometheus text format.
+"""
+
+import collections
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Upper bounds in seconds of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+           float('inf'))
+
+PHASES = ('connect', 'ttfb', 'download', 'decode')
+
+_timing = threading.local()
+
+
+class RequestEvent(object):
+    """What happened during one API call.
+
+    Durations are in seconds; network phases are None when no request was
+    sent (cache or store hits, coalesced duplicates) and `connect` is 0 when
+    a pooled connection was reused.
+
+    :ivar endpoint: endpoint name, e.g. 'ip'
+    :ivar uri: API URI, e.g. 'ip/1.2.3.4'
+    :ivar return_format: the requested return format
+    :ivar status: HTTP status code of the final attempt, if any
+    :ivar bytes: size of the response body, if downloaded
+    :ivar retries: number of retries before the final attempt
+    :ivar cache: 'hit', 'miss', or 'revalidated' when an expired entry was
+                 confirmed unchanged by a 304 response; None when no cache
+                 is configured
+    :ivar store: 'hit' or 'miss' for historical queries with a persistent
+                 store configured, else None
+    :ivar coalesced: True if the result came from a concurrent identical call
+    :ivar connect: time spent opening connections
+    :ivar ttfb: time from sending the request to the response headers,
+                excluding `connect`
+    :ivar download: time spent reading the response body
+    :ivar decode: time spent decoding the response body
+    :ivar total: wall time of the whole call
+    :ivar error: the exception raised by the call, if any
+    """
+
+    __slots__ = ('endpoint', 'uri', 'return_format', 'status', 'bytes',
+                 'retries', 'cache', 'store', 'coalesced', 'connect', 'ttfb',
+                 'download', 'decode', 'total', 'error', 'started')
+
+    def __init__(self, endpoint, uri, return_format=None):
+        self.endpoint = endpoint
+        self.uri = uri
+        self.return_format = return_format
+        self.status = None
+        self.bytes = None
+        self.retries = 0
+        self.cache = None
+        self.store = None
+        self.coalesced = False
+        self.connect = None
+        self.ttfb = None
+        self.download = None
+        self.decode = None
+        self.total = None
+        self.error = None
+        self.started = time.perf_counter()
+
+    def __repr__(self):
+        return 'RequestEvent({0})'.format(', '.join(
+            '{0}={1!r}'.format(name, getattr(self, name))
+            for name in self.__slots__ if name != 'started'))
+
+
+def reset_connect_time():
+    """Reset the connect time accumulated by the current thread."""
+    _timing.connect = 0.0
+
+
+def connect_time():
+    """Return the connect time accumulated by the current thread."""
+    return getattr(_timing, 'connect', 0.0)
+
+
+class _TimedConnect(object):
+    """Mixin recording how long `connect()` takes in a thread-local."""
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super(_TimedConnect, self).connect()
+        finally:
+            _timing.connect = connect_time() + time.perf_counter() - start
+
+
+class _TimedHTTPConnection(_TimedConnect, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnect, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """An HTTPAdapter whose connections report their connect time."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+
+class _Histogram(object):
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class _EndpointMetrics(object):
+
+    def __init__(self):
+        self.requests = collections.Counter()  # by status code
+        self.errors = 0
+        self.cache = collections.Counter()
+        self.bytes = 0
+        self.retries = 0
+        self.latency = _Histogram()
+        self.phases = dict((phase, _Histogram()) for phase in PHASES)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics(object):
+    """A hook aggregating :class:`RequestEvent` objects per endpoint.
+
+    Register it with :func:`dshield.add_hook` and read it back with
+    :meth:`snapshot` or :meth:`prometheus`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = collections.defaultdict(_EndpointMetrics)
+
+    def __call__(self, event):
+        with self._lock:
+            metrics = self._endpoints[event.endpoint]
+            if event.status is not None:
+                metrics.requests[event.status] += 1
+            if event.error is not None:
+                metrics.errors += 1
+            if event.cache is not None:
+                metrics.cache[event.cache] += 1
+            metrics.bytes += event.bytes or 0
+            metrics.retries += event.retries
+            if event.total is not None:
+                metrics.latency.observe(event.total)
+            for phase in PHASES:
+                value = getattr(event, phase)
+                if value is not None:
+                    metrics.phases[phase].observe(value)
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._endpoints.clear()
+
+    def snapshot(self):
+        """Return a dict of endpoint name to a dict of its counters and
+        latency totals."""
+        with self._lock:
+            return dict((name, {
+                'requests': sum(metrics.requests.values()),
+                'statuses': dict(metrics.requests),
+                'errors': metrics.errors,
+                'cache_hits': metrics.cache['hit'],
+                'cache_misses': metrics.cache['miss'],
+                'cache_revalidated': metrics.cache['revalidated'],
+                'bytes': metrics.bytes,
+                'retries': metrics.retries,
+                'calls': metrics.latency.count,
+                'seconds': metrics.latency.sum,
+                'phase_seconds': dict((phase, metrics.phases[phase].sum)
+                                      for phase in PHASES),
+            }) for name, metrics in self._endpoints.items())
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+
+        def sample(name, labels, value):
+            lines.append('{0}{{{1}}} {2}'.format(name, ','.join(
+                '{0}="{1}"'.format(key, _escape(label))
+                for key, label in labels), repr(float(value))))
+
+        def histogram(name, labels, hist):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, hist.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                sample(name + '_bucket', labels + [('le', le)], cumulative)
+            sample(name + '_sum', labels, hist.sum)
+            sample(name + '_count', labels, hist.count)
+
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            family('dshield_requests_total', 'counter',
+                   'HTTP responses received, by status code.')
+            for name, metrics in endpoints:
+                for status, count in sorted(metrics.requests.items()):
+                    sample('dshield_requests_total',
+                           [('endpoint', name), ('status', status)], count)
+            family('dshield_errors_total', 'counter', 'Calls that raised.')
+            for name, metrics in endpoints:
+                sample('dshield_errors_total', [('endpoint', name)],
+                       metrics.errors)
+            family('dshield_cache_total', 'counter',
+                   'Response cache lookups, by result.')
+            for name, metrics in endpoints:
+                for result in ('hit', 'miss', 'revalidated'):
+                    sample('dshield_cache_total',
+                           [('endpoint', name), ('result', result)],
+                           metrics.cache[result])
+            family('dshield_response_bytes_total', 'counter',
+                   'Response body bytes downloaded.')
+            for name, metrics in endpoints:
+                sample('dshield_response_bytes_total', [('endpoint', name)],
+                       metrics.bytes)
+            family('dshield_retries_total', 'counter', 'Requests retried.')
+            for name, metrics in endpoints:
+                sample('dshield_retries_total', [('endpoint', name)],
+                       metrics.retries)
+            family('dshield_call_duration_seconds', 'histogram',
+                   'Wall time of API calls.')
+            for name, metrics in endpoints:
+                histogram('dshield_call_duration_seconds',
+                          [('endpoint', name)], metrics.latency)
+            family('dshield_phase_duration_seconds', 'histogram',
+                   'Time spent per request phase.')
+            for name, metrics in endpoints:
+                for phase in PHASES:
+                    histogram('dshield_phase_duration_seconds',
+                              [('endpoint', name), ('phase', phase)],
+                              metrics.phases[phase])
+        return '\n'.join(lines) + '\n'
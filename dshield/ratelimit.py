@@ -0,0 +1,108 @@
+"""Request pacing and retries for the DShield API."""
+
+import datetime
+import email.utils
+import random
+import threading
+import time
+
+# Responses worth retrying: throttling and transient server errors.
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket shared by every request in the process.
+
+    The sustained rate adapts to the server: each throttled response halves
+    it (down to a tenth of `rate`) and pauses every caller, and each
+    successful response wins back a small share of `rate`.
+
+    :param rate: requests per second allowed on average
+    :param burst: maximum number of requests allowed back to back
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.current_rate = self.rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return how many seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens
+                               + (now - self._updated) * self.current_rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = max(0.0, -self._tokens / self.current_rate)
+            return max(wait, self._paused_until - now)
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttled(self, delay):
+        """Slow down after the server throttled a request, pausing all callers
+        for `delay` seconds."""
+        with self._lock:
+            self.current_rate = max(self.rate / 10, self.current_rate / 2)
+            self._paused_until = max(self._paused_until,
+                                     time.monotonic() + delay)
+
+    def succeeded(self):
+        """Speed back up towards `rate` after a successful request."""
+        if self.current_rate < self.rate:
+            with self._lock:
+                self.current_rate = min(self.rate,
+                                        self.current_rate + self.rate / 20)
+
+
+class RetryPolicy(object):
+    """Retries with jittered exponential backoff that honours Retry-After.
+
+    :param max_retries: number of retries after the first attempt
+    :param backoff: base delay in seconds, doubled on each retry
+    :param max_backoff: cap on any single delay; a Retry-After longer than
+                        this is not retried
+    """
+
+    def __init__(self, max_retries=3, backoff=0.5, max_backoff=60):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt, retry_after=None):
+        """Return the seconds to wait before retry number `attempt` (from 0),
+        never less than `retry_after`, or None to give up if the server asks
+        for a longer wait than `max_backoff`."""
+        if retry_after is not None:
+            if retry_after > self.max_backoff:
+                return None
+            return retry_after + random.uniform(
+                0, min(self.backoff, self.max_backoff - retry_after))
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+
+def retry_after(value):
+    """Parse a Retry-After header (seconds or HTTP date) into seconds."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (when - now).total_seconds())
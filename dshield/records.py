@@ -0,0 +1,281 @@
+"""Compact typed records and columns for the tabular API endpoints.
+
+Records are returned when a function is called with
+``return_format=dshield.TYPED``. Numeric fields are parsed to `int` and dates
+to `datetime.date` (or `datetime.datetime`) once, and each record uses
+`__slots__` instead of a dict. ``return_format=dshield.COLUMNAR`` returns
+:class:`Columns` instead, with numeric fields in contiguous arrays.
+"""
+
+import array
+import collections
+import datetime
+import functools
+
+
+def _int(value):
+    """Parse a count or port number, leaving unparseable values alone."""
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            return value
+
+
+@functools.lru_cache(maxsize=4096)
+def _date(value):
+    """Parse a 'Y-M-D' or 'Y-M-D H:M:S' date, leaving other values alone.
+
+    Rows repeat the same few dates, so parsed dates are memoized and shared.
+    """
+    if not value:
+        return None
+    for fmt, convert in (("%Y-%m-%d", lambda d: d.date()),
+                         ("%Y-%m-%d %H:%M:%S", lambda d: d)):
+        try:
+            return convert(datetime.datetime.strptime(value, fmt))
+        except (TypeError, ValueError):
+            pass
+    return value
+
+
+def _str(value):
+    return value
+
+
+class Record(object):
+    """Base class for typed records.
+
+    Subclasses list their fields in `__slots__` and a parser for each in
+    `_types`. Records compare equal field by field, and :meth:`_asdict`
+    returns a plain dict.
+    """
+
+    __slots__ = ()
+    _types = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_dict(cls, row):
+        """Build a record from a decoded JSON row. Unknown keys are
+        dropped and missing fields are None."""
+        return cls(*[parse(row.get(name))
+                     for name, parse in zip(cls.__slots__, cls._types)])
+
+    def _asdict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, ', '.join(
+            '{0}={1!r}'.format(name, getattr(self, name))
+            for name in self.__slots__))
+
+
+class Backscatter(Record):
+    """A :func:`dshield.backscatter` row."""
+    __slots__ = ('sourceport', 'count', 'sources', 'targets')
+    _types = (_int, _int, _int, _int)
+
+
+class TopPort(Record):
+    """A :func:`dshield.topports` row."""
+    __slots__ = ('rank', 'targetport', 'records', 'targets', 'sources')
+    _types = (_int, _int, _int, _int, _int)
+
+
+class TopIP(Record):
+    """A :func:`dshield.topips` row."""
+    __slots__ = ('rank', 'source', 'reports', 'targets')
+    _types = (_int, _str, _int, _int)
+
+
+class Source(Record):
+    """A :func:`dshield.sources` or :func:`dshield.asnum` row."""
+    __slots__ = ('ip', 'attacks', 'count', 'firstseen', 'lastseen')
+    _types = (_str, _int, _int, _date, _date)
+
+
+class DailyCount(Record):
+    """A :func:`dshield.porthistory` or :func:`dshield.dailysummary` row."""
+    __slots__ = ('date', 'records', 'targets', 'sources')
+    _types = (_date, _int, _int, _int)
+
+
+RECORD_TYPES = {
+    'backscatter': Backscatter,
+    'topports': TopPort,
+    'topips': TopIP,
+    'sources': Source,
+    'asnum': Source,
+    'porthistory': DailyCount,
+    'dailysummary': DailyCount,
+}
+
+
+def rows(data):
+    """Return the list of row dicts in a decoded tabular response, or None
+    if `data` does not look tabular.
+
+    Rows come as a list, a list wrapped in a single-key dict, or a dict of
+    numbered rows next to scalar members such as 'limit' and 'date'.
+    """
+    if isinstance(data, list):
+        return data
+    if not isinstance(data, dict):
+        return None
+    if len(data) == 1:
+        value = next(iter(data.values()))
+        if isinstance(value, list):
+            return value
+    numbered = [(int(key), value) for key, value in data.items()
+                if key.isdigit() and isinstance(value, dict)]
+    if not numbered:
+        return None
+    return [value for _, value in sorted(numbered, key=lambda item: item[0])]
+
+
+def convert(endpoint, data):
+    """Convert a decoded response from `endpoint` to a list of records.
+
+    Responses from endpoints without a record type, or that are not tabular
+    (such as error messages), are returned unchanged.
+    """
+    cls = RECORD_TYPES.get(endpoint)
+    table = rows(data) if cls is not None else None
+    if table is None:
+        return data
+    return [cls.from_dict(row) for row in table if isinstance(row, dict)]
+
+
+# Value stored in count and port columns for missing or unparseable fields.
+MISSING = -1
+
+# Value stored in date columns for missing or unparseable dates; NumPy reads
+# it as NaT.
+MISSING_DATE = -2 ** 63
+
+_EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+
+def _int_cell(value):
+    value = _int(value)
+    return value if isinstance(value, int) else MISSING
+
+
+def _date_cell(value):
+    value = _date(value)
+    if isinstance(value, datetime.date):
+        return value.toordinal() - _EPOCH
+    return MISSING_DATE
+
+
+class Columns(object):
+    """Column-oriented view of a tabular response.
+
+    Counts and ports are held in ``array('q')`` columns with :data:`MISSING`
+    for missing values, and dates in ``array('q')`` columns of days since
+    1970-01-01 with :data:`MISSING_DATE`; other fields are lists of strings.
+    Numeric columns support the buffer protocol, so :meth:`to_numpy` wraps
+    them without copying.
+    """
+
+    def __init__(self, columns, kinds):
+        self._columns = columns
+        self.kinds = kinds
+
+    @classmethod
+    def from_rows(cls, record_type, rows):
+        """Build columns for `record_type` fields straight from row dicts."""
+        columns = collections.OrderedDict()
+        kinds = {}
+        rows = [row for row in rows if isinstance(row, dict)]
+        for name, parse in zip(record_type.__slots__, record_type._types):
+            values = (row.get(name) for row in rows)
+            if parse is _int:
+                columns[name] = array.array('q', map(_int_cell, values))
+                kinds[name] = 'int'
+            elif parse is _date:
+                columns[name] = array.array('q', map(_date_cell, values))
+                kinds[name] = 'date'
+            else:
+                columns[name] = list(values)
+                kinds[name] = 'str'
+        return cls(columns, kinds)
+
+    def __getitem__(self, name):
+        return self._columns[name]
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        """Return the number of rows."""
+        for column in self._columns.values():
+            return len(column)
+        return 0
+
+    def keys(self):
+        return self._columns.keys()
+
+    def items(self):
+        return self._columns.items()
+
+    def dates(self, name):
+        """Return a date column as a list of datetime.date() objects."""
+        return [None if day == MISSING_DATE
+                else datetime.date.fromordinal(day + _EPOCH)
+                for day in self._columns[name]]
+
+    def to_numpy(self):
+        """Return a dict of NumPy arrays. Numeric columns share memory with
+        these columns. Count and port columns are ``int64`` and keep
+        :data:`MISSING` (-1) for missing values, so mask them before
+        aggregating; date columns are ``datetime64[D]`` with NaT for missing
+        dates. Requires NumPy."""
+        import numpy
+        result = collections.OrderedDict()
+        for name, column in self._columns.items():
+            if self.kinds[name] == 'int':
+                result[name] = numpy.frombuffer(column, dtype=numpy.int64)
+            elif self.kinds[name] == 'date':
+                result[name] = numpy.frombuffer(column, dtype='datetime64[D]')
+            else:
+                result[name] = numpy.array(column, dtype=object)
+        return result
+
+    def __repr__(self):
+        return 'Columns({0} rows: {1})'.format(len(self), ', '.join(self))
+
+
+def to_columns(endpoint, data):
+    """Convert a decoded response from `endpoint` to :class:`Columns`.
+
+    Responses from endpoints without a record type, or that are not tabular
+    (such as error messages), are returned unchanged.
+    """
+    cls = RECORD_TYPES.get(endpoint)
+    table = rows(data) if cls is not None else None
+    if table is None:
+        return data
+    return Columns.from_rows(cls, table)
@@ -0,0 +1,259 @@
+"""Keep hot queries fresh in the background.
+
+A :class:`Refresher` re-fetches a registered set of queries at their own
+intervals from a background thread. Once it is installed with
+:func:`dshield.configure_refresher`, calls to those queries return the last
+good value at once, from any thread or event loop. If a value is overdue,
+the call still returns it and a refresh starts in the background
+(stale-while-revalidate). After warm-up, reads of registered queries never
+wait for the network.
+"""
+
+import functools
+import inspect
+import threading
+import time
+from concurrent import futures
+
+import dshield
+from dshield.cache import endpoint
+from dshield.metrics import RequestEvent
+
+DEFAULT_INTERVAL = 60
+DEFAULT_WORKERS = 4
+
+# URI builders by public function name; their parameters are named like
+# those of the public functions.
+_BUILDERS = {
+    'backscatter': dshield._backscatter_uri,
+    'handler': lambda: 'handler',
+    'infocon': lambda: 'infocon',
+    'ip': dshield._ip_uri,
+    'port': dshield._port_uri,
+    'portdate': dshield._portdate_uri,
+    'topports': functools.partial(dshield._top_uri, 'topports'),
+    'topips': functools.partial(dshield._top_uri, 'topips'),
+    'sources': functools.partial(dshield._top_uri, 'sources'),
+    'porthistory': dshield._porthistory_uri,
+    'asnum': dshield._asnum_uri,
+    'dailysummary': dshield._dailysummary_uri,
+    'daily404summary': dshield._daily404summary_uri,
+    'daily404detail': dshield._daily404detail_uri,
+    'glossary': dshield._glossary_uri,
+    'webhoneypotsummary': functools.partial(dshield._webhoneypot_uri,
+                                            'webhoneypotsummary'),
+    'webhoneypotbytype': functools.partial(dshield._webhoneypot_uri,
+                                           'webhoneypotbytype'),
+}
+
+# Queries whose default dates move with the current day, and whose long
+# ranges are split into several requests.
+_RANGE_QUERIES = ('porthistory', 'dailysummary')
+
+
+def query_key(name, *args, **kwargs):
+    """Return the ``(uri, return_format)`` key that a call to the public
+    function `name` with these arguments is fetched and cached under.
+
+    :raises ValueError: for date range queries without both dates, whose
+                        URI changes every day, or that span more than one
+                        request window
+    """
+    if name not in _BUILDERS:
+        raise ValueError("cannot refresh {0!r}".format(name))
+    arguments = inspect.signature(getattr(dshield, name)).bind(*args, **kwargs)
+    arguments.apply_defaults()
+    arguments = dict(arguments.arguments)
+    if name in _RANGE_QUERIES:
+        start, end = arguments['start_date'], arguments['end_date']
+        if not start or not end or dshield._windows(start, end) is not None:
+            raise ValueError(
+                "cannot refresh {0} without a start_date and end_date at most "
+                "{1} days apart".format(name, dshield.MAX_RANGE_DAYS))
+    return_format = arguments.pop('return_format', None)
+    if return_format in dshield._CONVERTERS:
+        return_format = None  # converted locally from the JSON response
+    return _BUILDERS[name](**arguments), return_format
+
+
+def _fetch(function, return_format):
+    """Fetch a query for a refresh, passing the request to any hooks.
+
+    :raises dshield.Error: if the API did not answer 200 OK
+    """
+    event = RequestEvent(endpoint(function), function, return_format)
+    try:
+        value = dshield._fetch(function, return_format, event)[0]
+        if event.status not in (None, 200):
+            raise dshield.Error("Refreshing {0} failed with HTTP status {1}".format(
+                function, event.status))
+        return value
+    except BaseException as e:
+        event.error = e
+        raise
+    finally:
+        if dshield._hooks:
+            dshield._emit(event)
+
+
+class _Entry(object):
+
+    __slots__ = ('key', 'interval', 'value', 'updated', 'due', 'refreshing',
+                 'error')
+
+    def __init__(self, key, interval):
+        self.key = key
+        self.interval = interval
+        self.value = dshield._MISSING
+        self.updated = None
+        self.due = 0.0
+        self.refreshing = False
+        self.error = None
+
+
+class Refresher(object):
+    """Re-fetches registered queries in the background.
+
+    :param interval: default seconds between refreshes of a query
+    :param workers: maximum number of refreshes running at once
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, workers=DEFAULT_WORKERS):
+        self.interval = interval
+        self.workers = workers
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self._thread = None
+        self._stopped = False
+
+    def add(self, name, *args, **kwargs):
+        """Register a call to the public function `name`, e.g.
+        ``add('topports', 'records', 10, interval=300)``.
+
+        :param interval: optional keyword, seconds between refreshes
+        :returns: the query key, see :func:`query_key`.
+        """
+        interval = kwargs.pop('interval', None) or self.interval
+        key = query_key(name, *args, **kwargs)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = _Entry(key, interval)
+            else:
+                entry.interval = interval
+        self._wakeup.set()
+        return key
+
+    def remove(self, key):
+        """Stop refreshing the query with `key`, as returned by :meth:`add`."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get(self, key, default=None):
+        """Return the last good value for `key`, or `default` if it is not
+        registered or not fetched yet. An overdue value is still returned,
+        and a refresh is started in the background."""
+        entry = self._entries.get(key)
+        if entry is None or entry.value is dshield._MISSING:
+            return default
+        if entry.due <= time.monotonic():
+            with self._lock:
+                self._submit(entry)
+        return entry.value
+
+    def status(self):
+        """Return a dict of key to ``(updated, error)``: the time.time() of
+        the last successful refresh, and the exception raised by the last
+        attempt if it failed."""
+        with self._lock:
+            return dict((key, (entry.updated, entry.error))
+                        for key, entry in self._entries.items())
+
+    def refresh(self):
+        """Refresh every registered query now and wait for them all."""
+        with self._lock:
+            entries = list(self._entries.values())
+        for entry in entries:
+            self._refresh(entry)
+
+    def start(self, warm=True):
+        """Start refreshing in a daemon thread.
+
+        :param warm: first refresh every query and wait for the results, so
+                     that reads never block from the start
+        """
+        if warm:
+            self.refresh()
+        if self._thread is None:
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the background thread and wait for refreshes in flight.
+        Values stay available."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            executor = self._executor
+            self._executor = futures.ThreadPoolExecutor(max_workers=self.workers)
+        executor.shutdown(wait=True)
+
+    def _run(self):
+        while not self._stopped:
+            now = time.monotonic()
+            wait = None
+            with self._lock:
+                for entry in self._entries.values():
+                    if entry.refreshing:
+                        continue
+                    if entry.due <= now:
+                        self._submit(entry)
+                    elif wait is None or entry.due - now < wait:
+                        wait = entry.due - now
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+
+    def _submit(self, entry):
+        """Start refreshing `entry` unless it already is; holds the lock."""
+        if not entry.refreshing:
+            entry.refreshing = True
+            self._executor.submit(self._refresh, entry, True)
+
+    def _refresh(self, entry, submitted=False):
+        with self._lock:
+            if entry.refreshing and not submitted:
+                return
+            entry.refreshing = True
+        fetched = False
+        error = None
+        try:
+            value = _fetch(*entry.key)
+            fetched = True
+        except Exception as e:
+            # Any failure (API, network, store, archive) keeps the last good
+            # value; it is reported by status() instead of being lost in the
+            # executor.
+            error = e
+        finally:
+            with self._lock:
+                if fetched:
+                    entry.value = value
+                    entry.updated = time.time()
+                entry.error = error
+                entry.due = time.monotonic() + entry.interval
+                entry.refreshing = False
+            self._wakeup.set()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,146 @@
+"""Record API responses to a local archive and replay them offline.
+
+An :class:`Archive` in ``RECORD`` mode saves every response received from
+the API; in ``REPLAY`` mode it answers every request from memory without
+touching the network, and raises :class:`ReplayMiss` for anything it does
+not hold. See :func:`dshield.configure_archive`.
+
+Archives are gzipped files with one JSON array per response::
+
+    ["ip/8.8.8.8?json", 200, "utf-8", "{\\"ip\\": ...}"]
+
+holding the request (API URI and format), status code, text encoding and
+body. Recording appends, so later responses to the same request win.
+"""
+
+import collections
+import json
+import os
+import threading
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+
+class ReplayMiss(LookupError):
+    """Raised when replaying a request that is not in the archive."""
+
+
+class Entry(collections.namedtuple('Entry', 'status content encoding')):
+    """A recorded response: status code, body bytes and text encoding."""
+
+    __slots__ = ()
+
+    @property
+    def text(self):
+        """The body decoded with the recorded encoding, or UTF-8."""
+        return self.content.decode(self.encoding or 'utf-8', 'replace')
+
+    @property
+    def headers(self):
+        """Recorded responses keep no headers."""
+        return {}
+
+
+class Archive(object):
+    """Recorded responses keyed by request, e.g. 'ip/8.8.8.8?json'.
+
+    The whole archive is loaded into memory when opened. A file cut short
+    by a crash while recording keeps every complete entry; opening it to
+    record again first rewrites it with just those entries.
+
+    :param path: path of the archive file
+    :param mode: RECORD to append responses to the file, REPLAY to serve
+                 them; replaying requires the file to exist
+    """
+
+    def __init__(self, path, mode=REPLAY):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError("mode must be RECORD or REPLAY, not {0!r}".format(mode))
+        self.path = path
+        self.mode = mode
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._file = None
+        complete = True
+        if mode == REPLAY or os.path.exists(path):
+            complete = self._load()
+        if mode == RECORD:
+            import gzip
+            if not complete:
+                # Appending after a cut-off stream would make the rest of
+                # the file unreadable.
+                self._rewrite()
+            self._file = gzip.open(path, 'at', encoding='utf-8')
+
+    def _load(self):
+        """Load the entries of the file; return False if it was cut short
+        or damaged, keeping every complete entry before that point."""
+        import gzip
+        import zlib
+        with gzip.open(self.path, 'rt', encoding='utf-8') as archive:
+            try:
+                for line in archive:
+                    try:
+                        request, status, encoding, body = json.loads(line)
+                    except ValueError:
+                        return False  # a partial last line
+                    self._entries[request] = Entry(
+                        status, body.encode('utf-8', 'surrogateescape'), encoding)
+            except (EOFError, OSError, zlib.error):
+                return False
+        return True
+
+    def _rewrite(self):
+        """Replace the file with the entries loaded from it."""
+        import gzip
+        temporary = self.path + '.tmp'
+        with gzip.open(temporary, 'wt', encoding='utf-8') as archive:
+            for request, entry in self._entries.items():
+                archive.write(_line(request, *entry) + '\n')
+        os.replace(temporary, self.path)
+
+    def get(self, request):
+        """Return the :class:`Entry` recorded for `request`.
+
+        :raises ReplayMiss: if `request` was never recorded.
+        """
+        try:
+            return self._entries[request]
+        except KeyError:
+            raise ReplayMiss("{0} is not in the archive {1}".format(
+                request, self.path))
+
+    def add(self, request, status, content, encoding=None):
+        """Record a response body (bytes) and append it to the file."""
+        entry = Entry(status, content, encoding)
+        line = _line(request, status, content, encoding)
+        with self._lock:
+            if self._file is None:
+                raise ValueError("archive {0} is not recording".format(self.path))
+            self._entries[request] = entry
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def __contains__(self, request):
+        return request in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def close(self):
+        """Finish writing the file, if recording."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def _line(request, status, content, encoding):
+    """Return the archive line of a response."""
+    return json.dumps([request, status, encoding,
+                       content.decode('utf-8', 'surrogateescape')],
+                      separators=(',', ':'))
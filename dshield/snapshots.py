@@ -0,0 +1,442 @@
+"""Compact daily snapshots of the top lists, with a change feed.
+
+:class:`SnapshotStore` keeps one snapshot per day of :func:`dshield.topports`,
+:func:`dshield.topips` and :func:`dshield.backscatter` in a SQLite file. Each
+snapshot is stored as integer columns (ranks, keys and counts), delta and
+varint encoded, then compressed: a 100-row day takes a few hundred bytes.
+
+When a day is added, how it differs from the previous stored day (new and
+dropped entries, rank and count changes) is computed once and kept as a
+change feed, so day-over-day movement is read back without decoding any
+snapshot, and history is queried without fetching or parsing old days again.
+"""
+
+import collections
+import datetime
+import ipaddress
+import sqlite3
+import threading
+import zlib
+
+import dshield
+from dshield.history import _final
+from dshield.index import _key
+from dshield.records import Backscatter, TopIP, TopPort
+
+LISTS = ('topports', 'topips', 'backscatter')
+DEFAULT_LIMIT = 100
+
+NEW = 'new'
+DROPPED = 'dropped'
+MOVED = 'moved'
+
+
+class Change(collections.namedtuple(
+        'Change', 'day key kind rank previous_rank count previous_count')):
+    """How one entry of a list changed from the previous stored day.
+
+    `count` is the first counter of the list: records for topports, reports
+    for topips and count for backscatter. Fields of the missing side of a
+    NEW or DROPPED change are None.
+    """
+
+    __slots__ = ()
+
+
+_List = collections.namedtuple('_List', 'record_type key fields fetch')
+
+_LISTS = {
+    'topports': _List(TopPort, 'targetport', ('records', 'targets', 'sources'),
+                      lambda day, limit: dshield.topports(
+                          'records', limit, day, dshield.TYPED)),
+    'topips': _List(TopIP, 'source', ('reports', 'targets'),
+                    lambda day, limit: dshield.topips(
+                        'records', limit, day, dshield.TYPED)),
+    'backscatter': _List(Backscatter, 'sourceport', ('count', 'sources', 'targets'),
+                         lambda day, limit: dshield.backscatter(
+                             day, limit, dshield.TYPED)),
+}
+
+# Value stored for missing counts, as in dshield.records.Columns.
+_MISSING = -1
+
+# How the keys of a snapshot are encoded.
+_INT_KEYS = 0
+_IPV4_KEYS = 1
+_TEXT_KEYS = 2
+
+
+def _pack(numbers, out):
+    """Append `numbers` to the bytearray `out`, delta, zigzag and varint
+    encoded."""
+    previous = 0
+    for number in numbers:
+        delta = number - previous
+        previous = number
+        delta = delta << 1 if delta >= 0 else (-delta << 1) - 1
+        while delta > 0x7f:
+            out.append(delta & 0x7f | 0x80)
+            delta >>= 7
+        out.append(delta)
+
+
+def _unpack(data, position, count):
+    """Decode `count` numbers packed by :func:`_pack` from `data` at
+    `position`, and return them with the position after them."""
+    numbers = []
+    previous = 0
+    for _ in range(count):
+        delta = shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            delta |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        previous += -((delta + 1) >> 1) if delta & 1 else delta >> 1
+        numbers.append(previous)
+    return numbers, position
+
+
+def _normal_key(list_name, key):
+    """Return a port number as an int, and an IPv4 address in normal form."""
+    if list_name != 'topips':
+        try:
+            return int(key)
+        except (TypeError, ValueError):
+            return str(key)
+    number = _key(str(key))
+    if number is not None and number[0] == 4:
+        return str(ipaddress.IPv4Address(number[1]))
+    return str(key)
+
+
+def _count(value):
+    return value if isinstance(value, int) else _MISSING
+
+
+def _value(number):
+    return None if number == _MISSING else number
+
+
+class _Snapshot(object):
+    """One day of a list: keys in rank order, with ranks and counters."""
+
+    __slots__ = ('keys', 'ranks', 'columns', '_positions')
+
+    def __init__(self, keys, ranks, columns):
+        self.keys = keys
+        self.ranks = ranks
+        self.columns = columns
+        self._positions = None
+
+    @classmethod
+    def from_records(cls, list_name, spec, records):
+        records = sorted(enumerate(records), key=lambda item: (
+            getattr(item[1], 'rank', None) or item[0] + 1, item[0]))
+        keys, ranks = [], []
+        for position, (_, record) in enumerate(records):
+            keys.append(_normal_key(list_name, getattr(record, spec.key)))
+            ranks.append(_count(getattr(record, 'rank', position + 1)))
+        columns = [[_count(getattr(record, field)) for _, record in records]
+                   for field in spec.fields]
+        return cls(keys, ranks, columns)
+
+    def encode(self):
+        if all(isinstance(key, int) and key >= 0 for key in self.keys):
+            kind, numbers = _INT_KEYS, self.keys
+        else:
+            numbers = [_key(key) for key in self.keys]
+            if all(number is not None and number[0] == 4 for number in numbers):
+                kind, numbers = _IPV4_KEYS, [number[1] for number in numbers]
+            else:
+                kind, numbers = _TEXT_KEYS, ()
+        out = bytearray()
+        _pack((len(self.keys), kind, len(self.columns)), out)
+        for column in [self.ranks, numbers] + self.columns:
+            _pack(column, out)
+        if kind == _TEXT_KEYS:
+            out.extend('\n'.join(map(str, self.keys)).encode('utf-8'))
+        return zlib.compress(bytes(out))
+
+    @classmethod
+    def decode(cls, blob):
+        data = zlib.decompress(blob)
+        (count, kind, width), position = _unpack(data, 0, 3)
+        ranks, position = _unpack(data, position, count)
+        keys, position = _unpack(data, position, 0 if kind == _TEXT_KEYS else count)
+        columns = []
+        for _ in range(width):
+            column, position = _unpack(data, position, count)
+            columns.append(column)
+        if kind == _IPV4_KEYS:
+            keys = [str(ipaddress.IPv4Address(key)) for key in keys]
+        elif kind == _TEXT_KEYS:
+            keys = data[position:].decode('utf-8').split('\n') if count else []
+        return cls(keys, ranks, columns)
+
+    def positions(self):
+        if self._positions is None:
+            self._positions = dict((key, n) for n, key in enumerate(self.keys))
+        return self._positions
+
+    def record(self, spec, position):
+        values = dict(zip(spec.fields,
+                          (_value(column[position]) for column in self.columns)))
+        values[spec.key] = self.keys[position]
+        if 'rank' in spec.record_type.__slots__:
+            values['rank'] = _value(self.ranks[position])
+        return spec.record_type(*[values.get(name)
+                                  for name in spec.record_type.__slots__])
+
+    def records(self, spec):
+        return [self.record(spec, n) for n in range(len(self.keys))]
+
+
+def _diff(day, previous, current):
+    """Return the :class:`Change` list turning `previous` into `current`."""
+    changes = []
+    before = dict(previous.positions())
+    counts, previous_counts = current.columns[0], previous.columns[0]
+    for n, key in enumerate(current.keys):
+        rank, count = _value(current.ranks[n]), _value(counts[n])
+        m = before.pop(key, None)
+        if m is None:
+            changes.append(Change(day, key, NEW, rank, None, count, None))
+            continue
+        previous_rank, previous_count = (_value(previous.ranks[m]),
+                                         _value(previous_counts[m]))
+        if (rank, count) != (previous_rank, previous_count):
+            changes.append(Change(day, key, MOVED, rank, previous_rank, count,
+                                  previous_count))
+    for key, m in sorted(before.items(), key=lambda item: item[1]):
+        changes.append(Change(day, key, DROPPED, None, _value(previous.ranks[m]),
+                              None, _value(previous_counts[m])))
+    return changes
+
+
+def _spec(list_name):
+    try:
+        return _LISTS[list_name]
+    except KeyError:
+        raise ValueError("list must be one of {0}, not {1!r}".format(
+            ', '.join(LISTS), list_name))
+
+
+def _day(date):
+    return str(dshield._to_date(date))
+
+
+class SnapshotStore(object):
+    """Daily snapshots of the top lists in a SQLite file, with the changes
+    between consecutive stored days.
+
+    The change feed of a day compares it with the closest earlier stored
+    day, and is recomputed when a day is added or replaced in between. The
+    first stored day of a list has no changes. IPv4 addresses are returned
+    in their normal form, '192.0.2.7' rather than '192.000.002.007'.
+
+    :param path: path of the SQLite database file
+    :param limit: number of entries fetched per list and day
+    """
+
+    def __init__(self, path, limit=DEFAULT_LIMIT):
+        self.path = path
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS snapshots (
+                              list TEXT NOT NULL,
+                              day TEXT NOT NULL,
+                              data BLOB NOT NULL,
+                              PRIMARY KEY (list, day))""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS changes (
+                              list TEXT NOT NULL,
+                              day TEXT NOT NULL,
+                              key NOT NULL,
+                              kind TEXT NOT NULL,
+                              rank INTEGER,
+                              previous_rank INTEGER,
+                              count INTEGER,
+                              previous_count INTEGER)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS changes_day "
+                         "ON changes (list, day)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS changes_key "
+                         "ON changes (list, key, day)")
+
+    def _load(self, list_name, day):
+        row = self._db.execute(
+            "SELECT data FROM snapshots WHERE list = ? AND day = ?",
+            (list_name, day)).fetchone()
+        return None if row is None else _Snapshot.decode(row[0])
+
+    def _neighbour(self, list_name, day, later):
+        row = self._db.execute(
+            "SELECT day FROM snapshots WHERE list = ? AND day {0} ? "
+            "ORDER BY day {1} LIMIT 1".format('>' if later else '<',
+                                              'ASC' if later else 'DESC'),
+            (list_name, day)).fetchone()
+        return None if row is None else row[0]
+
+    def _record_changes(self, list_name, day, previous_day, snapshot=None):
+        self._db.execute("DELETE FROM changes WHERE list = ? AND day = ?",
+                         (list_name, day))
+        if previous_day is None:
+            return
+        snapshot = snapshot or self._load(list_name, day)
+        changes = _diff(day, self._load(list_name, previous_day), snapshot)
+        self._db.executemany(
+            "INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(list_name,) + tuple(change) for change in changes])
+
+    def append(self, list_name, date, records=None):
+        """Store the snapshot of a list for one day, and its changes.
+
+        :param list_name: 'topports', 'topips' or 'backscatter'
+        :param date: string in 'Y-M-D' format or datetime.date()
+        :param records: optional typed records or row dicts of that day;
+                        fetched from the API by default
+        :returns: the stored records
+        :raises dshield.Error: if the API did not return a list
+        """
+        spec = _spec(list_name)
+        day = _day(date)
+        if records is None:
+            records = spec.fetch(day, self.limit)
+        if not isinstance(records, list):
+            raise dshield.Error("No {0} list for {1}: {2}".format(
+                list_name, day, records))
+        records = [spec.record_type.from_dict(record)
+                   if isinstance(record, dict) else record
+                   for record in records]
+        snapshot = _Snapshot.from_records(
+            list_name, spec, [record for record in records
+                   if isinstance(record, spec.record_type)])
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)",
+                    (list_name, day, snapshot.encode()))
+                self._record_changes(list_name, day,
+                                     self._neighbour(list_name, day, False),
+                                     snapshot)
+                following = self._neighbour(list_name, day, True)
+                if following is not None:
+                    self._record_changes(list_name, following, day)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+        return snapshot.records(spec)
+
+    def days(self, list_name, start_date=None, end_date=None):
+        """Return the stored days of a list, in order."""
+        _spec(list_name)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT day FROM snapshots WHERE list = ? AND day BETWEEN ? AND ?"
+                " ORDER BY day", (list_name,) + self._range(start_date, end_date)
+            ).fetchall()
+        return [dshield._to_date(day) for day, in rows]
+
+    def snapshot(self, list_name, date):
+        """Return the stored records of a list for one day, or None."""
+        spec = _spec(list_name)
+        with self._lock:
+            snapshot = self._load(list_name, _day(date))
+        return None if snapshot is None else snapshot.records(spec)
+
+    def snapshots(self, list_name, start_date=None, end_date=None):
+        """Yield ``(date, records)`` for each stored day in a range."""
+        spec = _spec(list_name)
+        for day, snapshot in self._decoded(list_name, start_date, end_date):
+            yield day, snapshot.records(spec)
+
+    def series(self, list_name, key, start_date=None, end_date=None):
+        """Return ``(date, record)`` for each stored day in a range on which
+        `key` (a port number or IP address) is in the list."""
+        spec = _spec(list_name)
+        key = _normal_key(list_name, key)
+        found = []
+        for day, snapshot in self._decoded(list_name, start_date, end_date):
+            position = snapshot.positions().get(key)
+            if position is not None:
+                found.append((day, snapshot.record(spec, position)))
+        return found
+
+    def _decoded(self, list_name, start_date, end_date):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT day, data FROM snapshots WHERE list = ?"
+                " AND day BETWEEN ? AND ? ORDER BY day",
+                (list_name,) + self._range(start_date, end_date)).fetchall()
+        return [(dshield._to_date(day), _Snapshot.decode(data))
+                for day, data in rows]
+
+    def changes(self, list_name, start_date=None, end_date=None, kinds=None,
+                key=None):
+        """Return the :class:`Change` records of a list over a range of
+        days, ordered by day and then as ranked on that day.
+
+        :param kinds: optional collection of NEW, DROPPED and MOVED
+        :param key: optional port number or IP address to follow
+        """
+        _spec(list_name)
+        query = ("SELECT day, key, kind, rank, previous_rank, count,"
+                 " previous_count FROM changes WHERE list = ?"
+                 " AND day BETWEEN ? AND ?")
+        parameters = [list_name] + list(self._range(start_date, end_date))
+        if key is not None:
+            query += " AND key = ?"
+            parameters.append(_normal_key(list_name, key))
+        if kinds is not None:
+            kinds = list(kinds)
+            query += " AND kind IN ({0})".format(', '.join('?' * len(kinds)))
+            parameters.extend(kinds)
+        query += " ORDER BY day, rowid"
+        with self._lock:
+            rows = self._db.execute(query, parameters).fetchall()
+        return [Change(dshield._to_date(row[0]), *row[1:]) for row in rows]
+
+    def missing(self, list_name, start_date=None, end_date=None):
+        """Return the days in a range that :meth:`sync` would fetch: those
+        not stored yet whose lists are final."""
+        start, end = dshield._date_range(start_date, end_date)
+        held = set(self.days(list_name, start, end))
+        days = (start + datetime.timedelta(days=n)
+                for n in range((end - start).days + 1))
+        return [day for day in days if day not in held and _final(day)]
+
+    def sync(self, list_names=LISTS, start_date=None, end_date=None,
+             concurrency=dshield.DEFAULT_POOL_SIZE):
+        """Fetch and append every missing day of the lists, concurrently.
+
+        :returns: a generator of ``((list_name, date), records)`` tuples in
+                  order; a failed day yields its exception as the records.
+        """
+        if isinstance(list_names, str):
+            list_names = [list_names]
+        pending = [(list_name, day) for list_name in list_names
+                   for day in self.missing(list_name, start_date, end_date)]
+        return dshield._bounded_map(lambda item: self.append(*item), pending,
+                                    concurrency, ordered=True)
+
+    def size(self):
+        """Return the total size of the stored snapshots, in bytes."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COALESCE(SUM(LENGTH(data)), 0) FROM snapshots"
+            ).fetchone()[0]
+
+    def close(self):
+        """Close the underlying database connection."""
+        with self._lock:
+            self._db.close()
+
+    @staticmethod
+    def _range(start_date, end_date):
+        start, end = dshield._date_range(start_date, end_date)
+        return str(start), str(end)
@@ -0,0 +1,168 @@
+"""Incremental decoding of large API responses."""
+
+import codecs
+import json
+
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = ' \t\n\r'
+
+
+class _JSONRecords(object):
+    """Yields the records of a JSON document read from an iterable of byte
+    chunks, without holding the whole document in memory.
+
+    Records are the elements of a top-level array. For a top-level object,
+    records are the elements of its array members and any object members
+    (e.g. ``{"0": {...}, "1": {...}}``); other members are skipped, except
+    an API error message ``{"error": "..."}``, yielded as is.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Read the next chunk into the buffer; return False at the end."""
+        if self._eof:
+            return False
+        if self._pos > CHUNK_SIZE:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        for chunk in self._chunks:
+            if chunk:
+                self._buffer += self._text.decode(chunk)
+                return True
+        self._buffer += self._text.decode(b'', final=True)
+        self._eof = True
+        return False
+
+    def _peek(self):
+        """Skip whitespace and return the next character, or '' at the end."""
+        while True:
+            while (self._pos < len(self._buffer)
+                   and self._buffer[self._pos] in _WHITESPACE):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, characters):
+        character = self._peek()
+        if character not in characters or not character:
+            raise ValueError('Expected one of {0!r} at offset {1}, got {2!r}'
+                             .format(characters, self._pos, character))
+        self._pos += 1
+        return character
+
+    def _value(self):
+        """Decode the next JSON value, reading more input until it is whole."""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # A number or literal may continue in the next chunk.
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def _array(self):
+        """Yield the elements of the array starting at the current position."""
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(',]') == ']':
+                return
+
+    def __iter__(self):
+        character = self._peek()
+        if character == '[':
+            for record in self._array():
+                yield record
+        elif character == '{':
+            self._pos += 1
+            if self._peek() == '}':
+                return
+            while True:
+                name = self._value()
+                self._expect(':')
+                if self._peek() == '[':
+                    for record in self._array():
+                        yield record
+                else:
+                    value = self._value()
+                    if isinstance(value, dict):
+                        yield value
+                    elif name == 'error':
+                        yield {'error': value}
+                if self._expect(',}') == '}':
+                    return
+        elif character:
+            yield self._value()
+
+
+def iter_json_records(chunks):
+    """Yield the records of a JSON document given as an iterable of byte
+    chunks, see :class:`_JSONRecords`."""
+    return iter(_JSONRecords(chunks))
+
+
+def iter_xml_records(chunks):
+    """Yield the records of an XML document given as an iterable of byte
+    chunks, parsed incrementally.
+
+    Records are the elements below the root whose children are all leaf
+    elements, such as each ``<data>`` of ``<sources><data><ip>...</data>
+    ...</sources>``, and are yielded as dicts of child tag to text, like the
+    JSON records of the same response. Elements are dropped from the tree
+    as soon as they are consumed, so memory stays bounded. A document without
+    records holding an API error, ``<error>...</error>`` or an ``<error>``
+    child of the root, yields ``{"error": "..."}`` as the JSON parser does.
+    """
+    from xml.etree import ElementTree  # only loaded when parsing XML
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    # Per open element: [element, has child elements, has nested children].
+    stack = []
+    for chunk in chunks:
+        if chunk:
+            parser.feed(chunk)
+            for record in _xml_records(parser, stack):
+                yield record
+    parser.close()
+    for record in _xml_records(parser, stack):
+        yield record
+
+
+def _xml_records(parser, stack):
+    for event, element in parser.read_events():
+        if event == 'start':
+            if stack:
+                stack[-1][1] = True
+            stack.append([element, False, False])
+            continue
+        _, branch, nested = stack.pop()
+        if not stack:
+            if not nested:
+                error = element if element.tag == 'error' else element.find('error')
+                if error is not None:
+                    yield {'error': error.text}
+            continue
+        if not branch:
+            continue
+        stack[-1][2] = True
+        if not nested:
+            yield dict((child.tag, child.text) for child in element)
+        stack[-1][0].remove(element)
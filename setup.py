@@ -9,11 +9,23 @@ os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 setup(
     name='dshield',
     version='0.2.1',
-    py_modules=['dshield'],
+    packages=['dshield'],
     include_package_data=True,
+    python_requires='>=3.8',
     install_requires=[
-        'requests'
+        'requests',
+        'urllib3',
     ],
+    extras_require={
+        'aio': ['aiohttp'],
+        'yaml': ['PyYAML'],
+    },
+    entry_points={
+        'console_scripts': [
+            'dshield = dshield.cli:main',
+            'dshield-enrich = dshield.enrich:main',
+        ],
+    },
     license='BSD',
     description='A Pythonic interface to the Internet Storm Center / DShield API.',
     long_description=README,
@@ -27,6 +39,8 @@ setup(
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Software Development :: Libraries',
         'Topic :: Internet',
     ],
@@ -1,8 +1,34 @@
+import asyncio
 import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import responses
 import requests
 import dshield
+import dshield.cache
+import dshield.cli
+import dshield.enrich
+import dshield.history
+import dshield.index
+import dshield.metrics
+import dshield.ratelimit
+import dshield.replay
+import dshield.snapshots
+import dshield.records
+import dshield.refresh
+import dshield.stream
+
+try:
+    from aioresponses import aioresponses
+    import dshield.aio
+except ImportError:
+    aioresponses = None
 
 # Python 2/3 compat fix.
 try:
@@ -52,6 +78,1382 @@ class TestInternals(unittest.TestCase):
         self.assertEquals(len(json), 10)
         self.assertEquals(len(dshield._get('backscatter')), 10)
 
+    @responses.activate
+    def test_get_reuses_shared_session(self):
+        responses.add(responses.GET, 'https://dshield.org/api/infocon?json',
+                      body='{"status":"green"}', status=200,
+                      match_querystring=True, content_type='text/json')
+        session = dshield._get_session()
+        dshield._get('infocon')
+        self.assertTrue(dshield._get_session() is session)
+
+    def test_configure_session(self):
+        session = requests.Session()
+        try:
+            dshield.configure_session(timeout=5, session=session)
+            self.assertTrue(dshield._get_session() is session)
+            self.assertEquals(dshield._timeout, 5)
+            dshield.close_session()
+            self.assertFalse(dshield._get_session() is session)
+        finally:
+            dshield.configure_session()
+
+
+class TestCache(unittest.TestCase):
+
+    def tearDown(self):
+        dshield.disable_cache()
+
+    def test_is_historical(self):
+        today = datetime.date(2012, 5, 10)
+        self.assertTrue(dshield.cache.is_historical('backscatter/2011-12-01', today))
+        self.assertTrue(dshield.cache.is_historical(
+            'dailysummary/2012-05-01/2012-05-03', today))
+        self.assertFalse(dshield.cache.is_historical('dailysummary/2012-05-01', today))
+        self.assertFalse(dshield.cache.is_historical('backscatter/2012-05-09', today))
+        self.assertFalse(dshield.cache.is_historical('infocon', today))
+        self.assertFalse(dshield.cache.is_historical('ip/1.2.3.4', today))
+
+    def test_ttl(self):
+        cache = dshield.cache.MemoryCache(ttls={'infocon': 60}, default_ttl=10)
+        self.assertEquals(cache.ttl('infocon'), 60)
+        self.assertEquals(cache.ttl('topports/records/10'), 10)
+        self.assertEquals(cache.ttl('backscatter/2011-12-01'), None)
+
+    def test_expiry(self):
+        cache = dshield.cache.MemoryCache(ttls={'infocon': -1})
+        cache.set(('infocon', None), 'value')
+        self.assertEquals(cache.get(('infocon', None)), None)
+        cache = dshield.cache.MemoryCache(ttls={'infocon': 0.01})
+        cache.set(('infocon', None), 'value')
+        self.assertEquals(cache.get(('infocon', None)), 'value')
+        time.sleep(0.02)
+        self.assertEquals(cache.get(('infocon', None)), None)
+
+    def test_lru_eviction(self):
+        cache = dshield.cache.MemoryCache(maxsize=2)
+        cache.set(('ip/1', None), 1)
+        cache.set(('ip/2', None), 2)
+        cache.get(('ip/1', None))
+        cache.set(('ip/3', None), 3)
+        self.assertEquals(cache.get(('ip/1', None)), 1)
+        self.assertEquals(cache.get(('ip/2', None)), None)
+        self.assertEquals(cache.info(),
+                          dshield.cache.CacheInfo(2, 1, 1, 2, 2))
+
+    def test_invalidate(self):
+        cache = dshield.cache.MemoryCache()
+        cache.set(('ip/1', None), 1)
+        cache.set(('ip/1', dshield.XML), 'xml')
+        cache.invalidate('ip/1')
+        self.assertEquals(cache.get(('ip/1', None)), None)
+        self.assertEquals(cache.get(('ip/1', dshield.XML)), 'xml')
+        cache.clear()
+        self.assertEquals(len(cache), 0)
+
+    @responses.activate
+    def test_get_uses_cache(self):
+        responses.add(responses.GET, 'https://dshield.org/api/infocon?json',
+                      body='{"status":"green"}', status=200,
+                      match_querystring=True, content_type='text/json')
+        dshield.configure_cache(maxsize=10)
+        self.assertEquals(dshield.infocon(), {'status': 'green'})
+        self.assertEquals(dshield.infocon(), {'status': 'green'})
+        self.assertEquals(dshield.infocon(dshield.JSON), '{"status":"green"}')
+        self.assertEquals(len(responses.calls), 2)
+        self.assertEquals(dshield.get_cache().info().hits, 1)
+        dshield.get_cache().invalidate('infocon')
+        dshield.infocon()
+        self.assertEquals(len(responses.calls), 3)
+
+    @responses.activate
+    def test_revalidation(self):
+        responses.add(responses.GET, 'https://dshield.org/api/infocon?json',
+                      body='{"status":"green"}', status=200,
+                      match_querystring=True, content_type='text/json',
+                      headers={'ETag': '"v1"',
+                               'Last-Modified': 'Wed, 01 Jan 2020 00:00:00 GMT'})
+        dshield.configure_cache(ttls={'infocon': 0.01})
+        events = []
+        dshield.add_hook(events.append)
+        try:
+            first = dshield.infocon()
+            time.sleep(0.02)
+            responses.replace(responses.GET, 'https://dshield.org/api/infocon?json',
+                              status=304, match_querystring=True)
+            self.assertTrue(dshield.infocon() is first)
+            self.assertTrue(dshield.infocon() is first)
+        finally:
+            dshield.remove_hook(events.append)
+        headers = responses.calls[1].request.headers
+        self.assertEquals(headers['If-None-Match'], '"v1"')
+        self.assertEquals(headers['If-Modified-Since'],
+                          'Wed, 01 Jan 2020 00:00:00 GMT')
+        self.assertEquals([event.cache for event in events],
+                          ['miss', 'revalidated', 'hit'])
+        self.assertEquals(len(responses.calls), 2)
+
+    @responses.activate
+    def test_error_responses_are_not_cached(self):
+        responses.add(responses.GET,
+                      'https://dshield.org/api/backscatter/2011-12-01?xml',
+                      body='<html>busy</html>', status=503, match_querystring=True)
+        responses.add(responses.GET,
+                      'https://dshield.org/api/backscatter/2011-12-01?xml',
+                      body='<backscatter/>', match_querystring=True)
+        dshield.configure_cache()
+        dshield.configure_retries(max_retries=0)
+        try:
+            self.assertEquals(dshield.backscatter('2011-12-01', return_format=dshield.XML),
+                              '<html>busy</html>')
+            self.assertEquals(len(dshield.get_cache()), 0)
+            self.assertEquals(dshield.backscatter('2011-12-01', return_format=dshield.XML),
+                              '<backscatter/>')
+            self.assertEquals(dshield.backscatter('2011-12-01', return_format=dshield.XML),
+                              '<backscatter/>')
+        finally:
+            dshield.configure_retries()
+        self.assertEquals(len(responses.calls), 2)
+
+    def test_stale_entries_without_validators_are_dropped(self):
+        cache = dshield.cache.MemoryCache(ttls={'infocon': 0.01})
+        cache.set(('infocon', None), 'plain')
+        cache.set(('infocon', dshield.XML), 'xml', {'If-None-Match': '"v1"'})
+        time.sleep(0.02)
+        self.assertEquals(cache.get(('infocon', None)), None)
+        self.assertEquals(cache.get(('infocon', dshield.XML)), None)
+        self.assertEquals(cache.stale(('infocon', None)), None)
+        self.assertEquals(cache.stale(('infocon', dshield.XML)),
+                          ('xml', {'If-None-Match': '"v1"'}))
+
+
+class TestDiskStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'dshield.db')
+
+    def tearDown(self):
+        dshield.disable_store()
+        shutil.rmtree(self.directory)
+
+    def test_set_get(self):
+        store = dshield.cache.DiskStore(self.path)
+        store.set('backscatter/2011-12-01', None, b'["test"]')
+        store.set('backscatter/2011-12-01', dshield.XML, '<xml/>')
+        self.assertEquals(store.get('backscatter/2011-12-01', None), b'["test"]')
+        self.assertEquals(store.get('backscatter/2011-12-01', dshield.XML), '<xml/>')
+        self.assertEquals(store.get('backscatter/2011-12-02', None), None)
+        store.close()
+        store = dshield.cache.DiskStore(self.path)
+        self.assertEquals(len(store), 2)
+        store.close()
+
+    def test_prune(self):
+        store = dshield.cache.DiskStore(self.path, max_bytes=10)
+        store.set('backscatter/2011-12-01', None, b'123456')
+        store.set('backscatter/2011-12-02', None, b'123456')
+        self.assertEquals(len(store), 1)
+        self.assertEquals(store.get('backscatter/2011-12-02', None), b'123456')
+        self.assertEquals(store.prune(0), 1)
+        store.vacuum()
+        self.assertEquals(store.size(), 0)
+        store.close()
+
+    def test_size_and_touch(self):
+        store = dshield.cache.DiskStore(self.path)
+        store.set('backscatter/2011-12-01', None, b'1234')
+        store.set('backscatter/2011-12-01', None, b'123456')
+        store.set('backscatter/2011-12-02', None, b'12')
+        self.assertEquals(store.size(), 8)
+        accessed = store._db.execute("SELECT accessed FROM responses").fetchone()[0]
+        store.get('backscatter/2011-12-01', None)
+        self.assertEquals(
+            store._db.execute("SELECT accessed FROM responses").fetchone()[0],
+            accessed)
+        store.clear()
+        self.assertEquals(store.size(), 0)
+        store.close()
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_shared_across_forked_processes(self):
+        store = dshield.cache.DiskStore(self.path)
+        store.set('backscatter/2011-12-01', None, b'["test"]')
+        pid = os.fork()
+        if pid == 0:
+            try:
+                found = store.get('backscatter/2011-12-01', None)
+                store.set('backscatter/2011-12-02', None, b'[]')
+                os._exit(0 if found == b'["test"]' and store._db is not None
+                         and store._pid == os.getpid() else 1)
+            except BaseException:
+                os._exit(2)
+        _, status = os.waitpid(pid, 0)
+        self.assertEquals(status, 0)
+        self.assertEquals(store.get('backscatter/2011-12-02', None), b'[]')
+        self.assertEquals(store.size(), 10)
+        store.close()
+
+    @responses.activate
+    def test_get_uses_store_for_historical_queries(self):
+        responses.add(responses.GET,
+                      'https://dshield.org/api/backscatter/2011-12-01?json',
+                      body='["2011-12-01"]', status=200, match_querystring=True,
+                      content_type='text/json')
+        responses.add(responses.GET, 'https://dshield.org/api/backscatter?json',
+                      body='["test"]', status=200,
+                      match_querystring=True, content_type='text/json')
+        dshield.configure_store(self.path)
+        self.assertEquals(dshield.backscatter('2011-12-01'), ['2011-12-01'])
+        self.assertEquals(dshield.backscatter('2011-12-01'), ['2011-12-01'])
+        self.assertEquals(len(responses.calls), 1)
+        dshield.backscatter()
+        dshield.backscatter()
+        self.assertEquals(len(responses.calls), 3)
+        self.assertEquals(len(dshield.get_store()), 1)
+
+
+class TestSharedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.db')
+
+    def tearDown(self):
+        dshield.disable_cache()
+        shutil.rmtree(self.directory)
+
+    def test_set_get(self):
+        cache = dshield.cache.SharedCache(self.path, maxsize=2,
+                                          ttls={'infocon': 0.01})
+        cache.set(('ip/1.2.3.4', None), {'ip': {'count': '1'}})
+        cache.set(('ip/1.2.3.4', dshield.XML), '<ip/>')
+        self.assertEquals(cache.get(('ip/1.2.3.4', None)), {'ip': {'count': '1'}})
+        self.assertEquals(cache.get(('ip/1.2.3.4', dshield.XML)), '<ip/>')
+        cache.set(('infocon', None), {'status': 'green'}, {'If-None-Match': '"a"'})
+        self.assertEquals(len(cache), 2)
+        time.sleep(0.02)
+        self.assertEquals(cache.get(('infocon', None)), None)
+        self.assertEquals(cache.stale(('infocon', None)),
+                          ({'status': 'green'}, {'If-None-Match': '"a"'}))
+        self.assertEquals(cache.stale(('ip/1.2.3.4', dshield.XML)), None)
+        cache.invalidate('infocon')
+        self.assertEquals(cache.stale(('infocon', None)), None)
+        info = cache.info()
+        self.assertEquals((info.hits, info.misses, info.evictions, info.size),
+                          (2, 1, 1, 1))
+        cache.close()
+        cache = dshield.cache.SharedCache(self.path)
+        self.assertEquals(len(cache), 1)
+        cache.clear()
+        self.assertEquals(len(cache), 0)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_shared_across_forked_processes(self):
+        cache = dshield.cache.SharedCache(self.path)
+        cache.set(('topports/records/10', None), [{'rank': '1'}])
+        pid = os.fork()
+        if pid == 0:
+            try:
+                found = cache.get(('topports/records/10', None))
+                cache.set(('ip/1.2.3.4', None), {'ip': {}})
+                os._exit(0 if found == [{'rank': '1'}] else 1)
+            except BaseException:
+                os._exit(2)
+        _, status = os.waitpid(pid, 0)
+        self.assertEquals(status, 0)
+        self.assertEquals(cache.get(('ip/1.2.3.4', None)), {'ip': {}})
+
+    @responses.activate
+    def test_get_through_shared_cache(self):
+        responses.add(responses.GET, 'https://dshield.org/api/infocon?json',
+                      body='{"status":"green"}', match_querystring=True)
+        dshield.configure_cache(path=self.path)
+        self.assertEquals(dshield.infocon(), {'status': 'green'})
+        other = dshield.cache.SharedCache(self.path)
+        self.assertEquals(other.get(('infocon', None)), {'status': 'green'})
+        self.assertEquals(dshield.infocon(), {'status': 'green'})
+        self.assertEquals(len(responses.calls), 1)
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'responses.gz')
+
+    def tearDown(self):
+        dshield.disable_archive()
+        shutil.rmtree(self.directory)
+
+    def test_add_get(self):
+        archive = dshield.replay.Archive(self.path, dshield.RECORD)
+        archive.add('infocon?json', 200, b'{"status":"green"}')
+        archive.add('infocon?xml', 200, b'<status>gr\xfcn</status>', 'latin-1')
+        archive.close()
+        archive = dshield.replay.Archive(self.path)
+        self.assertEquals(len(archive), 2)
+        self.assertEquals(archive.get('infocon?json').content, b'{"status":"green"}')
+        self.assertEquals(archive.get('infocon?xml').text, u'<status>gr\xfcn</status>')
+        self.assertRaises(dshield.ReplayMiss, archive.get, 'handler?json')
+        self.assertRaises(ValueError, archive.add, 'handler?json', 200, b'{}')
+
+    def test_truncated_archive(self):
+        archive = dshield.replay.Archive(self.path, dshield.RECORD)
+        archive.add('infocon?json', 200, b'{"status":"green"}')
+        archive.add('handler?json', 200, b'{"name":"test"}')
+        archive._file.flush()  # left open, as if the process died
+        self.assertEquals(len(dshield.replay.Archive(self.path)), 2)
+        archive.close()
+
+    def test_record_after_truncation(self):
+        archive = dshield.replay.Archive(self.path, dshield.RECORD)
+        for n in range(200):
+            archive.add('ip/10.0.0.{0}?json'.format(n), 200,
+                        json.dumps({'ip': {'number': n}}).encode('utf-8'))
+        archive.close()
+        with open(self.path, 'rb+') as f:
+            f.truncate(os.path.getsize(self.path) // 2)
+        archive = dshield.replay.Archive(self.path, dshield.RECORD)
+        kept = len(archive)
+        archive.add('infocon?json', 200, b'{"status":"green"}')
+        archive.close()
+        archive = dshield.replay.Archive(self.path)
+        self.assertEquals(len(archive), kept + 1)
+        self.assertEquals(archive.get('infocon?json').content, b'{"status":"green"}')
+        with open(self.path, 'rb+') as f:
+            f.seek(os.path.getsize(self.path) // 2)
+            f.write(b'\xff' * 64)
+        self.assertTrue(len(dshield.replay.Archive(self.path)) < kept + 1)
+
+    @responses.activate
+    def test_record_then_replay(self):
+        responses.add(responses.GET, 'https://dshield.org/api/infocon?json',
+                      body='{"status":"green"}', match_querystring=True,
+                      content_type='text/json')
+        responses.add(responses.GET, 'https://dshield.org/api/sources/attacks/2?json',
+                      body='[{"ip":"1.2.3.4"},{"ip":"5.6.7.8"}]',
+                      match_querystring=True, content_type='text/json')
+        dshield.configure_archive(self.path, dshield.RECORD)
+        dshield.infocon()
+        dshield.sources(limit=2)
+        dshield.configure_archive(self.path, dshield.REPLAY)
+        self.assertEquals(dshield.infocon(), {'status': 'green'})
+        self.assertEquals(dshield.infocon(dshield.JSON), '{"status":"green"}')
+        self.assertEquals([row['ip'] for row in dshield.iter_sources(limit=2)],
+                          ['1.2.3.4', '5.6.7.8'])
+        self.assertEquals(len(responses.calls), 2)
+        self.assertRaises(dshield.ReplayMiss, dshield.handler)
+        self.assertRaises(dshield.ReplayMiss, list, dshield.ip_many(['8.8.8.8']))
+
+
+class TestPortHistoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = dshield.history.PortHistoryStore(
+            os.path.join(self.directory, 'history.db'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    @responses.activate
+    def test_only_missing_days_requested(self):
+        responses.add(responses.GET,
+                      'https://dshield.org/api/porthistory/80/2011-07-20/2011-07-22?json',
+                      body='{"porthistory":[{"date":"2011-07-20","records":"1"},'
+                           '{"date":"2011-07-22","records":"3"}]}',
+                      match_querystring=True, content_type='text/json')
+        responses.add(responses.GET,
+                      'https://dshield.org/api/porthistory/80/2011-07-23/2011-07-23?json',
+                      body='{"porthistory":[{"date":"2011-07-23","records":"4"}]}',
+                      match_querystring=True, content_type='text/json')
+        data = self.store.porthistory(80, '2011-07-20', '2011-07-22')
+        self.assertEquals([row['records'] for row in data], ['1', '3'])
+        self.assertEquals(self.store.missing(80, '2011-07-20', '2011-07-23'),
+                          [(datetime.date(2011, 7, 23), datetime.date(2011, 7, 23))])
+        data = self.store.porthistory(80, '2011-07-20', '2011-07-23')
+        self.assertEquals([row['records'] for row in data], ['1', '3', '4'])
+        self.assertEquals(len(responses.calls), 2)
+        results = list(self.store.sync([80, 80], '2011-07-21', '2011-07-23'))
+        self.assertEquals(results, [(80, [{'date': '2011-07-22', 'records': '3'},
+                                          {'date': '2011-07-23', 'records': '4'}])])
+        self.assertEquals(len(responses.calls), 2)
+
+    def test_bad_ranges(self):
+        self.assertRaises(dshield.Error, self.store.porthistory, 22,
+                          '2012-03-05', '2012-03-01')
+        self.assertRaises(dshield.Error, self.store.missing, 22, '2012-13-01')
+
+
+class TestSnapshotStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = dshield.snapshots.SnapshotStore(
+            os.path.join(self.directory, 'snapshots.db'), limit=3)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_bad_ranges(self):
+        self.assertRaises(dshield.Error, self.store.days, 'topips',
+                          '2012-03-05', '2012-03-01')
+        self.assertRaises(dshield.Error, self.store.missing, 'topips', 'yesterday')
+
+    def test_encoding_round_trip(self):
+        out = bytearray()
+        numbers = [0, 5, -3, 2 ** 40, -1, 127, 128]
+        dshield.snapshots._pack(numbers, out)
+        self.assertEquals(dshield.snapshots._unpack(bytes(out), 0, len(numbers)),
+                          (numbers, len(out)))
+
+    @responses.activate
+    def test_changes(self):
+        for day, body in [
+                ('2012-05-01', '[{"rank":"1","targetport":"22","records":"90"},'
+                               '{"rank":"2","targetport":"23","records":"80"},'
+                               '{"rank":"3","targetport":"80","records":"70"}]'),
+                ('2012-05-03', '[{"rank":"1","targetport":"23","records":"95"},'
+                               '{"rank":"2","targetport":"22","records":"90"},'
+                               '{"rank":"3","targetport":"445","records":"60"}]')]:
+            responses.add(responses.GET,
+                          'https://dshield.org/api/topports/records/3/{0}?json'.format(day),
+                          body=body, match_querystring=True)
+        self.store.append('topports', '2012-05-01')
+        self.store.append('topports', datetime.date(2012, 5, 3))
+        self.assertEquals(len(responses.calls), 2)
+        day = datetime.date(2012, 5, 3)
+        Change = dshield.snapshots.Change
+        self.assertEquals(self.store.changes('topports', '2012-05-01', '2012-05-03'), [
+            Change(day, 23, 'moved', 1, 2, 95, 80),
+            Change(day, 22, 'moved', 2, 1, 90, 90),
+            Change(day, 445, 'new', 3, None, 60, None),
+            Change(day, 80, 'dropped', None, 3, None, 70)])
+        self.assertEquals(
+            [c.key for c in self.store.changes('topports', '2012-05-01', '2012-05-03',
+                                               kinds=[dshield.snapshots.NEW])],
+            [445])
+        self.assertEquals(self.store.snapshot('topports', '2012-05-03')[0],
+                          dshield.records.TopPort(1, 23, 95, None, None))
+        self.assertEquals(self.store.snapshot('topports', '2012-05-02'), None)
+        # A day stored in between is diffed against, and the next day again.
+        self.store.append('topports', '2012-05-02', [
+            {'rank': '1', 'targetport': '23', 'records': '95'},
+            {'rank': '2', 'targetport': '22', 'records': '90'},
+            {'rank': '3', 'targetport': '80', 'records': '70'}])
+        changes = self.store.changes('topports', '2012-05-03', '2012-05-03')
+        self.assertEquals([(c.key, c.kind) for c in changes],
+                          [(445, 'new'), (80, 'dropped')])
+        self.assertEquals(len(self.store.changes('topports', '2012-05-01',
+                                                 '2012-05-03', key='22')), 1)
+        self.assertEquals([(day.day, record.rank) for day, record in
+                           self.store.series('topports', 80, '2012-05-01',
+                                             '2012-05-03')],
+                          [(1, 3), (2, 3)])
+        self.assertEquals(self.store.days('topports', '2012-05-01', '2012-05-31'),
+                          [datetime.date(2012, 5, n) for n in (1, 2, 3)])
+
+    def test_ip_keys(self):
+        self.store.append('topips', '2012-05-01', [
+            {'rank': '1', 'source': '001.002.003.004', 'reports': '9'},
+            {'rank': '2', 'source': '2001:db8::1', 'reports': '5'}])
+        self.store.append('topips', '2012-05-02', [
+            {'rank': '1', 'source': '1.2.3.4', 'reports': '12'}])
+        self.assertEquals([(c.key, c.kind) for c in
+                           self.store.changes('topips', '2012-05-01', '2012-05-02')],
+                          [('1.2.3.4', 'moved'), ('2001:db8::1', 'dropped')])
+        self.assertEquals(len(self.store.series('topips', '001.002.003.004',
+                                                '2012-05-01', '2012-05-02')), 2)
+
+    @responses.activate
+    def test_sync(self):
+        responses.add(responses.GET,
+                      'https://dshield.org/api/backscatter/2012-05-01/3?json',
+                      body='[{"sourceport":"80","count":"5"}]', match_querystring=True)
+        responses.add(responses.GET,
+                      'https://dshield.org/api/backscatter/2012-05-02/3?json',
+                      body='{"error":"no data"}', match_querystring=True)
+        results = dict(self.store.sync('backscatter', '2012-05-01', '2012-05-02'))
+        self.assertEquals(results[('backscatter', datetime.date(2012, 5, 1))],
+                          [dshield.records.Backscatter(80, 5, None, None)])
+        self.assertTrue(isinstance(results[('backscatter', datetime.date(2012, 5, 2))],
+                                   dshield.Error))
+        self.assertEquals(self.store.missing('backscatter', '2012-05-01',
+                                             '2012-05-02'),
+                          [datetime.date(2012, 5, 2)])
+
+
+class TestReputationIndex(unittest.TestCase):
+
+    def test_background_errors(self):
+        index = dshield.index.ReputationIndex()
+        stop = threading.Event()
+
+        def refresh():
+            stop.set()
+            raise dshield.ReplayMiss('sources/attacks/10000?json')
+        index.refresh = refresh
+        index._run(stop, 0)
+        self.assertTrue(isinstance(index.error, dshield.ReplayMiss))
+
+    @responses.activate
+    def test_index(self):
+        responses.add(responses.GET, 'https://dshield.org/api/sources/attacks/3?json',
+                      body=json.dumps([
+                          {'ip': '010.000.000.005', 'attacks': '5', 'count': '50',
+                           'firstseen': '2012-03-01', 'lastseen': '2012-03-08'},
+                          {'ip': '10.0.0.1', 'attacks': '1', 'count': '10'},
+                          {'ip': '2001:db8::1', 'attacks': '6', 'count': '60'}]),
+                      match_querystring=True, content_type='text/json')
+        responses.add(responses.GET, 'https://dshield.org/api/topips/records/2?json',
+                      body=json.dumps([
+                          {'rank': '1', 'source': '10.0.0.1', 'reports': '99',
+                           'targets': '9'},
+                          {'rank': '2', 'source': '192.0.2.7', 'reports': '88',
+                           'targets': '8'}]),
+                      match_querystring=True, content_type='text/json')
+        responses.add(responses.GET, 'https://dshield.org/api/ip/10.0.0.9?json',
+                      body='{"ip":{"number":"10.0.0.9","count":"3","attacks":"2",'
+                           '"mindate":"2012-01-01","maxdate":"2012-01-02"}}',
+                      match_querystring=True, content_type='text/json')
+        index = dshield.index.ReputationIndex(limit=3, topips_limit=2)
+        self.assertEquals(len(index), 0)
+        index.refresh()
+        self.assertEquals(len(index), 4)
+        self.assertTrue(index.loaded is not None)
+        entry = index.get('10.0.0.1')
+        self.assertEquals((entry.attacks, entry.rank, entry.reports), (1, 1, 99))
+        self.assertEquals(index.get('10.0.0.5').firstseen, datetime.date(2012, 3, 1))
+        self.assertEquals(index.get('192.0.2.7').attacks, None)
+        self.assertEquals(index.get('2001:db8:0::1').count, 60)
+        self.assertEquals(index.get('not an ip'), None)
+        self.assertEquals([e.ip for e in index.network('10.0.0.0/29')],
+                          ['10.0.0.1', '10.0.0.5'])
+        self.assertEquals(index.network('10.0.1.0/24'), [])
+        self.assertTrue(index.lookup('10.0.0.1') is entry)
+        self.assertEquals(len(responses.calls), 2)
+        missed = index.lookup('10.0.0.9')
+        self.assertEquals((missed.ip, missed.attacks, missed.indexed),
+                          ('10.0.0.9', 2, False))
+        self.assertEquals(len(responses.calls), 3)
+        results = dict(index.lookup_many(['10.0.0.9', '10.0.0.1', '10.0.0.9']))
+        self.assertEquals(sorted(results), ['10.0.0.1', '10.0.0.9'])
+        self.assertTrue(results['10.0.0.1'].indexed)
+
+
+class TestRefresher(unittest.TestCase):
+
+    def tearDown(self):
+        dshield.disable_refresher()
+
+    def test_query_key(self):
+        self.assertEquals(dshield.refresh.query_key('infocon'), ('infocon', None))
+        self.assertEquals(dshield.refresh.query_key('topports', limit=5),
+                          ('topports/records/5', None))
+        self.assertEquals(
+            dshield.refresh.query_key('ip', '8.8.8.8', return_format=dshield.XML),
+            ('ip/8.8.8.8', dshield.XML))
+        self.assertEquals(
+            dshield.refresh.query_key('sources', return_format=dshield.TYPED),
+            ('sources/attacks/10', None))
+        self.assertRaises(ValueError, dshield.refresh.query_key, 'ip_many', [])
+        self.assertEquals(
+            dshield.refresh.query_key('porthistory', 80, '2012-05-01', '2012-05-03'),
+            ('porthistory/80/2012-05-01/2012-05-03', None))
+        self.assertRaises(ValueError, dshield.refresh.query_key, 'porthistory', 80)
+        self.assertRaises(ValueError, dshield.refresh.query_key, 'dailysummary',
+                          '2012-01-01', '2012-03-01')
+
+    def test_unexpected_errors_are_recorded(self):
+        refresher = dshield.refresh.Refresher(interval=60)
+        key = refresher.add('infocon')
+        fetch = dshield._fetch
+
+        def failing_fetch(*args):
+            raise dshield.ReplayMiss('infocon?json is not in the archive')
+        dshield._fetch = failing_fetch
+        try:
+            refresher.refresh()
+            self.assertEquals(refresher.get(key, 'missing'), 'missing')
+            self.assertTrue(isinstance(refresher.status()[key][1],
+                                       dshield.ReplayMiss))
+            entry = refresher._entries[key]
+            self.assertFalse(entry.refreshing)
+            entry.due = 0
+            dshield._fetch = lambda *args: ({'status': 'green'}, None, True)
+            refresher.refresh()
+        finally:
+            dshield._fetch = fetch
+        self.assertEquals(refresher.get(key), {'status': 'green'})
+        self.assertEquals(refresher.status()[key][1], None)
+
+    @responses.activate
+    def test_serves_last_good_value(self):
+        responses.add(responses.GET, 'https://dshield.org/api/infocon?json',
+                      body='{"status":"green"}', match_querystring=True)
+        responses.add(responses.GET, 'https://dshield.org/api/infocon?json',
+                      status=500, match_querystring=True)
+        refresher = dshield.refresh.Refresher(interval=60)
+        key = refresher.add('infocon')
+        self.assertTrue(key in refresher)
+        dshield.configure_refresher(refresher)
+        refresher.refresh()
+        self.assertEquals(len(responses.calls), 1)
+        for _ in range(3):
+            self.assertEquals(dshield.infocon(), {'status': 'green'})
+        self.assertEquals(len(responses.calls), 1)
+        # A failed refresh keeps the last good value.
+        dshield.configure_retries(max_retries=0)
+        try:
+            refresher.refresh()
+        finally:
+            dshield.configure_retries()
+        updated, error = refresher.status()[key]
+        self.assertTrue(updated is not None)
+        self.assertTrue(isinstance(error, (dshield.Error, ValueError)))
+        self.assertEquals(dshield.infocon(), {'status': 'green'})
+
+    @responses.activate
+    def test_stale_while_revalidate(self):
+        responses.add(responses.GET, 'https://dshield.org/api/handler?json',
+                      body='{"name":"old"}', match_querystring=True)
+        responses.add(responses.GET, 'https://dshield.org/api/handler?json',
+                      body='{"name":"new"}', match_querystring=True)
+        refresher = dshield.refresh.Refresher(interval=0.01)
+        refresher.add('handler')
+        dshield.configure_refresher(refresher)
+        refresher.start()
+        deadline = time.time() + 5
+        while dshield.handler() != {'name': 'new'} and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(dshield.handler(), {'name': 'new'})
+        dshield.disable_refresher()
+        self.assertEquals(dshield.get_refresher(), None)
+
+    @responses.activate
+    def test_overdue_read_does_not_block(self):
+        responses.add(responses.GET, 'https://dshield.org/api/topports/records/10?json',
+                      body='[{"rank":"1"}]', match_querystring=True)
+        refresher = dshield.refresh.Refresher(interval=60)
+        key = refresher.add('topports', interval=0.01)
+        refresher.refresh()
+        time.sleep(0.02)
+        gate = threading.Event()
+        fetch = dshield._fetch
+
+        def slow_fetch(*args):
+            gate.wait(5)
+            return fetch(*args)
+        dshield._fetch = slow_fetch
+        try:
+            dshield.configure_refresher(refresher)
+            start = time.time()
+            self.assertEquals(dshield.topports(return_format=dshield.TYPED)[0].rank, 1)
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            gate.set()
+            refresher.stop()
+            dshield._fetch = fetch
+        self.assertEquals(len(responses.calls), 2)
+        self.assertEquals(refresher.status()[key][1], None)
+
+
+class TestEnrich(unittest.TestCase):
+
+    def test_extract(self):
+        self.assertEquals(dshield.enrich.extract(
+            'DROP 10.0.0.1:80 -> [2001:DB8::1]:443 at 12:34:56 from 10.0.0.1.'),
+            ['10.0.0.1', '2001:db8::1'])
+        self.assertEquals(dshield.enrich.extract('v1.2.3.4.5 999.1.1.1 ::'), [])
+        self.assertEquals(dshield.enrich.extract(
+            'Accepted from ::ffff:192.0.2.7 port 22, then ::FFFF:C000:208 and '
+            '64:ff9b::10.0.0.1'),
+            ['192.0.2.7', '192.0.2.8', '64:ff9b::a00:1'])
+
+    def test_enrich(self):
+        calls = []
+
+        def lookup(address):
+            calls.append(address)
+            if address == '10.0.0.3':
+                raise dshield.Error('Bad IP address')
+            if address == '10.0.0.4':
+                raise ValueError('Expecting value')
+            time.sleep(0.01 if address == '10.0.0.1' else 0)
+            return {'ip': {'number': address}}
+        lines = ['a 10.0.0.1\n', 'no address\n', 'b 10.0.0.2 10.0.0.1\n',
+                 'c 10.0.0.3\n', 'd 10.0.0.2\n', 'e 10.0.0.1\n']
+        results = list(dshield.enrich.enrich(lines, concurrency=4, window=2,
+                                             lookahead=2, lookup=lookup))
+        self.assertEquals([result['line'][0] for result in results],
+                          ['a', 'b', 'c', 'd', 'e'])
+        self.assertEquals(results[1]['ips'], {'10.0.0.2': {'number': '10.0.0.2'},
+                                              '10.0.0.1': {'number': '10.0.0.1'}})
+        self.assertEquals(results[2]['ips'], {'10.0.0.3': {'error': 'Bad IP address'}})
+        # The window remembers two addresses: 10.0.0.1 is reused for line b,
+        # but 10.0.0.2 and 10.0.0.1 have dropped out by lines d and e.
+        self.assertEquals(sorted(calls), ['10.0.0.1', '10.0.0.1', '10.0.0.2',
+                                          '10.0.0.2', '10.0.0.3'])
+        del calls[:]
+        self.assertEquals(len(list(dshield.enrich.enrich(
+            lines, lookup=lookup, all_lines=True))), 6)
+        self.assertEquals(sorted(calls), ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        self.assertEquals(list(dshield.enrich.enrich(['f 10.0.0.4\n'], lookup=lookup)),
+                          [{'line': 'f 10.0.0.4',
+                            'ips': {'10.0.0.4': {'error': 'Expecting value'}}}])
+
+    @responses.activate
+    def test_main(self):
+        responses.add(responses.GET, 'https://dshield.org/api/ip/10.0.0.1?json',
+                      body='{"ip":{"number":"10.0.0.1","count":"3"}}',
+                      match_querystring=True, content_type='text/json')
+        directory = tempfile.mkdtemp()
+        try:
+            log = os.path.join(directory, 'firewall.log')
+            output = os.path.join(directory, 'out.jsonl')
+            with open(log, 'w') as f:
+                f.write('x 10.0.0.1\ny 10.0.0.1\n')
+            self.assertEquals(dshield.enrich.main([log, '-o', output]), 0)
+            with open(output) as f:
+                lines = [json.loads(line) for line in f]
+        finally:
+            shutil.rmtree(directory)
+            dshield.disable_cache()
+            dshield.configure_session()
+        self.assertEquals(lines, [
+            {'line': 'x 10.0.0.1', 'ips': {'10.0.0.1': {'number': '10.0.0.1',
+                                                       'count': '3'}}},
+            {'line': 'y 10.0.0.1', 'ips': {'10.0.0.1': {'number': '10.0.0.1',
+                                                       'count': '3'}}}])
+        self.assertEquals(len(responses.calls), 1)
+
+
+class TestCLI(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        dshield.disable_cache()
+        dshield.configure_session()
+
+    def path(self, name, content=None):
+        path = os.path.join(self.directory, name)
+        if content is not None:
+            with open(path, 'w') as f:
+                f.write(content)
+        return path
+
+    def test_parse_arguments(self):
+        self.assertEquals(dshield.cli.parse_arguments('topports', ['records', 'limit=5']),
+                          {'function': 'topports', 'args': {'limit': '5'},
+                           'positional': ['records']})
+        self.assertRaises(ValueError, dshield.cli.parse_arguments, 'nope', [])
+
+    def test_load_manifest(self):
+        path = self.path('manifest.json', json.dumps({'concurrency': 4, 'queries': [
+            {'function': 'topports', 'args': {'limit': 5},
+             'expand': {'date': ['2012-05-01', '2012-05-02']}},
+            {'function': 'infocon'}]}))
+        queries, concurrency = dshield.cli.load_manifest(path)
+        self.assertEquals(concurrency, 4)
+        self.assertEquals(queries, [
+            {'function': 'topports', 'args': {'limit': 5, 'date': '2012-05-01'}},
+            {'function': 'topports', 'args': {'limit': 5, 'date': '2012-05-02'}},
+            {'function': 'infocon', 'args': {}}])
+        self.assertRaises(ValueError, dshield.cli.load_manifest,
+                          self.path('bad.json', '[{"args": {}}]'))
+
+    @responses.activate
+    def test_single_query(self):
+        responses.add(responses.GET, 'https://dshield.org/api/topports/records/2?json',
+                      body='{"limit":2,"0":{"rank":1,"targetport":22},'
+                           '"1":{"rank":2,"targetport":80}}',
+                      match_querystring=True, content_type='text/json')
+        output = self.path('out.csv')
+        self.assertEquals(dshield.cli.main(['topports', 'records', 'limit=2',
+                                            '-f', 'csv', '-o', output]), 0)
+        with open(output) as f:
+            self.assertEquals(f.read(), 'rank,targetport\n1,22\n2,80\n')
+
+    @responses.activate
+    def test_typed_results(self):
+        responses.add(responses.GET, 'https://dshield.org/api/sources/attacks/2?json',
+                      body='[{"ip":"1.2.3.4","attacks":"5","firstseen":"2012-05-01"},'
+                           '{"ip":"5.6.7.8","attacks":"3"}]',
+                      match_querystring=True, content_type='text/json')
+        output = self.path('out.json')
+        self.assertEquals(dshield.cli.main(['sources', 'attacks', '2',
+                                            'return_format=typed', '-o', output]), 0)
+        with open(output) as f:
+            self.assertEquals(json.load(f)[0],
+                              {'ip': '1.2.3.4', 'attacks': 5, 'count': None,
+                               'firstseen': '2012-05-01', 'lastseen': None})
+        self.assertEquals(dshield.cli.main(['sources', 'attacks', '2',
+                                            'return_format=columnar', '-o', output]), 0)
+        with open(output) as f:
+            columns = json.load(f)
+        self.assertEquals((columns['ip'], columns['attacks'], columns['firstseen']),
+                          (['1.2.3.4', '5.6.7.8'], [5, 3], ['2012-05-01', None]))
+        for return_format in ('typed', 'columnar'):
+            output = self.path('out.csv')
+            self.assertEquals(dshield.cli.main(['sources', 'attacks', '2',
+                                                'return_format=' + return_format,
+                                                '-f', 'csv', '-o', output]), 0)
+            with open(output) as f:
+                self.assertEquals(f.read().splitlines(), [
+                    'ip,attacks,count,firstseen,lastseen',
+                    '1.2.3.4,5,,2012-05-01,', '5.6.7.8,3,,,'])
+
+    @responses.activate
+    def test_run_manifest(self):
+        for port in ('22', '80'):
+            responses.add(responses.GET,
+                          'https://dshield.org/api/port/{0}?json'.format(port),
+                          body='{"number":"%s","data":{"records":"1"}}' % port,
+                          match_querystring=True, content_type='text/json')
+        responses.add(responses.GET, 'https://dshield.org/api/port/x?json',
+                      body='{"error":"bad port number"}',
+                      match_querystring=True, content_type='text/json')
+        manifest = self.path('manifest.json', json.dumps(
+            [{'function': 'port', 'expand': {'port_number': [22, 80, 'x']}}]))
+        output = self.path('out.jsonl')
+        self.assertEquals(dshield.cli.main(['run', manifest, '-f', 'jsonl',
+                                            '-o', output]), 1)
+        with open(output) as f:
+            self.assertEquals([json.loads(line) for line in f], [
+                {'function': 'port', 'port_number': 22, 'number': '22',
+                 'data.records': '1'},
+                {'function': 'port', 'port_number': 80, 'number': '80',
+                 'data.records': '1'},
+                {'function': 'port', 'port_number': 'x',
+                 'error': 'Bad port number, x'}])
+
+    @responses.activate
+    def test_run_manifest_failures(self):
+        responses.add(responses.GET, 'https://dshield.org/api/infocon?json',
+                      body='<html>Service Unavailable</html>', status=503,
+                      match_querystring=True, content_type='text/html')
+        responses.add(responses.GET, 'https://dshield.org/api/handler?json',
+                      body=RuntimeError('boom'), match_querystring=True)
+        responses.add(responses.GET, 'https://dshield.org/api/port/22?json',
+                      body='{"number":"22"}', match_querystring=True,
+                      content_type='text/json')
+        manifest = self.path('manifest.json', json.dumps(
+            [{'function': 'infocon'}, {'function': 'handler'},
+             {'function': 'port', 'args': {'port_number': 22}}]))
+        output = self.path('out.jsonl')
+        dshield.configure_retries(max_retries=0)
+        try:
+            self.assertEquals(dshield.cli.main(['run', manifest, '-f', 'jsonl',
+                                                '-o', output]), 1)
+        finally:
+            dshield.configure_retries()
+        with open(output) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEquals([sorted(row) for row in rows],
+                          [['error', 'function'], ['error', 'function'],
+                           ['function', 'number', 'port_number']])
+        self.assertEquals(rows[1]['error'], 'handler: boom')
+
+
+class TestStreaming(unittest.TestCase):
+
+    def records(self, text, size):
+        data = text.encode('utf-8')
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        return list(dshield.stream.iter_json_records(chunks))
+
+    def test_array(self):
+        text = ' [{"ip":"1.2.3.4","count":"12"}, {"ip":"\u00e9é","count":12345},'\
+               ' [1, 2], 67890, "x"] '
+        expected = json.loads(text)
+        for size in range(1, len(text) + 1):
+            self.assertEquals(self.records(text, size), expected)
+
+    def test_object(self):
+        text = '{"limit":2,"0":{"rank":1},"1":{"rank":2},"rows":[{"rank":3}]}'
+        for size in (1, 7, 100):
+            self.assertEquals(self.records(text, size),
+                              [{'rank': 1}, {'rank': 2}, {'rank': 3}])
+
+    def test_empty_and_truncated(self):
+        self.assertEquals(self.records('[]', 1), [])
+        self.assertEquals(self.records('{}', 1), [])
+        self.assertEquals(self.records('{"limit": 1, "error": "x"}', 1),
+                          [{'error': 'x'}])
+        self.assertRaises(ValueError, self.records, '[{"a":1}, {"b"', 3)
+
+    @responses.activate
+    def test_iter_functions(self):
+        body = json.dumps([{'ip': str(n)} for n in range(1000)])
+        responses.add(responses.GET, 'https://dshield.org/api/sources/ip/1000?json',
+                      body=body, match_querystring=True, content_type='text/json')
+        responses.add(responses.GET, 'https://dshield.org/api/asnum/10/1000?json',
+                      body=body, match_querystring=True, content_type='text/json')
+        responses.add(responses.GET,
+                      'https://dshield.org/api/daily404detail/2012-02-23/1000?json',
+                      body=body, match_querystring=True, content_type='text/json')
+        expected = json.loads(body)
+        self.assertEquals(list(dshield.iter_sources('ip', 1000)), expected)
+        self.assertEquals(list(dshield.iter_asnum(10, 1000)), expected)
+        self.assertEquals(list(dshield.iter_daily404detail('2012-02-23', 1000)),
+                          expected)
+
+    @responses.activate
+    def test_iter_errors(self):
+        responses.add(responses.GET, 'https://dshield.org/api/sources/ip/10?json',
+                      body='[{"ip": "1.2.3.4"}]', status=503,
+                      match_querystring=True, content_type='text/json')
+        responses.add(responses.GET, 'https://dshield.org/api/asnum/1/10?json',
+                      body='{"asnum": {"error": "no such AS"}}',
+                      match_querystring=True, content_type='text/json')
+        responses.add(responses.GET, 'https://dshield.org/api/asnum/2/10?json',
+                      body='{"error": "bad request"}',
+                      match_querystring=True, content_type='text/json')
+        self.assertRaises(dshield.Error, list, dshield.iter_sources('ip', 10))
+        self.assertRaises(dshield.Error, list, dshield.iter_asnum(1, 10))
+        self.assertRaises(dshield.Error, list, dshield.iter_asnum(1, 10, typed=True))
+        self.assertRaises(dshield.Error, list, dshield.iter_asnum(2, 10))
+
+    def test_xml(self):
+        text = ('<?xml version="1.0" encoding="UTF-8"?>\n<sources><limit>2</limit>'
+                '<data><ip>1.2.3.4</ip><attacks>5</attacks><lastseen/></data>'
+                '<data><ip>5.6.7.8</ip><attacks>6</attacks><lastseen/></data>'
+                '<more><row><ip>9.9.9.9</ip></row></more></sources>')
+        expected = [{'ip': '1.2.3.4', 'attacks': '5', 'lastseen': None},
+                    {'ip': '5.6.7.8', 'attacks': '6', 'lastseen': None},
+                    {'ip': '9.9.9.9'}]
+        data = text.encode('utf-8')
+        for size in (1, 7, 1000):
+            chunks = [data[n:n + size] for n in range(0, len(data), size)]
+            self.assertEquals(list(dshield.stream.iter_xml_records(chunks)),
+                              expected)
+        self.assertEquals(list(dshield.stream.iter_xml_records([b'<a/>'])), [])
+        self.assertEquals(list(dshield.stream.iter_xml_records([b'<error>x</error>'])),
+                          [{'error': 'x'}])
+        self.assertEquals(
+            list(dshield.stream.iter_xml_records([b'<asnum><error>x</error></asnum>'])),
+            [{'error': 'x'}])
+
+    @responses.activate
+    def test_iter_xml_error(self):
+        responses.add(responses.GET, 'https://dshield.org/api/asnum/1/10?xml',
+                      body='<?xml version="1.0"?>\n<error>no such AS</error>',
+                      match_querystring=True, content_type='text/xml')
+        self.assertRaises(dshield.Error, list,
+                          dshield.iter_asnum(1, 10, return_format=dshield.XML))
+
+    @responses.activate
+    def test_iter_functions_xml(self):
+        rows = [{'ip': '10.0.0.{0}'.format(n), 'attacks': str(n),
+                 'count': str(n * 2), 'firstseen': '2012-05-01',
+                 'lastseen': '2012-05-02'} for n in range(1000)]
+        body = '<?xml version="1.0" encoding="UTF-8"?>\n<sources>{0}</sources>'.format(
+            ''.join('<data>{0}</data>'.format(''.join(
+                '<{0}>{1}</{0}>'.format(key, value) for key, value in row.items()))
+                for row in rows))
+        responses.add(responses.GET, 'https://dshield.org/api/sources/ip/1000?xml',
+                      body=body, match_querystring=True, content_type='text/xml')
+        responses.add(responses.GET, 'https://dshield.org/api/sources/ip/1000?json',
+                      body=json.dumps(rows), match_querystring=True,
+                      content_type='text/json')
+        self.assertEquals(list(dshield.iter_sources('ip', 1000, return_format=dshield.XML)),
+                          rows)
+        self.assertEquals(
+            list(dshield.iter_sources('ip', 1000, return_format=dshield.XML, typed=True)),
+            list(dshield.iter_sources('ip', 1000, typed=True)))
+        self.assertEquals(next(dshield.iter_sources('ip', 1000, typed=True)),
+                          dshield.records.Source('10.0.0.0', 0, 0,
+                                                 datetime.date(2012, 5, 1),
+                                                 datetime.date(2012, 5, 2)))
+        self.assertRaises(ValueError, dshield.iter_asnum, 10,
+                          return_format=dshield.TEXT)
+
+    @responses.activate
+    def test_download_functions(self):
+        body = '<sources>' + '<row><ip>1.2.3.4</ip></row>' * 10000 + '</sources>'
+        responses.add(responses.GET, 'https://dshield.org/api/sources/ip/10000?xml',
+                      body=body, match_querystring=True, content_type='text/xml')
+        responses.add(responses.GET, 'https://dshield.org/api/asnum/10/5?text',
+                      body='a\tb', match_querystring=True, content_type='text/plain')
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'sources.xml')
+            self.assertEquals(dshield.download_sources(path, 'ip', 10000),
+                              len(body))
+            with open(path, 'rb') as output:
+                self.assertEquals(output.read(), body.encode('ascii'))
+            self.assertEquals(os.listdir(directory), ['sources.xml'])
+        finally:
+            shutil.rmtree(directory)
+        sink = io.BytesIO()
+        self.assertEquals(dshield.download_asnum(sink, 10, 5, dshield.TEXT), 3)
+        self.assertEquals(sink.getvalue(), b'a\tb')
+        self.assertRaises(ValueError, dshield.download_daily404detail, sink,
+                          '2012-02-23', return_format=dshield.TYPED)
+
+    @responses.activate
+    def test_download_error_keeps_existing_file(self):
+        responses.add(responses.GET, 'https://dshield.org/api/sources/attacks/10?xml',
+                      body='<html>503 busy</html>', status=503,
+                      match_querystring=True)
+        directory = tempfile.mkdtemp()
+        dshield.configure_retries(max_retries=0)
+        try:
+            path = os.path.join(directory, 'out.xml')
+            with open(path, 'wb') as output:
+                output.write(b'<sources/>')
+            self.assertRaises(dshield.Error, dshield.download_sources, path)
+            with open(path, 'rb') as output:
+                self.assertEquals(output.read(), b'<sources/>')
+            self.assertEquals(os.listdir(directory), ['out.xml'])
+            sink = io.BytesIO()
+            self.assertRaises(dshield.Error, dshield.download_sources, sink)
+            self.assertEquals(sink.getvalue(), b'')
+        finally:
+            dshield.configure_retries()
+            shutil.rmtree(directory)
+
+
+class TestRecords(unittest.TestCase):
+
+    def test_rows(self):
+        self.assertEquals(dshield.records.rows([{'a': 1}]), [{'a': 1}])
+        self.assertEquals(dshield.records.rows({'x': [{'a': 1}]}), [{'a': 1}])
+        self.assertEquals(dshield.records.rows(
+            {'limit': 2, '1': {'a': 2}, '0': {'a': 1}}), [{'a': 1}, {'a': 2}])
+        self.assertEquals(dshield.records.rows({'error': 'bad'}), None)
+        self.assertEquals(dshield.records.rows('text'), None)
+
+    def test_convert(self):
+        data = [{'ip': '1.2.3.4', 'attacks': '12', 'count': '345',
+                 'firstseen': '2012-03-01', 'lastseen': '2012-03-08 10:00:01',
+                 'extra': 'dropped'}]
+        source = dshield.records.convert('sources', data)[0]
+        self.assertEquals(source.ip, '1.2.3.4')
+        self.assertEquals(source.attacks, 12)
+        self.assertEquals(source.count, 345)
+        self.assertEquals(source.firstseen, datetime.date(2012, 3, 1))
+        self.assertEquals(source.lastseen, datetime.datetime(2012, 3, 8, 10, 0, 1))
+        self.assertFalse(hasattr(source, '__dict__'))
+        self.assertEquals(source._asdict()['count'], 345)
+        self.assertEquals(dshield.records.convert('sources', {'error': 'x'}),
+                          {'error': 'x'})
+        self.assertEquals(dshield.records.convert('infocon', {'status': 'green'}),
+                          {'status': 'green'})
+
+    @responses.activate
+    def test_typed_return_format(self):
+        responses.add(responses.GET, 'https://dshield.org/api/backscatter?json',
+                      body='[{"sourceport":"6000","count":"563542","sources":"518",'
+                           '"targets":"94654"}]',
+                      match_querystring=True, content_type='text/json')
+        self.assertEquals(dshield.backscatter(return_format=dshield.TYPED),
+                          [dshield.records.Backscatter(6000, 563542, 518, 94654)])
+
+    @responses.activate
+    def test_typed_long_range(self):
+        for start, end in [('2012-01-01', '2012-01-30'), ('2012-01-31', '2012-02-05')]:
+            responses.add(responses.GET,
+                          'https://dshield.org/api/dailysummary/{0}/{1}?json'.format(start, end),
+                          body='[{{"date":"{0}","records":"1"}}]'.format(end),
+                          match_querystring=True, content_type='text/json')
+        data = dshield.dailysummary('2012-01-01', '2012-02-05', dshield.TYPED)
+        self.assertEquals([row.date for row in data],
+                          [datetime.date(2012, 1, 30), datetime.date(2012, 2, 5)])
+        self.assertEquals(data[0].records, 1)
+
+
+class TestColumns(unittest.TestCase):
+
+    data = [{'date': '2012-01-01', 'records': '10', 'targets': '2', 'sources': '3'},
+            {'date': '2012-01-02', 'records': '', 'targets': '4', 'sources': '5'}]
+    missing_date = {'date': 'n/a', 'records': '1', 'targets': '1', 'sources': '1'}
+
+    def test_to_columns(self):
+        columns = dshield.records.to_columns('dailysummary', self.data)
+        self.assertEquals(len(columns), 2)
+        self.assertEquals(list(columns), ['date', 'records', 'targets', 'sources'])
+        self.assertEquals(columns['records'].tolist(), [10, dshield.records.MISSING])
+        self.assertEquals(columns['targets'].typecode, 'q')
+        self.assertEquals(columns.dates('date'),
+                          [datetime.date(2012, 1, 1), datetime.date(2012, 1, 2)])
+        self.assertEquals(dshield.records.to_columns('dailysummary', {'error': 'x'}),
+                          {'error': 'x'})
+
+    def test_to_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        columns = dshield.records.to_columns('dailysummary', self.data)
+        arrays = columns.to_numpy()
+        self.assertEquals(arrays['targets'].sum(), 6)
+        self.assertEquals(str(arrays['date'][1]), '2012-01-02')
+        columns['targets'][0] = 7
+        self.assertEquals(arrays['targets'][0], 7)
+        columns = dshield.records.to_columns('dailysummary',
+                                             self.data + [self.missing_date])
+        self.assertEquals(columns.dates('date')[2], None)
+        self.assertTrue(numpy.isnat(columns.to_numpy()['date'][2]))
+
+    @responses.activate
+    def test_columnar_return_format(self):
+        responses.add(responses.GET, 'https://dshield.org/api/topports/records/2?json',
+                      body='{"limit":2,"0":{"rank":1,"targetport":23,"records":"9"},'
+                           '"1":{"rank":2,"targetport":"445","records":"8"}}',
+                      match_querystring=True, content_type='text/json')
+        columns = dshield.topports(limit=2, return_format=dshield.COLUMNAR)
+        self.assertEquals(columns['targetport'].tolist(), [23, 445])
+        self.assertEquals(columns['records'].tolist(), [9, 8])
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def tearDown(self):
+        dshield.configure_rate_limit()
+        dshield.configure_retries()
+
+    def test_token_bucket(self):
+        bucket = dshield.ratelimit.TokenBucket(rate=10, burst=2)
+        self.assertEquals(bucket.reserve(), 0)
+        self.assertEquals(bucket.reserve(), 0)
+        self.assertAlmostEquals(bucket.reserve(), 0.1, places=2)
+        self.assertAlmostEquals(bucket.reserve(), 0.2, places=2)
+
+    def test_token_bucket_adapts(self):
+        bucket = dshield.ratelimit.TokenBucket(rate=10)
+        bucket.throttled(5)
+        self.assertEquals(bucket.current_rate, 5)
+        self.assertTrue(bucket.reserve() > 4)
+        for _ in range(20):
+            bucket.succeeded()
+        self.assertEquals(bucket.current_rate, 10)
+
+    def test_retry_after(self):
+        self.assertEquals(dshield.ratelimit.retry_after('3'), 3)
+        self.assertEquals(dshield.ratelimit.retry_after(None), None)
+        self.assertEquals(dshield.ratelimit.retry_after('soon'), None)
+        self.assertEquals(dshield.ratelimit.retry_after(
+            'Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+
+    def test_retry_delay(self):
+        policy = dshield.ratelimit.RetryPolicy(backoff=1, max_backoff=5)
+        for attempt in range(10):
+            self.assertTrue(0 <= policy.delay(attempt) <= 5)
+        self.assertTrue(2 <= policy.delay(0, 2) <= 3)
+        self.assertTrue(4.5 <= policy.delay(0, 4.5) <= 5)
+        self.assertEquals(policy.delay(0, 6), None)
+
+    @responses.activate
+    def test_retries_server_errors(self):
+        dshield.configure_retries(backoff=0)
+        dshield.configure_rate_limit(rate=1000)
+        url = 'https://dshield.org/api/infocon?json'
+        responses.add(responses.GET, url, status=503, match_querystring=True)
+        responses.add(responses.GET, url, status=429, match_querystring=True,
+                      adding_headers={'Retry-After': '0'})
+        responses.add(responses.GET, url, body='{"status":"green"}',
+                      match_querystring=True, content_type='text/json')
+        self.assertEquals(dshield.infocon(), {'status': 'green'})
+        self.assertEquals(len(responses.calls), 3)
+        self.assertEquals(dshield._limiter.current_rate, 500 + 50)
+
+    @responses.activate
+    def test_gives_up_after_max_retries(self):
+        dshield.configure_retries(max_retries=1, backoff=0)
+        responses.add(responses.GET, 'https://dshield.org/api/infocon?text',
+                      status=503, body='unavailable', match_querystring=True)
+        self.assertEquals(dshield.infocon(dshield.TEXT), 'unavailable')
+        self.assertEquals(len(responses.calls), 2)
+
+    @responses.activate
+    def test_gives_up_on_long_retry_after(self):
+        dshield.configure_retries(backoff=0, max_backoff=5)
+        responses.add(responses.GET, 'https://dshield.org/api/infocon?text',
+                      status=429, body='slow down', match_querystring=True,
+                      adding_headers={'Retry-After': '3600'})
+        self.assertEquals(dshield.infocon(dshield.TEXT), 'slow down')
+        self.assertEquals(len(responses.calls), 1)
+
+
+class TestCoalescing(unittest.TestCase):
+
+    @responses.activate
+    def test_concurrent_duplicates_share_one_request(self):
+        release = threading.Event()
+
+        def callback(request):
+            release.wait(5)
+            return (200, {}, '{"status":"green"}')
+        responses.add_callback(responses.GET, 'https://dshield.org/api/infocon',
+                               callback=callback, content_type='text/json')
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(dshield.infocon()))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(results, [{'status': 'green'}] * 5)
+        self.assertEquals(len(responses.calls), 1)
+        self.assertEquals(dshield._inflight, {})
+
+    def test_errors_are_shared(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def fetch():
+            started.set()
+            release.wait(5)
+            raise dshield.Error('failed')
+        errors = []
+
+        def call():
+            try:
+                dshield._coalesce('key', fetch)
+            except dshield.Error as e:
+                errors.append(e)
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=call)
+        follower.start()
+        time.sleep(0.1)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEquals(len(errors), 2)
+        self.assertTrue(errors[0] is errors[1])
+
+    @unittest.skipIf(aioresponses is None, "aiohttp is not installed")
+    def test_async_duplicates_share_one_request(self):
+        async def run():
+            try:
+                return await asyncio.gather(*[dshield.aio.infocon()
+                                              for _ in range(5)])
+            finally:
+                await dshield.aio.close_session()
+        calls = []
+
+        async def callback(url, **kwargs):
+            calls.append(url)
+            await asyncio.sleep(0.05)
+        with aioresponses() as mocked:
+            mocked.get('https://dshield.org/api/infocon?json', callback=callback,
+                       body='{"status":"green"}', content_type='text/json',
+                       repeat=True)
+            self.assertEquals(asyncio.run(run()), [{'status': 'green'}] * 5)
+        self.assertEquals(len(calls), 1)
+
+    @unittest.skipIf(aioresponses is None, "aiohttp is not installed")
+    def test_async_cancelled_leader(self):
+        async def run():
+            leader = asyncio.ensure_future(dshield.aio.infocon())
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(dshield.aio.infocon())
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            try:
+                return await follower
+            finally:
+                await dshield.aio.close_session()
+        calls = []
+
+        async def callback(url, **kwargs):
+            calls.append(url)
+            await asyncio.sleep(0.05)
+        with aioresponses() as mocked:
+            mocked.get('https://dshield.org/api/infocon?json', callback=callback,
+                       body='{"status":"green"}', content_type='text/json',
+                       repeat=True)
+            self.assertEquals(asyncio.run(run()), {'status': 'green'})
+        self.assertEquals(len(calls), 1)
+
+
+class TestHooks(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        dshield.add_hook(self.events.append)
+
+    def tearDown(self):
+        dshield.remove_hook(self.events.append)
+        dshield.disable_cache()
+
+    @responses.activate
+    def test_events(self):
+        responses.add(responses.GET, 'https://dshield.org/api/ip/4.4.4.4?json',
+                      body='{"ip":{"test":"unknown"}}',
+                      match_querystring=True, content_type='text/json')
+        dshield.configure_cache()
+        dshield.ip('4.4.4.4')
+        dshield.ip('4.4.4.4')
+        first, second = self.events
+        self.assertEquals((first.endpoint, first.uri, first.status, first.bytes),
+                          ('ip', 'ip/4.4.4.4', 200, 25))
+        self.assertEquals((first.cache, second.cache), ('miss', 'hit'))
+        self.assertEquals(first.retries, 0)
+        for phase in ('connect', 'ttfb', 'download', 'decode', 'total'):
+            self.assertTrue(getattr(first, phase) >= 0)
+        self.assertEquals((second.status, second.ttfb), (None, None))
+
+    @responses.activate
+    def test_error_events(self):
+        dshield.configure_retries(max_retries=0)
+        try:
+            self.assertRaises(requests.ConnectionError, dshield.infocon)
+        finally:
+            dshield.configure_retries()
+        self.assertTrue(isinstance(self.events[0].error, requests.ConnectionError))
+
+    @responses.activate
+    def test_streaming_events(self):
+        responses.add(responses.GET, 'https://dshield.org/api/sources/ip/2?json',
+                      body='[{"ip":"1"},{"ip":"2"}]',
+                      match_querystring=True, content_type='text/json')
+        self.assertEquals(len(list(dshield.iter_sources('ip', 2))), 2)
+        self.assertEquals((self.events[0].endpoint, self.events[0].bytes),
+                          ('sources', 23))
+        records = dshield.iter_sources('ip', 2)
+        next(records)
+        records.close()  # stopping early is not an error
+        self.assertEquals(len(self.events), 2)
+        self.assertEquals(self.events[1].error, None)
+
+    @responses.activate
+    def test_metrics(self):
+        responses.add(responses.GET, 'https://dshield.org/api/infocon?json',
+                      body='{"status":"green"}', match_querystring=True,
+                      content_type='text/json')
+        metrics = dshield.metrics.Metrics()
+        dshield.add_hook(metrics)
+        try:
+            dshield.infocon()
+            dshield.infocon()
+        finally:
+            dshield.remove_hook(metrics)
+        snapshot = metrics.snapshot()['infocon']
+        self.assertEquals(snapshot['requests'], 2)
+        self.assertEquals(snapshot['statuses'], {200: 2})
+        self.assertEquals(snapshot['bytes'], 36)
+        text = metrics.prometheus()
+        self.assertTrue('dshield_requests_total{endpoint="infocon",status="200"} 2.0'
+                        in text)
+        self.assertTrue('dshield_call_duration_seconds_count{endpoint="infocon"} 2.0'
+                        in text)
+        self.assertTrue('dshield_call_duration_seconds_bucket{endpoint="infocon",le="+Inf"} 2.0'
+                        in text)
+        metrics.reset()
+        self.assertEquals(metrics.snapshot(), {})
+
 
 class TestPublicMethods(unittest.TestCase):
 
@@ -106,6 +1508,84 @@ class TestPublicMethods(unittest.TestCase):
         self.assertEquals(dshield.ip('4.4.4.4', dshield.JSON), '{"ip":{"test":"unknown"}}')
         self.assertRaises(dshield.Error, dshield.ip, 'badip')
 
+    @responses.activate
+    def test_local_validation(self):
+        # Nothing is registered, so any request would fail with ConnectionError.
+        for call, args in [(dshield.ip, ('1.2.3',)),
+                           (dshield.ip, ('1.2.3.256',)),
+                           (dshield.ip, ('2001:db8::g',)),
+                           (dshield.port, (65536,)),
+                           (dshield.port, ('-1',)),
+                           (dshield.portdate, (80, '2011-13-01')),
+                           (dshield.porthistory, (22, '2011-07-20', '2011-07-01')),
+                           (dshield.topports, ('attacks',)),
+                           (dshield.sources, ('ip', 0)),
+                           (dshield.sources, ('ip', 10001)),
+                           (dshield.asnum, ('AS4837',)),
+                           (dshield.asnum, (4837, 2001)),
+                           (dshield.dailysummary, ('yesterday',)),
+                           (dshield.daily404detail, ('2011-07-20', 'all'))]:
+            self.assertRaises(dshield.Error, call, *args)
+        self.assertEquals(len(responses.calls), 0)
+        self.assertEquals(dshield._check_ip('010.001.002.003'), '010.001.002.003')
+        self.assertEquals(dshield._check_ip('2001:db8::1'), '2001:db8::1')
+
+    def test_raise_for(self):
+        raise_for = dshield._raise_for
+        self.assertRaises(dshield.Error, raise_for, {'error': 'bad IP address'},
+                          'bad IP address', 'Bad IP address, x')
+        self.assertRaises(dshield.Error, raise_for,
+                          {'porthistory': {'error': 'bad port number'}},
+                          'bad port number', 'Bad port number, x')
+        self.assertRaises(dshield.Error, raise_for,
+                          '<error>bad IP address</error>', 'bad IP address', 'x')
+        data = [{'comment': 'bad IP address'}] * 1000
+        self.assertTrue(raise_for(data, 'bad IP address', 'x') is data)
+        text = '<rows>' + '<row>1.2.3.4</row>' * 100 + '<row>bad IP address</row></rows>'
+        self.assertTrue(raise_for(text, 'bad IP address', 'x') is text)
+        try:
+            raise_for({'error': 'rate limited'}, 'bad IP address', 'x')
+        except dshield.Error as e:
+            self.assertEquals(str(e), 'rate limited')
+
+    @responses.activate
+    def test_ip_many(self):
+        for address in ['1.1.1.1', '2.2.2.2', '3.3.3.3']:
+            responses.add(responses.GET,
+                          'https://dshield.org/api/ip/{0}?json'.format(address),
+                          body='{{"ip":{{"number":"{0}"}}}}'.format(address),
+                          match_querystring=True, content_type='text/json')
+        responses.add(responses.GET, 'https://dshield.org/api/ip/badip?json',
+                      body='{"error":"bad IP address"}', status=200,
+                      match_querystring=True, content_type='text/json')
+        addresses = ['1.1.1.1', '2.2.2.2', 'badip', '1.1.1.1', '3.3.3.3']
+        results = list(dshield.ip_many(addresses, concurrency=2, ordered=True))
+        self.assertEquals([address for address, _ in results],
+                          ['1.1.1.1', '2.2.2.2', 'badip', '3.3.3.3'])
+        self.assertEquals(results[0][1], {'ip': {'number': '1.1.1.1'}})
+        self.assertTrue(isinstance(results[2][1], dshield.Error))
+        # 'badip' is rejected locally, without a request.
+        self.assertEquals(len(responses.calls), 3)
+        unordered = dict(dshield.ip_many(addresses))
+        self.assertEquals(sorted(unordered), sorted(set(addresses)))
+
+    @responses.activate
+    def test_ip_many_server_errors(self):
+        responses.add(responses.GET, 'https://dshield.org/api/ip/1.1.1.1?json',
+                      body='{"ip":{"number":"1.1.1.1"}}',
+                      match_querystring=True, content_type='text/json')
+        responses.add(responses.GET, 'https://dshield.org/api/ip/2.2.2.2?json',
+                      body='<html>Service Unavailable</html>', status=503,
+                      match_querystring=True, content_type='text/html')
+        dshield.configure_retries(max_retries=0)
+        try:
+            results = list(dshield.ip_many(['1.1.1.1', '2.2.2.2'], ordered=True))
+        finally:
+            dshield.configure_retries()
+        self.assertEquals(results[0], ('1.1.1.1', {'ip': {'number': '1.1.1.1'}}))
+        self.assertEquals(results[1][0], '2.2.2.2')
+        self.assertTrue(isinstance(results[1][1], dshield.Error))
+
     @responses.activate
     def test_port(self):
         responses.add(responses.GET, 'https://dshield.org/api/port/80?json',
@@ -212,8 +1692,9 @@ class TestPublicMethods(unittest.TestCase):
                       'https://dshield.org/api/porthistory/80/2011-07-20/2011-07-23?json',
                       body='{"porthistory":"test"}',
                       match_querystring=True, content_type='text/json')
+        recent = datetime.date.today() - datetime.timedelta(days=10)
         responses.add(responses.GET,
-                      'https://dshield.org/api/porthistory/80/2011-07-20?json',
+                      'https://dshield.org/api/porthistory/80/{0}?json'.format(recent),
                       body='{"porthistory":"test"}',
                       match_querystring=True, content_type='text/json')
         responses.add(responses.GET, 'https://dshield.org/api/porthistory/80?json',
@@ -230,16 +1711,57 @@ class TestPublicMethods(unittest.TestCase):
         data = {'porthistory': 'test'}
         self.assertEquals(dshield.porthistory(80), data)
         self.assertEquals(dshield.porthistory('80'), data)
-        self.assertEquals(dshield.porthistory(80, datetime.date(2011, 7, 20)), data)
+        self.assertEquals(dshield.porthistory(80, recent), data)
         self.assertEquals(dshield.porthistory(80, '2011-07-20', datetime.date(2011, 7, 23)), data)
         self.assertEquals(dshield.porthistory(80, '2011-07-20', '2011-07-23'), data)
         self.assertEquals(dshield.porthistory(80, return_format=dshield.JSON), '{"porthistory":"test"}')
         self.assertRaises(dshield.Error, dshield.porthistory, 'badport')
 
+    @responses.activate
+    def test_porthistory_long_range(self):
+        days = [datetime.date(2011, 1, 1) + datetime.timedelta(days=n)
+                for n in range(75)]
+        for start, end in [(0, 29), (30, 59), (60, 74)]:
+            body = json.dumps({'porthistory': [
+                {'date': str(day), 'records': str(n)}
+                for n, day in enumerate(days[start:end + 1], start)]})
+            responses.add(responses.GET,
+                          'https://dshield.org/api/porthistory/80/{0}/{1}?json'.format(
+                              days[start], days[end]),
+                          body=body, match_querystring=True,
+                          content_type='text/json')
+        data = dshield.porthistory(80, '2011-01-01', datetime.date(2011, 3, 16))
+        self.assertEquals([row['date'] for row in data['porthistory']],
+                          [str(day) for day in days])
+        self.assertEquals(len(responses.calls), 3)
+
+    @responses.activate
+    def test_porthistory_open_range_runs_to_today(self):
+        today = datetime.date.today()
+        start = today - datetime.timedelta(days=40)
+        middle = start + datetime.timedelta(days=dshield.MAX_RANGE_DAYS)
+        for first, last in [(start, middle - datetime.timedelta(days=1)),
+                            (middle, today)]:
+            responses.add(responses.GET,
+                          'https://dshield.org/api/porthistory/80/{0}/{1}?json'.format(
+                              first, last),
+                          body=json.dumps([{'date': str(first)}]),
+                          match_querystring=True, content_type='text/json')
+        self.assertEquals(dshield.porthistory(80, start),
+                          [{'date': str(start)}, {'date': str(middle)}])
+        self.assertEquals(len(responses.calls), 2)
+
+    def test_windows(self):
+        self.assertEquals(dshield._windows('2011-01-01', '2011-01-30'), None)
+        self.assertEquals(dshield._windows('2011-01-01', '2011-01-31'),
+                          [(datetime.date(2011, 1, 1), datetime.date(2011, 1, 30)),
+                           (datetime.date(2011, 1, 31), datetime.date(2011, 1, 31))])
+        self.assertEquals(dshield._windows(None, '2011-01-31'), None)
+
     @responses.activate
     def test_asnum(self):
         responses.add(responses.GET,
-                      'https://dshield.org/api/asnum/10/4837?json',
+                      'https://dshield.org/api/asnum/10/2000?json',
                       body='{"asnum":"test"}',
                       match_querystring=True, content_type='text/json')
         responses.add(responses.GET, 'https://dshield.org/api/asnum/10?json',
@@ -248,8 +1770,8 @@ class TestPublicMethods(unittest.TestCase):
         data = {'asnum': 'test'}
         self.assertEquals(dshield.asnum(10), data)
         self.assertEquals(dshield.asnum('10'), data)
-        self.assertEquals(dshield.asnum(10, 4837), data)
-        self.assertEquals(dshield.asnum(10, '4837'), data)
+        self.assertEquals(dshield.asnum(10, 2000), data)
+        self.assertEquals(dshield.asnum(10, '2000'), data)
         self.assertEquals(dshield.asnum(10, return_format=dshield.JSON), '{"asnum":"test"}')
 
     @responses.activate
@@ -258,8 +1780,9 @@ class TestPublicMethods(unittest.TestCase):
                       'https://dshield.org/api/dailysummary/2012-05-01/2012-05-03?json',
                       body='{"dailysummary":"test"}',
                       match_querystring=True, content_type='text/json')
+        recent = datetime.date.today() - datetime.timedelta(days=10)
         responses.add(responses.GET,
-                      'https://dshield.org/api/dailysummary/2012-05-01?json',
+                      'https://dshield.org/api/dailysummary/{0}?json'.format(recent),
                       body='{"dailysummary":"test"}',
                       match_querystring=True, content_type='text/json')
         responses.add(responses.GET,
@@ -268,12 +1791,42 @@ class TestPublicMethods(unittest.TestCase):
                       match_querystring=True, content_type='text/json')
         data = {'dailysummary': 'test'}
         self.assertEquals(dshield.dailysummary(), data)
-        self.assertEquals(dshield.dailysummary('2012-05-01'), data)
-        self.assertEquals(dshield.dailysummary(datetime.date(2012, 5, 1)), data)
+        self.assertEquals(dshield.dailysummary(str(recent)), data)
+        self.assertEquals(dshield.dailysummary(recent), data)
         self.assertEquals(dshield.dailysummary('2012-05-01', '2012-05-03'), data)
         self.assertEquals(dshield.dailysummary('2012-05-01', datetime.date(2012, 5, 3)), data)
         self.assertEquals(dshield.dailysummary(return_format=dshield.JSON), '{"dailysummary":"test"}')
 
+    @responses.activate
+    def test_dailysummary_long_range(self):
+        responses.add(responses.GET,
+                      'https://dshield.org/api/dailysummary/2012-01-01/2012-01-30?json',
+                      body='[{"date":"2012-01-30"},{"date":"2012-01-01"}]',
+                      match_querystring=True, content_type='text/json')
+        responses.add(responses.GET,
+                      'https://dshield.org/api/dailysummary/2012-01-31/2012-02-05?json',
+                      body='[{"date":"2012-01-31"},{"date":"2012-01-30"},{"date":"2012-02-05"}]',
+                      match_querystring=True, content_type='text/json')
+        data = dshield.dailysummary('2012-01-01', '2012-02-05')
+        self.assertEquals([row['date'] for row in data],
+                          ['2012-01-01', '2012-01-30', '2012-01-31', '2012-02-05'])
+
+    @responses.activate
+    def test_dailysummary_long_range_error(self):
+        responses.add(responses.GET,
+                      'https://dshield.org/api/dailysummary/2012-01-01/2012-01-30?json',
+                      body='[{"date":"2012-01-01"}]',
+                      match_querystring=True, content_type='text/json')
+        responses.add(responses.GET,
+                      'https://dshield.org/api/dailysummary/2012-01-31/2012-02-05?json',
+                      body='{"error":"too many requests"}',
+                      match_querystring=True, content_type='text/json')
+        self.assertRaises(dshield.Error, dshield.dailysummary, '2012-01-01',
+                          '2012-02-05')
+        self.assertEquals(dshield._merge_days([[{'date': '2012-01-01'}],
+                                               {'note': 'no rows'}]),
+                          [{'date': '2012-01-01'}])
+
     @responses.activate
     def test_daily404summary(self):
         responses.add(responses.GET,
@@ -344,6 +1897,194 @@ class TestPublicMethods(unittest.TestCase):
         self.assertEquals(dshield.webhoneypotbytype('2012-12-10', return_format=dshield.JSON),
                           '{"webhoneypotbytype":"test"}')
 
+@unittest.skipIf(aioresponses is None, "aiohttp is not installed")
+class TestAsyncMethods(unittest.TestCase):
+
+    def run_async(self, coroutine):
+        async def run():
+            try:
+                return await coroutine
+            finally:
+                await dshield.aio.close_session()
+        return asyncio.run(run())
+
+    def test_pooled_session(self):
+        async def run():
+            async with dshield.aio.pooled_session():
+                await dshield.aio.infocon()
+                self.assertIn(asyncio.get_running_loop(), dshield.aio._sessions)
+            return asyncio.get_running_loop() in dshield.aio._sessions
+        with aioresponses() as mocked:
+            mocked.get('https://dshield.org/api/infocon?json',
+                       body='{"status":"green"}', content_type='text/json')
+            self.assertFalse(asyncio.run(run()))
+
+    def test_gets_dict_if_not_type(self):
+        with aioresponses() as mocked:
+            mocked.get('https://dshield.org/api/infocon?json',
+                       body='{"status":"green"}', content_type='text/json')
+            self.assertEquals(self.run_async(dshield.aio.infocon()),
+                              {'status': 'green'})
+
+    def test_gets_string_if_type(self):
+        with aioresponses() as mocked:
+            mocked.get('https://dshield.org/api/infocon?json',
+                       body='{"status":"green"}', content_type='text/json')
+            self.assertEquals(self.run_async(dshield.aio.infocon(dshield.JSON)),
+                              '{"status":"green"}')
+
+    def test_uri_building(self):
+        with aioresponses() as mocked:
+            mocked.get('https://dshield.org/api/topports/records/10/2011-07-23?json',
+                       body='{"topports":"test"}', content_type='text/json')
+            self.assertEquals(
+                self.run_async(dshield.aio.topports('records', 10,
+                                                    datetime.date(2011, 7, 23))),
+                {'topports': 'test'})
+
+    def test_ip_error(self):
+        with aioresponses() as mocked:
+            mocked.get('https://dshield.org/api/ip/badip?json',
+                       body='{"error":"bad IP address"}', content_type='text/json')
+            self.assertRaises(dshield.Error, self.run_async,
+                              dshield.aio.ip('badip'))
+
+    def test_ip_many(self):
+        async def collect():
+            return [item async for item in
+                    dshield.aio.ip_many(['4.4.4.4', 'badip', '4.4.4.4'],
+                                        ordered=True)]
+        with aioresponses() as mocked:
+            mocked.get('https://dshield.org/api/ip/4.4.4.4?json',
+                       body='{"ip":{"test":"unknown"}}', content_type='text/json')
+            mocked.get('https://dshield.org/api/ip/badip?json',
+                       body='{"error":"bad IP address"}', content_type='text/json')
+            results = self.run_async(collect())
+        self.assertEquals(results[0], ('4.4.4.4', {'ip': {'test': 'unknown'}}))
+        self.assertEquals(results[1][0], 'badip')
+        self.assertTrue(isinstance(results[1][1], dshield.Error))
+        self.assertEquals(len(results), 2)
+
+    def test_long_range_error(self):
+        with aioresponses() as mocked:
+            mocked.get('https://dshield.org/api/dailysummary/2012-01-01/2012-01-30?json',
+                       body='[{"date":"2012-01-01"}]', content_type='text/json')
+            mocked.get('https://dshield.org/api/dailysummary/2012-01-31/2012-02-05?json',
+                       body='{"error":"too many requests"}', content_type='text/json')
+            self.assertRaises(dshield.Error, self.run_async,
+                              dshield.aio.dailysummary('2012-01-01', '2012-02-05'))
+
+    def test_ip_many_server_errors(self):
+        async def collect():
+            return [item async for item in
+                    dshield.aio.ip_many(['4.4.4.4', '5.5.5.5'], ordered=True)]
+        dshield.configure_retries(max_retries=0)
+        try:
+            with aioresponses() as mocked:
+                mocked.get('https://dshield.org/api/ip/4.4.4.4?json',
+                           body='{"ip":{"test":"unknown"}}', content_type='text/json')
+                mocked.get('https://dshield.org/api/ip/5.5.5.5?json', status=503,
+                           body='<html>Service Unavailable</html>',
+                           content_type='text/html')
+                results = self.run_async(collect())
+        finally:
+            dshield.configure_retries()
+        self.assertEquals(results[0], ('4.4.4.4', {'ip': {'test': 'unknown'}}))
+        self.assertTrue(isinstance(results[1][1], dshield.Error))
+
+    def test_revalidation(self):
+        async def twice():
+            first = await dshield.aio.infocon()
+            await asyncio.sleep(0.02)
+            return first, await dshield.aio.infocon()
+        dshield.configure_cache(ttls={'infocon': 0.01})
+        try:
+            with aioresponses() as mocked:
+                mocked.get('https://dshield.org/api/infocon?json',
+                           body='{"status":"green"}', content_type='text/json',
+                           headers={'ETag': '"v1"'})
+                mocked.get('https://dshield.org/api/infocon?json', status=304)
+                first, second = self.run_async(twice())
+                calls = list(mocked.requests.values())[0]
+        finally:
+            dshield.disable_cache()
+        self.assertTrue(second is first)
+        self.assertEquals(calls[1].kwargs['headers'], {'If-None-Match': '"v1"'})
+
+    def test_error_responses_are_not_cached(self):
+        async def twice():
+            return (await dshield.aio.infocon(dshield.XML),
+                    await dshield.aio.infocon(dshield.XML))
+        dshield.configure_cache()
+        dshield.configure_retries(max_retries=0)
+        try:
+            with aioresponses() as mocked:
+                mocked.get('https://dshield.org/api/infocon?xml',
+                           body='<html>busy</html>', status=503)
+                mocked.get('https://dshield.org/api/infocon?xml',
+                           body='<infocon/>')
+                results = self.run_async(twice())
+        finally:
+            dshield.configure_retries()
+            dshield.disable_cache()
+        self.assertEquals(results, ('<html>busy</html>', '<infocon/>'))
+
+    def test_replay(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'responses.gz')
+        archive = dshield.replay.Archive(path, dshield.RECORD)
+        archive.add('infocon?json', 200, b'{"status":"green"}')
+        archive.close()
+        dshield.configure_archive(path, dshield.REPLAY)
+        try:
+            self.assertEquals(self.run_async(dshield.aio.infocon()),
+                              {'status': 'green'})
+            self.assertRaises(dshield.ReplayMiss, self.run_async,
+                              dshield.aio.handler())
+        finally:
+            dshield.disable_archive()
+            shutil.rmtree(directory)
+
+    def test_mirrors_public_functions(self):
+        for name in ['backscatter', 'handler', 'infocon', 'ip', 'port',
+                     'portdate', 'topports', 'topips', 'sources',
+                     'porthistory', 'asnum', 'dailysummary', 'daily404summary',
+                     'daily404detail', 'glossary', 'webhoneypotsummary',
+                     'webhoneypotbytype']:
+            self.assertTrue(asyncio.iscoroutinefunction(getattr(dshield.aio, name)))
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def setUp(self):
+        from benchmarks.server import SimulatedServer
+        self.server = SimulatedServer(rows=5).start()
+        dshield.configure_session(base_url=self.server.base_url)
+
+    def tearDown(self):
+        dshield.configure_session()
+        self.server.stop()
+
+    def test_simulated_server(self):
+        self.assertEquals(dshield.infocon(), {'status': 'green'})
+        self.assertEquals(len(dshield.sources(limit=7)), 7)
+        self.assertEquals(dshield.sources(limit=7), dshield.sources(limit=7))
+        self.assertTrue(dshield.topports(return_format=dshield.XML)
+                        .startswith('<?xml'))
+        self.assertRaises(dshield.Error, dshield.ip, 'badip')
+
+    def test_compare(self):
+        from benchmarks.run import compare
+        baseline = {'results': {'single': {'ip': {'calls': 10, 'p50': 0.01,
+                                                  'throughput': 100.0}}}}
+        current = {'results': {'single': {'ip': {'calls': 10, 'p50': 0.02,
+                                                 'throughput': 110.0}}}}
+        self.assertEquals(
+            [(name, regressed) for name, _, _, _, regressed
+             in compare(baseline, current, 0.2)],
+            [('single/ip/p50', True), ('single/ip/throughput', False)])
+
+
 class TestRealAPI(unittest.TestCase):
 
     def test_no_functions_throw_exceptions(self):